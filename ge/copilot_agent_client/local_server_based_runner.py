@@ -1,5 +1,11 @@
+import sys
+import threading
+
 from multiprocessing import Process, Queue
 
+if "." not in sys.path:
+    sys.path.append(".")
+
 from copilot_front_end.mobile_action_helper import list_devices, get_device_wm_size
 
 from megfile import smart_open, smart_exists
@@ -7,6 +13,7 @@ from copy import deepcopy
 import jsonlines
 
 from copilot_agent_client.pu_client import evaluate_task_on_device
+from copilot_agent_server.trace_writer import get_trace_writer
 
 import time
 import random
@@ -18,11 +25,21 @@ class CopilotClientRolloutRunner:
                  server,
                  rollout_config: dict,
                  result_output_file: str,
-                 logger=None, device_name_map = {}
+                 logger=None, device_name_map = {},
+                 worker_mode=None,
                  ):
         
         self.device_task_map = device_task_map
 
+        # "process", a process per device, or "thread", a thread per device sharing the process wide micro-batcher,
+        # response cache and endpoint balancer of the server; the micro-batcher only batches the requests of
+        # one process, so the default is "thread" when micro_batching is configured
+        if worker_mode is None:
+            model_config = rollout_config.get('model_config', {})
+            worker_mode = "thread" if model_config.get('micro_batching', None) is not None else "process"
+        assert worker_mode in ["process", "thread"], f"Unknown worker_mode {worker_mode}"
+        self.worker_mode = worker_mode
+
         self.device_count = len(device_task_map)
 
         self.server = server
@@ -115,6 +132,24 @@ class CopilotClientRolloutRunner:
 
         self.log_queue.put(f"Total put {task_put_count} tasks into the queues.")
         self.log_queue.put(f"Reader runner stopped.")
+
+    def get_device_info(self, device_id):
+        return {
+            "device_id": device_id,
+            "device_wm_size": get_device_wm_size(device_id)
+        }
+
+    def run_task(self, device_info, task_meta):
+        """
+        Run one task on a device, returns its result log.
+        """
+        return evaluate_task_on_device(
+            self.server,
+            device_info,
+            task_meta['task'],
+            self.rollout_config,
+            extra_info = task_meta.get('origin_meta_data', {})
+        )
         
     def work_runner(self, device_id):
 
@@ -130,10 +165,7 @@ class CopilotClientRolloutRunner:
                 total_taskcount += self.device_task_count_map[device_id]
             return total_taskcount
         
-        device_info = {
-            "device_id": device_id,
-            "device_wm_size": get_device_wm_size(device_id)
-        }
+        device_info = self.get_device_info(device_id)
 
         while not self.task_queue[device_id].empty():
             task_meta = self.task_queue[device_id].get()
@@ -151,13 +183,7 @@ class CopilotClientRolloutRunner:
 
             try:
 
-                result_log = evaluate_task_on_device(
-                    self.server,
-                    device_info,
-                    task,
-                    self.rollout_config,
-                    extra_info = task_meta.get('origin_meta_data', {})
-                )
+                result_log = self.run_task(device_info, task_meta)
 
                 result_log['device_name'] = device_name
 
@@ -190,6 +216,7 @@ class CopilotClientRolloutRunner:
         """
         stop_signal_count = 0
         log_writer_count = 0
+        trace_writer = get_trace_writer()
         while True:
             log = self.done_queue.get()
             if log is None:
@@ -198,12 +225,11 @@ class CopilotClientRolloutRunner:
                     break
                 continue
             
-            # Write the log to the output file
-            with smart_open(self.result_output_file, 'a', encoding='utf-8') as f:
-                log_writer = jsonlines.Writer(f)
-                log_writer.write(log)
-                log_writer_count += 1
-            
+            # Write the log to the output file, each result is synced as it may end hours of rollout
+            trace_writer.write(self.result_output_file, log, fsync=True)
+            log_writer_count += 1
+
+        trace_writer.close(self.result_output_file)
         print(f"All logs have been written to {self.result_output_file}. Total logs written: {log_writer_count}")
 
 
@@ -219,8 +245,9 @@ class CopilotClientRolloutRunner:
         # Start the reader process to populate task queues
         self.reader_runner()
         
+        worker_class = Process if self.worker_mode == "process" else threading.Thread
         for device_id in self.device_task_map:
-            worker = Process(target=self.work_runner, args=(device_id,))
+            worker = worker_class(target=self.work_runner, args=(device_id,))
             workers.append(worker)
             worker.start()
         
@@ -234,3 +261,73 @@ class CopilotClientRolloutRunner:
         print("All tasks have been processed and logs written to the output file.")
 
 
+if __name__ == "__main__":
+    # python copilot_agent_client/local_server_based_runner.py [devices]
+    # rollouts through the runner against a stand-in model, one submission at a time as an inference server batching
+    # on its own: 30ms per submission plus 2ms per request in it; the devices take a step right after the previous one
+    import io
+    import os
+    import json
+    import tempfile
+    import contextlib
+
+    import yaml
+    from PIL import Image
+
+    from tools.llm_providers import _StandInOpenAIServer
+    from tools.image_pipeline import image_asset_from_frame
+
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    steps = 10
+
+    backend_lock = threading.Lock()
+    submissions = []
+
+    def latency(request):
+        batch_size = len(request.get("requests", [request]))
+        with backend_lock:
+            submissions.append(batch_size)
+            time.sleep(0.03 + 0.002 * batch_size)
+        return 0
+
+    model_server = _StandInOpenAIServer(latency=latency, reply="<THINK> ok </THINK>\nexplain:ok\taction:WAIT\tvalue:1\tsummary:ok")
+    screenshot = image_asset_from_frame(Image.effect_noise((540, 1200), 64).convert("RGB"))[1]
+
+    class StandInDeviceRunner(CopilotClientRolloutRunner):
+        def get_device_info(self, device_id):
+            return {"device_id": device_id, "device_wm_size": (1080, 2400)}
+
+        def run_task(self, device_info, task_meta):
+            session_id = self.server.get_session({"task": task_meta['task'], "task_type": self.rollout_config['task_type'],
+                "model_config": self.rollout_config['model_config']})
+            for _ in range(steps):
+                self.server.automate_step({"session_id": session_id,
+                    "observation": {"screenshot": {"image_url": {"url": screenshot}}, "query": ""}})
+            return {"session_id": session_id, "task": task_meta['task'], "rollout_config": self.rollout_config}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, "model_config.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump({"stand-in": {"api_base": model_server.api_base, "batch_api_path": "/batch/chat/completions"}}, f)
+        os.environ["GELAB_MODEL_CONFIG"] = config_path
+
+        from copilot_agent_server.local_server import LocalServer
+
+        server = LocalServer({"log_dir": os.path.join(tmp_dir, "logs"), "image_dir": os.path.join(tmp_dir, "images")})
+        rollout_config = {"task_type": "parser_0920", "model_config": {"model_name": "stand-in", "model_provider": "stand-in",
+            "micro_batching": {"window": 0.02, "max_batch_size": 16}}}
+
+        for worker_mode in ["process", "thread"]:
+            device_task_map = {f"device-{i}": [{"task": f"{worker_mode} task {i}"}] for i in range(devices)}
+            runner = StandInDeviceRunner(device_task_map, server, rollout_config,
+                os.path.join(tmp_dir, f"results_{worker_mode}.jsonl"), worker_mode=worker_mode)
+            submissions.clear()
+            start_time = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                runner.run()
+            elapsed = time.time() - start_time
+            with open(os.path.join(tmp_dir, f"results_{worker_mode}.jsonl")) as f:
+                assert len(f.readlines()) == devices
+            print(f"{devices} devices, {worker_mode} workers: {devices * steps / elapsed:.1f} steps/s, "
+                  f"{len(submissions)} submissions, mean batch size {sum(submissions) / len(submissions):.1f}")
+    model_server.close()
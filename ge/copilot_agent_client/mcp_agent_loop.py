@@ -9,18 +9,17 @@ import json
 from PIL import Image
 import io
 
-from tools.image_tools import make_b64_url
+from tools.image_tools import make_b64_url_from_image
 
-from copilot_front_end.mobile_action_helper import capture_screenshot, dectect_screen_on, press_home_key
+from copilot_front_end.mobile_action_helper import capture_screenshot_frame, dectect_screen_on, press_home_key
 
 from copilot_front_end.mobile_action_helper import init_device, open_screen
 from copilot_front_end.pu_frontend_executor import act_on_device, uiTars_to_frontend_action
+from copilot_front_end.screen_settle import wait_after_action
 from copilot_front_end.mobile_action_helper import get_device_wm_size
 from fastmcp.utilities.types import Image as MCPImage
 
 
-from megfile import smart_remove
-
 import time
 
 from tools.ask_llm_v2 import ask_llm_anything
@@ -240,6 +239,9 @@ def gui_agent_loop(
 
     delay_after_capture = agent_loop_config.get('delay_after_capture', 2)
 
+    # if given, wait for the screen to settle after each action instead of the fixed delay_after_capture
+    settle_config = agent_loop_config.get('settle_config', None)
+
     history_actions = []
     
 
@@ -271,14 +273,14 @@ def gui_agent_loop(
             stop_reason = "MANUAL_STOP_SCREEN_OFF"
             break
 
-        image_path = capture_screenshot(device_id, "tmp_screenshot", print_command=False)
+        screenshot_frame = capture_screenshot_frame(device_id, print_command=False)
 
         # current step log use to store intermediate logs if enabled
         current_step_log = {
 
         }
 
-        image_b64_url = make_b64_url(image_path)
+        image_b64_url = make_b64_url_from_image(screenshot_frame)
 
         current_step_log["screenshot_b64_url"] = image_b64_url
         
@@ -295,8 +297,6 @@ def gui_agent_loop(
             )
             caption_thread.start()
 
-
-        smart_remove(image_path)
         
         payload = {
             "session_id": session_id,
@@ -367,7 +367,7 @@ def gui_agent_loop(
             else:
                 raise ValueError(f"Unknown reply_mode: {reply_mode}")
 
-        act_on_device(action, device_id, device_wm_size, print_command=True, reflush_app=reflush_app)
+        act_on_device(action, device_id, device_wm_size, print_command=True, reflush_app=reflush_app, settle_config=settle_config)
 
         history_actions.append(action)
 
@@ -379,7 +379,9 @@ def gui_agent_loop(
             stop_reason = action['action_type'].upper()
             break
 
-        time.sleep(delay_after_capture)
+        settle_stats = wait_after_action(device_id, action['action_type'], settle_config, delay_after_capture)
+        if settle_stats is not None:
+            current_step_log['settle_stats'] = settle_stats
     
     # if intermediate caption is not enabled, but final caption is enabled, caption the final screenshot
     if enable_final_image_caption and not enable_intermediate_image_caption:
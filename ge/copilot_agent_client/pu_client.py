@@ -9,14 +9,13 @@ import json
 from PIL import Image
 import io
 
-from tools.image_tools import draw_points, make_b64_url
+from tools.image_tools import draw_points, make_b64_url_from_image
 
-from copilot_front_end.mobile_action_helper import capture_screenshot, dectect_screen_on, press_home_key
+from copilot_front_end.mobile_action_helper import capture_screenshot_frame, dectect_screen_on, press_home_key
 
 from copilot_front_end.mobile_action_helper import init_device, open_screen
 from copilot_front_end.pu_frontend_executor import act_on_device, uiTars_to_frontend_action
-
-from megfile import smart_remove
+from copilot_front_end.screen_settle import wait_after_action
 
 import time
 
@@ -136,6 +135,9 @@ def evaluate_task_on_device(agent_server, device_info, task, rollout_config, ext
     max_steps = rollout_config.get('max_steps', 40)
     delay_after_capture = rollout_config.get('delay_after_capture', 2)
 
+    # if given, wait for the screen to settle after each action instead of the fixed delay_after_capture
+    settle_config = rollout_config.get('settle_config', None)
+
     history_actions = []
 
     for step_idx in range(max_steps):
@@ -144,10 +146,9 @@ def evaluate_task_on_device(agent_server, device_info, task, rollout_config, ext
             print("Screen is off, turn on the screen first")
             break
 
-        image_path = capture_screenshot(device_id, "tmp_screenshot", print_command=False)
+        screenshot_frame = capture_screenshot_frame(device_id, print_command=False)
 
-        image_b64_url = make_b64_url(image_path, resize_config=rollout_config['model_config'].get("resize_config", None))
-        smart_remove(image_path)
+        image_b64_url = make_b64_url_from_image(screenshot_frame, resize_config=rollout_config['model_config'].get("resize_config", None))
         
         payload = {
             "session_id": session_id,
@@ -184,7 +185,7 @@ def evaluate_task_on_device(agent_server, device_info, task, rollout_config, ext
         #TODO: to replace with the new function
         action = uiTars_to_frontend_action(action)
 
-        act_on_device(action, device_id, device_wm_size, print_command=True, reflush_app=reflush_app)
+        act_on_device(action, device_id, device_wm_size, print_command=True, reflush_app=reflush_app, settle_config=settle_config)
 
         history_actions.append(action)
 
@@ -195,7 +196,9 @@ def evaluate_task_on_device(agent_server, device_info, task, rollout_config, ext
             stop_reason = action['action_type'].upper()
             break
 
-        time.sleep(delay_after_capture)
+        settle_stats = wait_after_action(device_id, action['action_type'], settle_config, delay_after_capture)
+        if settle_stats is not None:
+            print(f"Screen settled: {settle_stats['settled']} after {settle_stats['waited']:.2f}s, {settle_stats['frames']} frames")
     
     if action['action_type'] in ['COMPLETE', "ABORT"]:
         stop_reason = action['action_type']
@@ -0,0 +1,112 @@
+import os
+import atexit
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from megfile import smart_open
+
+
+class ImageWriterPool:
+    """
+    Persist images in background threads, so that a step does not wait for the disk.
+
+    At most max_pending writes are queued, submit blocks beyond that, so a slow disk slows the steps down
+    instead of growing the memory. A file appears under its final path only once it is fully written.
+    """
+
+    def __init__(self, max_workers=2, max_pending=16):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gelab-image-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+        self._lock = threading.Lock()
+        # path -> future of the write in progress, or of a failed write until it is waited on
+        self._pending = {}
+
+    def _write(self, path, encode, payload, on_written):
+        data = encode(payload) if encode is not None else payload
+        local_path = path[len("file://"):] if path.startswith("file://") else path
+        if "://" in local_path:
+            # object storage writes are atomic already
+            with smart_open(path, "wb") as f:
+                f.write(data)
+        else:
+            # write then rename, so a reader never sees a partial image
+            tmp_path = f"{local_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, local_path)
+        # before the future is done, so a wait(path) returns after it
+        if on_written is not None:
+            on_written(path)
+
+    def _on_done(self, path, future):
+        with self._lock:
+            # a failed write is kept for wait(path) to raise its error
+            if self._pending.get(path, None) is future and not future.cancelled() and future.exception() is None:
+                del self._pending[path]
+        self._slots.release()
+
+    def submit(self, path, payload, encode=None, on_written=None):
+        """
+        Queue encode(payload), or payload itself if encode is None, to be written to path.
+        on_written(path) is called once the file is complete.
+        Blocks while max_pending writes are already queued.
+        """
+        self._slots.acquire()
+        try:
+            # registered under the lock, which _on_done takes to unregister it
+            with self._lock:
+                future = self._executor.submit(self._write, path, encode, payload, on_written)
+                self._pending[path] = future
+        except BaseException:
+            self._slots.release()
+            raise
+        # outside the lock, the callback runs right away if the write is already done
+        future.add_done_callback(lambda future: self._on_done(path, future))
+        return future
+
+    def wait(self, path):
+        """
+        Wait until the write of path, if any, is done; raises the error of a failed write.
+        """
+        with self._lock:
+            future = self._pending.get(path, None)
+        if future is None:
+            return
+        try:
+            future.result()
+        finally:
+            self._forget(path, future)
+
+    def _forget(self, path, future):
+        with self._lock:
+            if self._pending.get(path, None) is future:
+                del self._pending[path]
+
+    def flush(self):
+        with self._lock:
+            pending = list(self._pending.items())
+        for path, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error writing image {path}: {e}")
+                # reported, a failed write is not reported again
+                self._forget(path, future)
+
+
+_image_writer = None
+_image_writer_lock = threading.Lock()
+
+
+def get_image_writer():
+    """
+    Get the process wide image writer, pending writes are finished at exit.
+    """
+    global _image_writer
+    with _image_writer_lock:
+        if _image_writer is None:
+            _image_writer = ImageWriterPool()
+            atexit.register(_image_writer.flush)
+        return _image_writer
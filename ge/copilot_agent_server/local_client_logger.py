@@ -2,6 +2,7 @@ import json
 import jsonlines
 
 from copilot_agent_server.base_logger import BaseLogger
+from copilot_agent_server.trace_writer import get_trace_writer, iter_jsonl
 from megfile import smart_open, smart_makedirs, smart_exists
 
 import datetime
@@ -27,9 +28,7 @@ class LocalClientLogger(BaseLogger):
             "message": message_dict
         }
 
-        with smart_open(self.log_file_path, 'a') as f:
-            writer = jsonlines.Writer(f)
-            writer.write(log_message)
+        get_trace_writer().write(self.log_file_path, log_message)
         
         if is_print:
             print(json.dumps(log_message, indent=2, ensure_ascii=False))
@@ -38,9 +37,9 @@ class LocalClientLogger(BaseLogger):
     def read_logs(self):
         logs = []
 
+        get_trace_writer().flush(self.log_file_path)
+
         assert smart_exists(self.log_file_path), f"log_dir {self.log_dir} does not exist"
-        with smart_open(self.log_file_path, "r") as f:
-            reader = jsonlines.Reader(f)
-            for obj in reader:
-                logs.append(obj)
+        for obj in iter_jsonl(self.log_file_path):
+            logs.append(obj)
         return logs
\ No newline at end of file
@@ -1,16 +1,23 @@
 import json
 import sys
 import os
+import threading
+import contextvars
 
 from copilot_agent_server.base_server import BaseCopilotServer
 
 from copilot_agent_server.local_server_logger import LocalServerLogger
+from copilot_agent_server.session_store import SessionState, get_session_store, get_log_size
+from copilot_agent_server.image_writer import get_image_writer
+from copilot_agent_server.micro_batcher import get_llm_batcher
 
-from tools.image_tools import read_from_url, make_b64_url
+from tools.image_pipeline import get_image_asset, count_image_ops
 
 from copilot_agent_server.parser_factory import get_parser
 
-from tools.ask_llm_v2 import ask_llm_anything
+from tools.ask_llm_v2 import ask_llm_anything, stream_llm_anything
+from tools.llm_providers import get_provider_registry
+from tools.llm_cache import get_response_cache
 
 from copy import deepcopy
 
@@ -38,7 +45,13 @@ class LocalServer(BaseCopilotServer):
         assert "image_dir" in server_config, "server_config must contain 'image_dir'"
 
         self.debug = server_config.get("debug", False)
-        
+
+        # parsed sessions are kept in memory across steps and server instances, see session_store.py
+        session_cache_config = server_config.get("session_cache", {})
+        self.session_store = get_session_store(
+            max_sessions=session_cache_config.get("max_sessions", 256),
+            ttl=session_cache_config.get("ttl", 3600),
+        )
 
     
     def get_session(self, payload: dict) -> str:
@@ -75,6 +88,9 @@ class LocalServer(BaseCopilotServer):
 
         logger.log_str(message_to_log, is_print=self.debug)
 
+        config = {key: message_to_log[key] for key in ["task", "task_type", "model_config", "extra_info"]}
+        self.session_store.put(logger, SessionState(config, log_size=get_log_size(logger.log_target_file)))
+
         return session_id
 
     def automate_step(self, payload: dict) -> dict:
@@ -91,12 +107,16 @@ class LocalServer(BaseCopilotServer):
             "session_id": session_id
         })
 
-        logs = logger.read_logs()
-        assert len(logs) > 0, f"No logs found for session_id {session_id}"
-        current_ste = len(logs) - 1
+        session_state = self.session_store.get(logger)
+        with session_state.lock, count_image_ops() as image_ops:
+            # the previous step may still be streaming the rest of its response
+            session_state.wait_pending_step()
+            return self._automate_step(payload, logger, session_state, image_ops)
 
-        config_log = logs[0]
-        config_dict = config_log['message']
+    def _automate_step(self, payload: dict, logger: LocalServerLogger, session_state: SessionState, image_ops: dict) -> dict:
+        current_ste = len(session_state.actions)
+
+        config_dict = session_state.config
 
 
         task_type = config_dict['task_type']
@@ -108,43 +128,31 @@ class LocalServer(BaseCopilotServer):
         observation = payload['observation']
 
         image_url = observation['screenshot']['image_url']['url']
-        image = read_from_url(image_url)
-        image_inner_url = logger.save_image(image, f"step_{current_ste+1}")
+        # written in the background, the model is asked with the in-memory image_url meanwhile
+        image_inner_url = logger.save_image_url(image_url, f"step_{current_ste+1}")
 
         query = observation.get('query', '')
 
 
-        def get_envs_acts_from_logs(logs):
-            environments = []
-            actions = []
-            for log in logs[1:]:
-                msg = log['message']
-                assert "environment" in msg, "log message must contain 'environment'"
-                assert "action" in msg, "log message must contain 'action'"
-                environments.append(msg['environment'])
-                actions.append(msg['action'])
-
-            return environments, actions
-
-        environments, actions = get_envs_acts_from_logs(logs)
-
         current_env = {
             "image": image_inner_url,
             "user_comment": query
         }
-        environments.append(current_env)
 
         
-        parser = get_parser(task_type)
+        # optional, the prompt_layout of the parsers and the history_policy of the function_call parser
+        parser = get_parser(task_type, {
+            "prompt_layout": model_config.get('prompt_layout', None),
+            "history_policy": model_config.get('history_policy', None),
+        })
 
-        messages_to_ask = parser.env2messages4ask(
-            task = task,
-            environments = environments,
-            actions = actions,
-        )
-        print(messages_to_ask)
+        # only the messages the new step changes are built, the session is only extended once the step is logged
+        prompt_builder = session_state.get_prompt_builder(parser)
+        asked_messages = prompt_builder.build(current_env)
+        kept_prefix = prompt_builder.kept_prefix
+        print(asked_messages[kept_prefix:])
 
-        asked_messages = deepcopy(messages_to_ask)
+        # the parser output is logged as it is, the model is asked with a copy holding the image URLs
 
         model_name = model_config['model_name']
         model_provider = model_config.get('model_provider', 'eval')
@@ -158,79 +166,199 @@ class LocalServer(BaseCopilotServer):
 
         image_preprocess = model_config.get('image_preprocess', None)
 
-        if image_preprocess is not None:
-            if "target_image_size" in image_preprocess:
-                target_image_size = image_preprocess["target_image_size"]
-                
-                def resize_image_in_messages(messages, target_size):
-                    for msg in messages:
-                        if type(msg['content']) == str:
-                            continue
-                        assert type(msg['content']) == list
-                        for content in msg['content']:
-                            if content['type'] == "text":
-                                continue
-                            assert content['type'] == "image_url" 
-
-                            image_url = content['image_url']['url']
-
-                            image_resize_url = make_b64_url(image_url, resize_config={
-                                "is_resize": True,
-                                "target_image_size": target_size
-                            })
-
-                            content['image_url']['url'] = image_resize_url
-                    
-                resize_image_in_messages(messages_to_ask, target_image_size)
-                print(f"Resized images to {target_image_size} for model {model_name}")
+        target_image_size = None
+        if image_preprocess is not None and "target_image_size" in image_preprocess:
+            target_image_size = image_preprocess["target_image_size"]
+
+        image_writer = get_image_writer()
+
+        def make_image_url(url):
+            if url == image_inner_url:
+                # the current screenshot may still be on its way to disk, use the received image
+                url = image_url
+            else:
+                image_writer.wait(url)
+            if target_image_size is None:
+                return url
+            # resized once per image, the history images reuse the variant of their own step
+            return get_image_asset(url).b64_url(size=target_image_size, quality=85)
+
+        # the kept prefix is sent as it was for the step before, if that step was built by the same builder
+        last_asked_messages, last_messages_to_ask = session_state.last_asked
+        reused = kept_prefix
+        if reused > len(last_asked_messages) or (reused > 0 and last_asked_messages[reused - 1] is not asked_messages[reused - 1]):
+            reused = 0
+        messages_to_ask = last_messages_to_ask[:reused]
+        for msg in asked_messages[reused:]:
+            # an assistant message with only a tool call has no content
+            if msg['content'] is None or type(msg['content']) == str:
+                messages_to_ask.append(dict(msg))
+                continue
+            assert type(msg['content']) == list
+            contents = []
+            for content in msg['content']:
+                if content['type'] == "image_url":
+                    content = dict(content, image_url=dict(content['image_url'], url=make_image_url(content['image_url']['url'])))
+                else:
+                    content = dict(content)
+                contents.append(content)
+            messages_to_ask.append(dict(msg, content=contents))
+        session_state.last_asked = (asked_messages, messages_to_ask)
+
+        if target_image_size is not None:
+            print(f"Resized images to {target_image_size} for model {model_name}")
 
         parser_tools = parser.get_tools()
         if parser_tools:
             args["tools"] = parser_tools
             args["tool_choice"] = "auto"
         
-        llm_start_time = time.time()
-        response = ask_llm_anything(
-            model_provider=model_provider,
-            model_name=model_name,
-            messages=messages_to_ask,
-            args=args
-        )
-        llm_end_time = time.time()
-       
-        #response =remove_before_think(response)
+        llm_kwargs = {
+            "model_provider": model_provider,
+            "model_name": model_name,
+            "messages": messages_to_ask,
+            "args": args,
+            # the steps of a session go to one endpoint, for the prefix cache of the inference server
+            "session_id": logger.session_id,
+            # optional, replays of recorded sessions are answered from disk
+            "response_cache": get_response_cache(model_config.get('response_cache', None)),
+        }
 
-        action = parser.str2action(response)
+        def finish_step(action, response, llm_end_time, extra_llm_cost={}, extra_log={}):
+            # Convert response to dict if it's a ChatCompletionMessage object
+            if hasattr(response, 'model_dump'):
+                response_log = response.model_dump()
+            elif hasattr(response, 'to_dict'):
+                response_log = response.to_dict()
+            else:
+                response_log = response
 
+            log_message = {
+                "environment": current_env,
+                "action": action,
 
-        # Convert response to dict if it's a ChatCompletionMessage object
-        if hasattr(response, 'model_dump'):
-            response_log = response.model_dump()
-        elif hasattr(response, 'to_dict'):
-            response_log = response.to_dict()
-        else:
-            response_log = response
+                # the messages after the prefix kept from the step before, see iter_asked_messages
+                "asked_messages_delta": {"kept_prefix": kept_prefix, "messages": asked_messages[kept_prefix:]},
+                "model_response": response_log,
+                "model_config": model_config,
 
-        log_message = {
-            "environment": current_env,
-            "action": action,
 
-            "asked_messages": asked_messages,
-            "model_response": response_log,
-            "model_config": model_config,
+                "llm_cost": {
+                    "llm_time": llm_end_time - llm_start_time,
+                    "llm_start_time": llm_start_time,
+                    "llm_end_time": llm_end_time,
+                    **extra_llm_cost
+                },
 
+                # decodes / encodes / resizes of the screenshots in this step
+                "image_ops": dict(image_ops),
+                **extra_log
+            }
 
-            "llm_cost": {
-                "llm_time": llm_end_time - llm_start_time,
-                "llm_start_time": llm_start_time,
-                "llm_end_time": llm_end_time
-            },
-        }
+            logger.log_str(log_message, is_print=self.debug)
 
-        logger.log_str(log_message, is_print=self.debug)
+            # the same round trip as the trace, so the cached step equals a step rebuilt from disk,
+            # and the caller may modify the returned action freely
+            session_state.append_step(current_env, json.loads(json.dumps(action, ensure_ascii=False)))
+            session_state.log_size = get_log_size(logger.log_target_file)
+
+        llm_start_time = time.time()
 
+        if not model_config.get('stream', False):
+            # optional, the requests of concurrent sessions are sent in one submission to a provider with a batch API,
+            # otherwise a slow request is optionally duplicated to another endpoint, see HedgePolicy
+            batching_config = model_config.get('micro_batching', None)
+            completion_fn = None
+            if batching_config is not None and batching_config.get("enabled", True) and \
+                    get_provider_registry().get_provider_settings(model_provider).get("batch_api_path", None) is not None:
+                completion_fn = get_llm_batcher(model_provider, batching_config).submit
+            call_stats = {}
+            response = ask_llm_anything(**llm_kwargs, hedge_config=model_config.get('hedging', None), call_stats=call_stats,
+                completion_fn=completion_fn)
+            llm_end_time = time.time()
+
+            #response =remove_before_think(response)
+
+            action = parser.str2action(response)
+            extra_llm_cost = {}
+            if "response_cache" in call_stats:
+                extra_llm_cost["response_cache"] = call_stats.pop("response_cache")
+            if call_stats:
+                extra_llm_cost["hedging"] = call_stats
+            finish_step(action, response, llm_end_time, extra_llm_cost=extra_llm_cost)
+
+            return {
+                "action": action,
+                "current_step": current_ste + 1
+            }
+
+        # streamed: the action is returned as soon as the parser finds it complete, the rest of the response
+        # (e.g. the summary) is received, logged and added to the session in the background
+        stream_parser = parser.make_stream_parser()
+        action_ready = threading.Event()
+        stream_result = {}
+
+        def on_delta(delta):
+            if stream_parser is None or action_ready.is_set():
+                return
+            early_action = stream_parser.feed(delta)
+            if early_action is not None:
+                stream_result['dispatched_action'] = deepcopy(early_action)
+                stream_result['action'] = early_action
+                stream_result['time_to_action'] = time.time() - llm_start_time
+                action_ready.set()
+
+        def stream_runner():
+            try:
+                response = stream_llm_anything(**llm_kwargs, on_delta=on_delta, call_stats=stream_result.setdefault('call_stats', {}))
+                llm_end_time = time.time()
+                action = parser.str2action(response)
+            except Exception as e:
+                if not action_ready.is_set():
+                    stream_result['error'] = e
+                    action_ready.set()
+                    return
+                # the action is executed already, the step is logged with it
+                print(f"Error streaming the rest of step {current_ste + 1} of session {logger.session_id}: {e}")
+                finish_step(stream_result['dispatched_action'], None, time.time(),
+                    extra_llm_cost={"time_to_action": stream_result['time_to_action']},
+                    extra_log={"stream_error": str(e)})
+                return
+
+            extra_log = {}
+            if not action_ready.is_set():
+                # the parser did not find the action before the end of the response
+                stream_result['action'] = action
+                stream_result['time_to_action'] = llm_end_time - llm_start_time
+                action_ready.set()
+            else:
+                # the history records the action that ran on the device, with the summary of the full response
+                executed_action = deepcopy(stream_result['dispatched_action'])
+                executed_action.pop("summary", None)
+                if {k: v for k, v in action.items() if k != "summary"} != executed_action:
+                    print(f"Streamed action {executed_action} differs from the parsed action {action}")
+                    extra_log["parsed_action"] = action
+                if "summary" in action:
+                    executed_action["summary"] = action["summary"]
+                action = executed_action
+
+            finish_step(action, response, llm_end_time,
+                extra_llm_cost={"time_to_action": stream_result['time_to_action'], **stream_result['call_stats']}, extra_log=extra_log)
+
+        # not a daemon, the last step of a session is still logged when the process is exiting;
+        # the copied context keeps counting the image operations of this step
+        stream_thread = threading.Thread(target=contextvars.copy_context().run, args=(stream_runner,))
+        session_state.pending_step = stream_thread
+        stream_thread.start()
+
+        action_ready.wait()
+        if 'error' in stream_result:
+            stream_thread.join()
+            raise stream_result['error']
+
+        print(f"Action of step {current_ste + 1} ready after {stream_result['time_to_action']:.2f}s")
         return {
-            "action": action,
+            "action": stream_result['action'],
             "current_step": current_ste + 1
         }
         
@@ -2,6 +2,9 @@ import json
 import jsonlines
 
 from copilot_agent_server.base_logger import BaseLogger
+from copilot_agent_server.trace_writer import get_trace_writer, iter_jsonl
+from copilot_agent_server.image_writer import get_image_writer
+from tools.image_pipeline import get_image_asset, get_image_asset_registry
 from megfile import smart_open, smart_makedirs, smart_exists
 
 import datetime
@@ -48,15 +51,20 @@ class LocalServerLogger(BaseLogger):
         pass
 
     def read_logs(self):
+        return [obj for obj in self.iter_logs()]
+
+    def iter_logs(self):
+        """
+        Yield the log records one by one, so the caller can drop the fields it does not need right away.
+        """
+        # records of this process still buffered in the trace writer are written first
+        get_trace_writer().flush(self.log_target_file)
+
         if not smart_exists(self.log_target_file):
-            return []
-        
-        # with smart_open(self.log_target_file, 'r') as f:
-        with smart_open(self.log_target_file, 'r',encoding='utf-8') as f:
-            reader = jsonlines.Reader(f)
-            logs = [obj for obj in reader]
-        
-        return logs
+            return
+
+        for obj in iter_jsonl(self.log_target_file):
+            yield obj
 
     def log_str(self, message_dict, is_print: bool = False):
         
@@ -66,10 +74,7 @@ class LocalServerLogger(BaseLogger):
             "message": message_dict
         }
 
-        # with smart_open(self.log_target_file, 'a') as f:
-        with smart_open(self.log_target_file, 'a',encoding='utf-8') as f:
-            writer = jsonlines.Writer(f)
-            writer.write(log_message)
+        get_trace_writer().write(self.log_target_file, log_message)
         
         if is_print:
             print(json.dumps(log_message, indent=2, ensure_ascii=False))
@@ -93,3 +98,20 @@ class LocalServerLogger(BaseLogger):
 
         return image_path
 
+    def save_image_url(self, image_url: str, image_name: str) -> str:
+        """
+        Save the image behind a base64 data URL or a file path in the background, as JPEG.
+        JPEG payloads are stored as they are, other formats are re-encoded off the calling thread.
+        Returns the path right away, get_image_writer().wait(path) blocks until the file is written.
+        """
+        assert isinstance(image_name, str) and len(image_name) > 0, "image_name must be a non-empty string"
+
+        image_path = f"{self.image_dir}/{self.session_id}_{image_name}.jpeg"
+        asset = get_image_asset(image_url)
+        # later steps refer to the image by its path, they get the in-memory asset and its variants back
+        # once the file is written, as long as it is not written again
+        get_image_writer().submit(image_path, asset, encode=lambda asset: asset.jpeg(),
+                                  on_written=lambda path: get_image_asset_registry().register_path(path, asset))
+
+        return image_path
+
@@ -0,0 +1,210 @@
+import sys
+import time
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+
+class MicroBatcher:
+    """
+    Collects the requests submitted from many threads within window seconds, up to max_batch_size, and runs them
+    with one batch_fn(requests) -> results call, whose results are handed back to each caller in order.
+
+    A batch that fails as a whole falls back to single_fn(request) for each of its requests in parallel, if given,
+    and the requests of the next fallback_cooldown seconds go to single_fn right away, without waiting for a window.
+    Batches run in their own threads, so the next batch is collected while the previous one is in flight.
+
+    Only the requests of one process are batched: the devices of a rollout must run as threads of one process,
+    see the worker_mode of CopilotClientRolloutRunner.
+    """
+
+    def __init__(self, batch_fn, single_fn=None, window=0.02, max_batch_size=16, max_inflight_batches=4,
+                 fallback_cooldown=30.0):
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.batch_fn = batch_fn
+        self.single_fn = single_fn
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.fallback_cooldown = fallback_cooldown
+
+        self._condition = threading.Condition()
+        # (request, future) of the batch being collected
+        self._pending = []
+        self._batch_started_at = None
+        self._collector = None
+        self._batching_disabled_until = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight_batches, thread_name_prefix="gelab-micro-batch")
+        # the single requests of the failed batches
+        self._fallback_executor = ThreadPoolExecutor(max_workers=max_batch_size * max_inflight_batches,
+            thread_name_prefix="gelab-micro-batch-fallback")
+
+        self.requests = 0
+        self.batches = 0
+        self.fallbacks = 0
+        self.single_requests = 0
+
+    def _ensure_collector(self):
+        if self._collector is None:
+            self._collector = threading.Thread(target=self._collect_runner, daemon=True)
+            self._collector.start()
+
+    def _collect_runner(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+                # wait for the window of the oldest request, or a full batch
+                while len(self._pending) < self.max_batch_size:
+                    remaining = self._batch_started_at + self.window - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                self._pending = self._pending[self.max_batch_size:]
+                self._batch_started_at = time.time() if len(self._pending) > 0 else None
+                self.batches += 1
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        requests = [request for request, future in batch]
+        try:
+            results = self.batch_fn(requests)
+            assert len(results) == len(requests), f"batch of {len(requests)} requests got {len(results)} results"
+        except Exception as e:
+            if self.single_fn is None:
+                for request, future in batch:
+                    future.set_exception(e)
+                return
+            print(f"Batch of {len(requests)} requests failed, sending them as single requests "
+                  f"for the next {self.fallback_cooldown}s: {e}")
+            with self._condition:
+                self.fallbacks += 1
+                self._batching_disabled_until = time.time() + self.fallback_cooldown
+            for request, future in batch:
+                self._fallback_executor.submit(self._run_single, request, future)
+            return
+
+        for (request, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run_single(self, request, future):
+        try:
+            future.set_result(self.single_fn(request))
+        except Exception as e:
+            future.set_exception(e)
+
+    def submit(self, request, timeout=None):
+        """
+        Submit one request and block until its result, from its batch or from the fallback.
+        """
+        future = Future()
+        with self._condition:
+            bypass = self.single_fn is not None and time.time() < self._batching_disabled_until
+            self.requests += 1
+            if bypass:
+                self.single_requests += 1
+        if bypass:
+            return self.single_fn(request)
+
+        with self._condition:
+            self._ensure_collector()
+            if len(self._pending) == 0:
+                self._batch_started_at = time.time()
+            self._pending.append((request, future))
+            self._condition.notify()
+        return future.result(timeout=timeout)
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "mean_batch_size": (self.requests - self.single_requests) / self.batches if self.batches > 0 else 0.0,
+                "fallbacks": self.fallbacks,
+                "single_requests": self.single_requests,
+            }
+
+
+_llm_batchers = {}
+_llm_batchers_lock = threading.Lock()
+
+
+def get_llm_batcher(model_provider, batching_config):
+    """
+    Get the batcher of the chat completions sent to a provider, shared by all sessions of the process.
+    Requests for different models may share a batch, the batch endpoint gets the model of each request.
+    """
+    from tools.ask_llm_v2 import ask_llm_batch
+    from tools.llm_providers import get_llm_balancer
+
+    window = batching_config.get("window", 0.02)
+    max_batch_size = batching_config.get("max_batch_size", 16)
+    fallback_cooldown = batching_config.get("fallback_cooldown", 30.0)
+    key = (model_provider, window, max_batch_size, fallback_cooldown)
+    with _llm_batchers_lock:
+        if key not in _llm_batchers:
+            def single_fn(kwargs):
+                return get_llm_balancer(model_provider).call(lambda client: client.chat.completions.create(**kwargs))
+
+            _llm_batchers[key] = MicroBatcher(
+                batch_fn=lambda kwargs_list: ask_llm_batch(model_provider, kwargs_list),
+                single_fn=single_fn,
+                window=window,
+                max_batch_size=max_batch_size,
+                fallback_cooldown=fallback_cooldown,
+            )
+        return _llm_batchers[key]
+
+
+if __name__ == "__main__":
+    # python copilot_agent_server/micro_batcher.py [devices]
+    # a mock backend running one submission at a time, 30ms per submission plus 2ms per request in it,
+    # as an inference server that batches on its own, driven by one thread per device
+    from concurrent.futures import ThreadPoolExecutor as DeviceExecutor
+
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    steps = 10
+    backend_lock = threading.Lock()
+
+    def mock_batch_fn(requests):
+        with backend_lock:
+            time.sleep(0.03 + 0.002 * len(requests))
+        return [f"result of {request}" for request in requests]
+
+    def mock_single_fn(request):
+        return mock_batch_fn([request])[0]
+
+    def run(ask):
+        def device_runner(device_idx):
+            for step_idx in range(steps):
+                request = f"device {device_idx} step {step_idx}"
+                assert ask(request) == f"result of {request}"
+
+        start_time = time.time()
+        with DeviceExecutor(max_workers=devices) as executor:
+            list(executor.map(device_runner, range(devices)))
+        return devices * steps / (time.time() - start_time)
+
+    single_throughput = run(mock_single_fn)
+    batcher = MicroBatcher(mock_batch_fn, mock_single_fn, window=0.02, max_batch_size=16)
+    batched_throughput = run(batcher.submit)
+    print(f"{devices} devices: one request per submission {single_throughput:.1f} req/s, "
+          f"micro-batched {batched_throughput:.1f} req/s, {batcher.get_stats()}")
+
+    # a backend without batch support falls back to single requests, sent in parallel
+    def failing_batch_fn(requests):
+        raise RuntimeError("batch submission not supported")
+
+    def concurrent_single_fn(request):
+        time.sleep(0.05)
+        return f"result of {request}"
+
+    batcher = MicroBatcher(failing_batch_fn, concurrent_single_fn, window=0.02, max_batch_size=16)
+    start_time = time.time()
+    with DeviceExecutor(max_workers=16) as executor:
+        results = list(executor.map(batcher.submit, [f"request {i}" for i in range(16)]))
+    assert results == [f"result of request {i}" for i in range(16)]
+    print(f"fallback of a batch of 16 requests of 50ms: {1000 * (time.time() - start_time):.0f}ms, {batcher.get_stats()}")
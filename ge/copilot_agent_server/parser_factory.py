@@ -1,8 +1,15 @@
+import sys
+
+if "." not in sys.path:
+    sys.path.append(".")
+
 from copilot_tools.parser_0920_summary import Parser0920Summary
 from copilot_tools.function_call_parser import FunctionCallParser
 
-def get_parser(parser_name):
-    
+def get_parser(parser_name, parser_config=None):
+    """
+    parser_config, e.g. the "history_policy" of FunctionCallParser, is passed to the parsers that take one.
+    """
     parser_name_map = {
         "parser_0922_summary": Parser0920Summary,
         "parser_0920":Parser0920Summary,
@@ -10,7 +17,82 @@ def get_parser(parser_name):
     }
 
     if parser_name in parser_name_map:
-        return parser_name_map[parser_name]()
+        return parser_name_map[parser_name](parser_config)
     else:
         raise ValueError(f"Unknown parser name: {parser_name}")
 
+
+if __name__ == "__main__":
+    # python copilot_agent_server/parser_factory.py
+    # the share of the prompt of a step an inference server with prefix caching reuses from the step before,
+    # in each prompt_layout; the cache_friendly one must keep every message but the newest turn byte-identical
+    import json
+
+    from copilot_tools.history_policy import estimate_tokens, estimate_text_tokens
+
+    def prefix_tokens(previous_messages, messages):
+        """
+        The estimated tokens of the longest common prefix of two prompts, and the leading messages equal as a whole.
+        """
+        for idx, (previous_msg, msg) in enumerate(zip(previous_messages, messages)):
+            if json.dumps(previous_msg, sort_keys=True) == json.dumps(msg, sort_keys=True):
+                continue
+            tokens = estimate_tokens(messages[:idx])
+            if previous_msg["role"] != msg["role"] or type(msg["content"]) != list or type(previous_msg["content"]) != list:
+                return tokens, idx
+            for previous_item, item in zip(previous_msg["content"], msg["content"]):
+                if previous_item == item:
+                    tokens += estimate_tokens([{"role": "user", "content": [item]}]) - 4
+                    continue
+                if previous_item["type"] == "text" and item["type"] == "text":
+                    common = 0
+                    while common < min(len(previous_item["text"]), len(item["text"])) and previous_item["text"][common] == item["text"][common]:
+                        common += 1
+                    tokens += estimate_text_tokens(item["text"][:common])
+                break
+            return tokens, idx
+        idx = min(len(previous_messages), len(messages))
+        return estimate_tokens(messages[:idx]), idx
+
+    def run_session(parser, task, steps=40):
+        prompt_builder = parser.make_prompt_builder(task)
+        environments, actions = [], []
+        previous, reused_tokens, total_tokens = None, 0, 0
+        for step_idx in range(steps):
+            # the user answers the INFO actions and sometimes comments on their own
+            user_comment = "the blue one" if step_idx % 7 == 1 else ("skip the ads" if step_idx % 11 == 5 else "")
+            current_env = {"image": f"images/step_{step_idx + 1}.jpeg", "user_comment": user_comment}
+            messages = prompt_builder.build(current_env)
+            assert json.dumps(messages) == json.dumps(parser.env2messages4ask(task, environments + [current_env], actions))
+
+            if previous is not None:
+                tokens, equal_messages = prefix_tokens(previous, messages)
+                if parser.prompt_layout == "cache_friendly":
+                    assert equal_messages >= len(previous) - 1, f"step {step_idx + 1} changed message {equal_messages} of {len(previous)}"
+                reused_tokens += tokens
+                total_tokens += estimate_tokens(messages)
+            # a copy, so a builder changing a message in place is caught
+            previous = json.loads(json.dumps(messages))
+
+            action_type = "INFO" if step_idx % 7 == 0 else "CLICK"
+            action = {"action_type": action_type, "action": action_type, "explain": f"step {step_idx + 1}",
+                      "cot": "the item is in the middle of the screen", "summary": f"done {step_idx + 1} steps"}
+            if action_type == "INFO":
+                action["value"] = "which one?"
+            else:
+                action["point"] = [500, 500]
+            environments.append(current_env)
+            actions.append(action)
+            prompt_builder.append(current_env, action)
+        return messages, total_tokens / (steps - 1), (total_tokens - reused_tokens) / (steps - 1)
+
+    for parser_name in ["parser_0920", "function_call"]:
+        for prompt_layout in ["default", "cache_friendly"]:
+            parser = get_parser(parser_name, {"prompt_layout": prompt_layout})
+            messages, prompt_tokens, new_tokens = run_session(parser, "open the settings and turn on the dark mode")
+            other_messages, _, _ = run_session(parser, "send a message to Alice")
+            if prompt_layout == "cache_friendly":
+                assert json.dumps(messages[0]) == json.dumps(other_messages[0]), "the system message differs across sessions"
+            print(f"{parser_name}, {prompt_layout}: {prompt_tokens:.0f} estimated prompt tokens per step, "
+                  f"{new_tokens:.0f} of them not in the prompt of the step before")
+
@@ -0,0 +1,195 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+from megfile import smart_exists, smart_stat
+
+from copilot_agent_server.trace_writer import get_trace_writer
+
+
+class SessionState:
+    """
+    The parsed state of one session: the session_start config, and the environment and action of every step.
+    The asked messages and model responses stay on disk only; the prompt builder of the parser keeps what the
+    next step's messages reuse.
+    """
+
+    def __init__(self, config, environments=None, actions=None, log_size=0):
+        self.config = config
+        self.environments = environments if environments is not None else []
+        self.actions = actions if actions is not None else []
+
+        # the size of the trace file this state reflects, a different size means another process appended to it
+        self.log_size = log_size
+
+        # held for a whole step, so the steps of one session never interleave
+        self.lock = threading.Lock()
+        # the thread finishing a streamed step after its action was returned
+        self.pending_step = None
+
+        # built on the first step served by this process, see get_prompt_builder
+        self.prompt_builder = None
+        # (asked messages, messages sent to the model) of the last step, the kept prefix of the next step is reused
+        self.last_asked = ([], [])
+
+    def append_step(self, environment, action):
+        self.environments.append(environment)
+        self.actions.append(action)
+        if self.prompt_builder is not None:
+            self.prompt_builder.append(environment, action)
+
+    def get_prompt_builder(self, parser):
+        """
+        The prompt builder of the session, fed with the steps so far when it is made.
+        """
+        if self.prompt_builder is None:
+            prompt_builder = parser.make_prompt_builder(self.config['task'])
+            for environment, action in zip(self.environments, self.actions):
+                prompt_builder.append(environment, action)
+            self.prompt_builder = prompt_builder
+        return self.prompt_builder
+
+    def wait_pending_step(self):
+        """
+        Wait until a streamed step is logged and appended, the next step needs its summary.
+        """
+        if self.pending_step is not None:
+            self.pending_step.join()
+            self.pending_step = None
+
+
+def get_log_size(log_file):
+    # the size on disk only counts once the records of this process are written
+    get_trace_writer().flush(log_file)
+    if not smart_exists(log_file):
+        return 0
+    return smart_stat(log_file).size
+
+
+def load_session_state(logger):
+    """
+    Rebuild the state of a session from its trace, reading one record at a time and keeping only the needed fields.
+    """
+    log_size = get_log_size(logger.log_target_file)
+
+    config = None
+    environments, actions = [], []
+    for log in logger.iter_logs():
+        message = log['message']
+        if config is None:
+            config = {
+                "task": message['task'],
+                "task_type": message['task_type'],
+                "model_config": message['model_config'],
+                "extra_info": message.get('extra_info', {}),
+            }
+            continue
+
+        assert "environment" in message, "log message must contain 'environment'"
+        assert "action" in message, "log message must contain 'action'"
+        environments.append(message['environment'])
+        actions.append(message['action'])
+
+    assert config is not None, f"No logs found for session_id {logger.session_id}"
+    return SessionState(config, environments, actions, log_size)
+
+
+def iter_asked_messages(logger):
+    """
+    The messages asked at each step of a session; a step logs either all of them, or the messages after
+    the prefix it kept from the step before, see PromptBuilder.
+    """
+    asked_messages = []
+    for log in logger.iter_logs():
+        message = log['message']
+        if "asked_messages" in message:
+            asked_messages = message['asked_messages']
+        elif "asked_messages_delta" in message:
+            delta = message['asked_messages_delta']
+            asked_messages = asked_messages[:delta['kept_prefix']] + delta['messages']
+        else:
+            continue
+        yield asked_messages
+
+
+class SessionStore:
+    """
+    In-process LRU cache of SessionState, so a step does not re-read the whole trace of its session.
+    Sessions idle for longer than ttl seconds, or beyond max_sessions, are evicted and rebuilt from disk on demand.
+    """
+
+    def __init__(self, max_sessions=256, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # (log_file) -> (state, last_access_time)
+        self._sessions = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        now = time.time()
+        while len(self._sessions) > 0:
+            log_file, (state, last_access_time) = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_sessions or now - last_access_time > self.ttl:
+                self._sessions.popitem(last=False)
+            else:
+                break
+
+    def put(self, logger, state):
+        with self._lock:
+            self._sessions[logger.log_target_file] = (state, time.time())
+            self._sessions.move_to_end(logger.log_target_file)
+            self._evict()
+
+    def get(self, logger):
+        """
+        Get the state of the session logged by logger, rebuilt from disk if it is not cached or is stale.
+        """
+        log_file = logger.log_target_file
+        with self._lock:
+            entry = self._sessions.get(log_file, None)
+
+        if entry is not None and entry[0].log_size == get_log_size(log_file):
+            state = entry[0]
+            with self._lock:
+                self.hits += 1
+                self._sessions[log_file] = (state, time.time())
+                self._sessions.move_to_end(log_file)
+            return state
+
+        state = load_session_state(logger)
+        with self._lock:
+            self.misses += 1
+        self.put(logger, state)
+        return state
+
+    def drop(self, logger):
+        with self._lock:
+            self._sessions.pop(logger.log_target_file, None)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store(max_sessions=256, ttl=3600):
+    """
+    Get the process wide session store, shared by all LocalServer instances; the arguments apply on first use only.
+    """
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = SessionStore(max_sessions=max_sessions, ttl=ttl)
+        return _session_store
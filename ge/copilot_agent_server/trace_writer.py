@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import atexit
+import signal
+import threading
+
+from collections import OrderedDict
+
+from megfile import smart_open, smart_makedirs, smart_exists
+
+
+class TraceWriter:
+    """
+    Append-only JSONL writer that keeps one open handle per target file and commits records in groups.
+
+    Records are buffered per target as complete lines, and a group is written with a single write call when
+    it reaches max_batch_records or max_batch_bytes, when the background flusher runs (every flush_interval
+    seconds), or when flush is called, optionally with fsync. A reader therefore only ever sees whole records,
+    except for the trailing line of a write in progress, which iter_jsonl skips.
+    """
+
+    def __init__(self, max_batch_records=64, max_batch_bytes=1 << 20, flush_interval=1.0, max_open_files=64):
+        self.max_batch_records = max_batch_records
+        self.max_batch_bytes = max_batch_bytes
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+
+        self._lock = threading.RLock()
+        # path -> list of serialized lines
+        self._buffers = {}
+        self._buffer_bytes = {}
+        # path -> open handle, least recently used first
+        self._handles = OrderedDict()
+
+        self._pid = os.getpid()
+        self._flusher = None
+        self._stop_event = threading.Event()
+
+        self.records_written = 0
+        self.write_calls = 0
+
+    def _after_fork_in_child(self):
+        # another thread of the parent may have held the lock while forking,
+        # the buffers and handles belong to the parent, and the flusher thread is gone
+        self._lock = threading.RLock()
+        self._buffers, self._buffer_bytes, self._handles = {}, {}, OrderedDict()
+        self._pid = os.getpid()
+        self._flusher = None
+
+    def _ensure_flusher(self):
+        if self._pid != os.getpid():
+            # forked, the buffers and handles belong to the parent process
+            self._buffers, self._buffer_bytes, self._handles = {}, {}, OrderedDict()
+            self._pid = os.getpid()
+            self._flusher = None
+        if self._flusher is None and self.flush_interval is not None:
+            self._stop_event.clear()
+            self._flusher = threading.Thread(target=self._flush_runner, daemon=True)
+            self._flusher.start()
+
+    def _flush_runner(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing traces: {e}")
+
+    def _get_handle(self, path):
+        handle = self._handles.get(path, None)
+        if handle is not None:
+            self._handles.move_to_end(path)
+            return handle
+
+        log_dir = os.path.dirname(path)
+        if log_dir and not smart_exists(log_dir):
+            smart_makedirs(log_dir, exist_ok=True)
+        handle = smart_open(path, "a", encoding="utf-8")
+        self._handles[path] = handle
+
+        while len(self._handles) > self.max_open_files:
+            _, old_handle = self._handles.popitem(last=False)
+            old_handle.close()
+        return handle
+
+    def write(self, path, record, fsync=False):
+        """
+        Queue one record for the target file. With fsync, the target is flushed and synced to disk before returning.
+        """
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._ensure_flusher()
+            self._buffers.setdefault(path, []).append(line)
+            self._buffer_bytes[path] = self._buffer_bytes.get(path, 0) + len(line)
+
+            if fsync or len(self._buffers[path]) >= self.max_batch_records or self._buffer_bytes[path] >= self.max_batch_bytes:
+                self._flush_path(path, fsync=fsync)
+
+    def _flush_path(self, path, fsync=False):
+        lines = self._buffers.pop(path, None)
+        self._buffer_bytes.pop(path, None)
+        if lines:
+            handle = self._get_handle(path)
+            handle.write("".join(lines))
+            handle.flush()
+            self.records_written += len(lines)
+            self.write_calls += 1
+        if fsync and path in self._handles:
+            handle = self._handles[path]
+            if hasattr(handle, "fileno"):
+                os.fsync(handle.fileno())
+
+    def flush(self, path=None, fsync=False):
+        """
+        Write the buffered records of one target, or of all targets if path is None.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._ensure_flusher()
+            paths = [path] if path is not None else list(self._buffers.keys())
+            for target in paths:
+                self._flush_path(target, fsync=fsync)
+
+    def close(self, path=None):
+        """
+        Flush, sync and close one target, or all of them if path is None.
+        """
+        with self._lock:
+            paths = [path] if path is not None else list(set(self._buffers.keys()) | set(self._handles.keys()))
+            for target in paths:
+                self._flush_path(target, fsync=True)
+                handle = self._handles.pop(target, None)
+                if handle is not None:
+                    handle.close()
+            if path is None:
+                self._stop_event.set()
+                self._flusher = None
+
+
+def iter_jsonl(path):
+    """
+    Yield the records of a JSONL file written by TraceWriter, skipping a trailing line whose write is still in progress.
+    """
+    with smart_open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # torn, the rest of the record is not written yet
+                break
+            if line.strip() == "":
+                continue
+            yield json.loads(line)
+
+
+_trace_writer = None
+_trace_writer_lock = threading.Lock()
+
+
+def get_trace_writer():
+    """
+    Get the process wide trace writer, closed at exit and on SIGTERM / SIGHUP.
+    """
+    global _trace_writer
+    with _trace_writer_lock:
+        if _trace_writer is None:
+            _trace_writer = TraceWriter()
+            atexit.register(_trace_writer.close)
+            _install_signal_handlers()
+            if hasattr(os, "register_at_fork"):
+                # flush before forking, so a child never inherits records the parent has not written yet
+                os.register_at_fork(before=_trace_writer.flush, after_in_child=_trace_writer._after_fork_in_child)
+        return _trace_writer
+
+
+def _install_signal_handlers():
+    for signal_name in ["SIGTERM", "SIGHUP"]:
+        if not hasattr(signal, signal_name):
+            continue
+        signum = getattr(signal, signal_name)
+        try:
+            previous_handler = signal.getsignal(signum)
+
+            def handler(signum, frame, previous_handler=previous_handler):
+                _trace_writer.close()
+                if previous_handler == signal.SIG_IGN:
+                    return
+                if callable(previous_handler):
+                    previous_handler(signum, frame)
+                else:
+                    # the default action of both signals is to terminate, exit so atexit handlers still run
+                    raise SystemExit(128 + signum)
+
+            signal.signal(signum, handler)
+        except ValueError:
+            # not the main thread, rely on atexit
+            pass
+
+
+if __name__ == "__main__":
+    # python copilot_agent_server/trace_writer.py [records]
+    # compares reopening the file for every record, as before, with the group-committed writer
+    import sys
+    import tempfile
+    import jsonlines
+
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    record = {"session_id": "bench", "message": {"action": {"action_type": "CLICK", "point": [500, 500]}, "text": "x" * 512}}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = f"{tmp_dir}/reopen.jsonl"
+        start_time = time.perf_counter()
+        for _ in range(records):
+            with smart_open(path, "a", encoding="utf-8") as f:
+                jsonlines.Writer(f).write(record)
+        reopen_time = time.perf_counter() - start_time
+
+        writer = TraceWriter()
+        path = f"{tmp_dir}/grouped.jsonl"
+        start_time = time.perf_counter()
+        for _ in range(records):
+            writer.write(path, record)
+        writer.close()
+        grouped_time = time.perf_counter() - start_time
+
+        assert len(list(iter_jsonl(path))) == records
+
+        # a torn trailing line is skipped, not parsed
+        with open(path, "a") as f:
+            f.write('{"session_id": "torn"')
+        assert len(list(iter_jsonl(path))) == records
+
+    print(f"{records} records: reopen per record {1e6 * reopen_time / records:.1f}us/record, "
+          f"group commit {1e6 * grouped_time / records:.1f}us/record, {writer.write_calls} write calls")
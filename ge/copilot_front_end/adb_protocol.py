@@ -0,0 +1,474 @@
+import os
+import sys
+import time
+import queue
+import socket
+import struct
+import threading
+import subprocess
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+# shell protocol v2 packet ids
+_SHELL_ID_STDIN = 0
+_SHELL_ID_STDOUT = 1
+_SHELL_ID_STDERR = 2
+_SHELL_ID_EXIT = 3
+_SHELL_ID_CLOSE_STDIN = 4
+
+_SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbProtocolError(RuntimeError):
+    pass
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise AdbProtocolError("Connection closed by the adb server")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(256 * 1024)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+class AdbServerClient:
+    """
+    A client of the adb server host protocol (TCP 5037 by default), so no `adb` process is spawned per command.
+
+    Every service (shell:, exec:, sync:) consumes its connection, so the client keeps a small pool of
+    connections per device that already switched to the device transport, and refills it in the background.
+    """
+
+    def __init__(self, host=None, port=None, timeout=30, pool_size=2):
+        self.host = host or os.environ.get("ADB_SERVER_HOST", "127.0.0.1")
+        self.port = int(port or os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self._pool_lock = threading.Lock()
+        self._transport_pool = {}
+        self._features = {}
+
+        self._refill_queue = queue.Queue()
+        threading.Thread(target=self._refill_runner, daemon=True).start()
+
+    # ---------------------------------------------------------------- low level
+
+    def _connect(self, timeout=None):
+        sock = socket.create_connection((self.host, self.port), timeout=timeout or self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _send_request(self, sock, request):
+        payload = request.encode("utf-8")
+        sock.sendall(b"%04x" % len(payload) + payload)
+        self._read_status(sock, request)
+
+    def _read_status(self, sock, request):
+        status = _recv_exactly(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            length = int(_recv_exactly(sock, 4), 16)
+            message = _recv_exactly(sock, length).decode("utf-8", errors="replace")
+            raise AdbProtocolError(f"adb server refused {request}: {message}")
+        raise AdbProtocolError(f"Unexpected adb server status {status} for {request}")
+
+    def _read_length_prefixed(self, sock):
+        length = int(_recv_exactly(sock, 4), 16)
+        return _recv_exactly(sock, length).decode("utf-8", errors="replace")
+
+    def host_request(self, request):
+        """
+        Run a host service (e.g. host:devices, host:version) and return its length prefixed reply.
+        """
+        sock = self._connect()
+        try:
+            self._send_request(sock, request)
+            return self._read_length_prefixed(sock)
+        finally:
+            sock.close()
+
+    # ---------------------------------------------------------------- transports
+
+    def _open_transport(self, device_id, timeout=None):
+        sock = self._connect(timeout)
+        try:
+            self._send_request(sock, "host:transport-any" if device_id is None else f"host:transport:{device_id}")
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _refill_runner(self):
+        while True:
+            device_id = self._refill_queue.get()
+            with self._pool_lock:
+                missing = self.pool_size - len(self._transport_pool.get(device_id, []))
+            for _ in range(missing):
+                try:
+                    sock = self._open_transport(device_id)
+                except Exception:
+                    # the device is gone or the server is down, the next command opens its own transport
+                    break
+                with self._pool_lock:
+                    self._transport_pool.setdefault(device_id, []).append(sock)
+
+    def _take_transport(self, device_id, timeout=None):
+        """
+        Take a connection switched to the device transport, from the pool if possible.
+        :return: (socket, is_pooled)
+        """
+        with self._pool_lock:
+            pool = self._transport_pool.get(device_id, [])
+            sock = pool.pop() if pool else None
+        if self.pool_size > 0:
+            self._refill_queue.put(device_id)
+        if sock is not None:
+            return sock, True
+        return self._open_transport(device_id, timeout), False
+
+    def _open_service(self, device_id, service, timeout=None):
+        """
+        Open a device service on a transport connection, retrying once on a fresh connection
+        if a pooled one turned out to be stale (e.g. the device reconnected).
+        """
+        sock, is_pooled = self._take_transport(device_id, timeout)
+        try:
+            sock.settimeout(timeout or self.timeout)
+            self._send_request(sock, service)
+            return sock
+        except (OSError, AdbProtocolError):
+            sock.close()
+            if not is_pooled:
+                raise
+
+        sock = self._open_transport(device_id, timeout)
+        try:
+            sock.settimeout(timeout or self.timeout)
+            self._send_request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def close(self):
+        with self._pool_lock:
+            pools = list(self._transport_pool.values())
+            self._transport_pool = {}
+        for pool in pools:
+            for sock in pool:
+                sock.close()
+
+    # ---------------------------------------------------------------- device services
+
+    def features(self, device_id):
+        """
+        Get the feature list of the device, e.g. shell_v2, cached per device.
+        """
+        if device_id not in self._features:
+            request = "host:features" if device_id is None else f"host-serial:{device_id}:features"
+            self._features[device_id] = self.host_request(request).split(",")
+        return self._features[device_id]
+
+    def list_devices(self):
+        """
+        List the online devices with host:devices.
+        """
+        devices = []
+        for line in self.host_request("host:devices").splitlines():
+            parts = line.split()
+            if len(parts) >= 2 and parts[1] == "device":
+                devices.append(parts[0])
+        return devices
+
+    def shell(self, device_id, command, timeout=None):
+        """
+        Run a shell command on the device and return a subprocess.CompletedProcess.
+        :raises subprocess.TimeoutExpired: if connecting, opening the service or reading takes longer than timeout.
+        """
+        args = f"adb shell {command}" if device_id is None else f"adb -s {device_id} shell {command}"
+        try:
+            if "shell_v2" in self.features(device_id):
+                return_code, stdout, stderr = self._shell_v2(device_id, command, timeout)
+            else:
+                return_code, stdout, stderr = self._shell_legacy(device_id, command, timeout)
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(args, timeout or self.timeout)
+
+        return subprocess.CompletedProcess(
+            args=args,
+            returncode=return_code,
+            stdout=stdout.decode("utf-8", errors="replace"),
+            stderr=stderr.decode("utf-8", errors="replace"),
+        )
+
+    def _shell_v2(self, device_id, command, timeout):
+        sock = self._open_service(device_id, f"shell,v2,raw:{command}", timeout)
+        try:
+            # nothing is written to stdin, the command gets EOF right away
+            sock.sendall(struct.pack("<BI", _SHELL_ID_CLOSE_STDIN, 0))
+
+            stdout, stderr, return_code = [], [], 255
+            while True:
+                header = sock.recv(5)
+                if not header:
+                    break
+                if len(header) < 5:
+                    header += _recv_exactly(sock, 5 - len(header))
+                packet_id, length = struct.unpack("<BI", header)
+                data = _recv_exactly(sock, length) if length > 0 else b""
+
+                if packet_id == _SHELL_ID_STDOUT:
+                    stdout.append(data)
+                elif packet_id == _SHELL_ID_STDERR:
+                    stderr.append(data)
+                elif packet_id == _SHELL_ID_EXIT:
+                    return_code = data[0] if data else 255
+                    break
+            return return_code, b"".join(stdout), b"".join(stderr)
+        finally:
+            sock.close()
+
+    def _shell_legacy(self, device_id, command, timeout):
+        # the legacy shell service does not report the exit code, it is echoed after the output
+        marker = b"__GELAB_EXIT__:"
+        sock = self._open_service(device_id, f"shell:{command} </dev/null; echo \"\n{marker.decode()}$?\"", timeout)
+        try:
+            output = _recv_all(sock).replace(b"\r\n", b"\n")
+        finally:
+            sock.close()
+
+        return_code = 255
+        if marker in output:
+            output, tail = output.rsplit(marker, 1)
+            # drop the newline added before the marker
+            output = output[:-1] if output.endswith(b"\n") else output
+            try:
+                return_code = int(tail.strip())
+            except ValueError:
+                pass
+        return return_code, output, b""
+
+    def exec_out(self, device_id, command, timeout=None):
+        """
+        Run a command with exec: and return its raw binary stdout.
+        :raises subprocess.TimeoutExpired: if connecting, opening the service or reading takes longer than timeout.
+        """
+        try:
+            sock = self._open_service(device_id, f"exec:{command}", timeout)
+            try:
+                return _recv_all(sock)
+            finally:
+                sock.close()
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(f"exec:{command}", timeout or self.timeout)
+
+    # ---------------------------------------------------------------- sync service
+
+    def _sync_request(self, sock, sync_id, data):
+        sock.sendall(sync_id + struct.pack("<I", len(data)) + data)
+
+    def _sync_read_fail(self, sock):
+        length = struct.unpack("<I", _recv_exactly(sock, 4))[0]
+        return _recv_exactly(sock, length).decode("utf-8", errors="replace")
+
+    def stat(self, device_id, remote_path):
+        """
+        Get (mode, size, mtime) of a remote file, mode is 0 if the file does not exist.
+        """
+        sock = self._open_service(device_id, "sync:")
+        try:
+            self._sync_request(sock, b"STAT", remote_path.encode("utf-8"))
+            reply = _recv_exactly(sock, 16)
+            if reply[:4] != b"STAT":
+                raise AdbProtocolError(f"Unexpected sync reply {reply[:4]} for STAT {remote_path}")
+            mode, size, mtime = struct.unpack("<III", reply[4:])
+            self._sync_request(sock, b"QUIT", b"")
+            return mode, size, mtime
+        finally:
+            sock.close()
+
+    def push(self, device_id, local_path, remote_path, mode=0o644):
+        """
+        Push a local file to the device. A remote directory path gets the local file name appended, like `adb push`.
+        """
+        remote_mode = self.stat(device_id, remote_path)[0]
+        if remote_mode & 0o170000 == 0o040000:
+            remote_path = remote_path.rstrip("/") + "/" + os.path.basename(local_path)
+
+        sock = self._open_service(device_id, "sync:")
+        try:
+            self._sync_request(sock, b"SEND", f"{remote_path},{mode}".encode("utf-8"))
+            with open(local_path, "rb") as f:
+                while True:
+                    chunk = f.read(_SYNC_DATA_MAX)
+                    if not chunk:
+                        break
+                    self._sync_request(sock, b"DATA", chunk)
+            sock.sendall(b"DONE" + struct.pack("<I", int(time.time())))
+
+            reply = _recv_exactly(sock, 4)
+            if reply == b"FAIL":
+                raise AdbProtocolError(f"Push {local_path} to {remote_path} failed: {self._sync_read_fail(sock)}")
+            if reply != b"OKAY":
+                raise AdbProtocolError(f"Unexpected sync reply {reply} for SEND {remote_path}")
+            _recv_exactly(sock, 4)
+            self._sync_request(sock, b"QUIT", b"")
+        finally:
+            sock.close()
+
+    def pull(self, device_id, remote_path):
+        """
+        Read a remote file into bytes.
+        """
+        sock = self._open_service(device_id, "sync:")
+        try:
+            self._sync_request(sock, b"RECV", remote_path.encode("utf-8"))
+            chunks = []
+            while True:
+                sync_id = _recv_exactly(sock, 4)
+                if sync_id == b"DATA":
+                    length = struct.unpack("<I", _recv_exactly(sock, 4))[0]
+                    chunks.append(_recv_exactly(sock, length))
+                elif sync_id == b"DONE":
+                    _recv_exactly(sock, 4)
+                    break
+                elif sync_id == b"FAIL":
+                    raise AdbProtocolError(f"Pull {remote_path} failed: {self._sync_read_fail(sock)}")
+                else:
+                    raise AdbProtocolError(f"Unexpected sync reply {sync_id} for RECV {remote_path}")
+            self._sync_request(sock, b"QUIT", b"")
+            return b"".join(chunks)
+        finally:
+            sock.close()
+
+
+_adb_client = None
+_adb_client_lock = threading.Lock()
+
+
+def get_adb_client():
+    """
+    Get the process wide adb server client.
+    """
+    global _adb_client
+    with _adb_client_lock:
+        if _adb_client is None:
+            _adb_client = AdbServerClient()
+        return _adb_client
+
+
+class _StandInAdbServer:
+    """
+    A minimal local server speaking the adb host protocol, for trying the client without a device.
+    Shell and exec commands are run by the local `sh`; only one device, "stand-in", is known.
+    """
+
+    def __init__(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(64)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept_runner, daemon=True).start()
+
+    def _accept_runner(self):
+        while True:
+            conn, _ = self._server.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _reply(self, conn, payload):
+        payload = payload.encode("utf-8")
+        conn.sendall(b"OKAY" + b"%04x" % len(payload) + payload)
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    length = int(_recv_exactly(conn, 4), 16)
+                except AdbProtocolError:
+                    return
+                request = _recv_exactly(conn, length).decode("utf-8")
+
+                if request == "host:devices":
+                    return self._reply(conn, "stand-in\tdevice\n")
+                if request.endswith(":features"):
+                    return self._reply(conn, "shell_v2,cmd")
+                if request in ["host:transport:stand-in", "host:transport-any"]:
+                    conn.sendall(b"OKAY")
+                    continue
+                if request.startswith("shell,v2,raw:"):
+                    conn.sendall(b"OKAY")
+                    # the client closes stdin first
+                    _recv_exactly(conn, 5)
+                    result = subprocess.run(["sh", "-c", request.split(":", 1)[1]], capture_output=True, stdin=subprocess.DEVNULL)
+                    conn.sendall(struct.pack("<BI", _SHELL_ID_STDOUT, len(result.stdout)) + result.stdout)
+                    conn.sendall(struct.pack("<BI", _SHELL_ID_STDERR, len(result.stderr)) + result.stderr)
+                    conn.sendall(struct.pack("<BIB", _SHELL_ID_EXIT, 1, result.returncode & 0xff))
+                    return
+                if request.startswith("exec:"):
+                    conn.sendall(b"OKAY")
+                    result = subprocess.run(["sh", "-c", request.split(":", 1)[1]], capture_output=True, stdin=subprocess.DEVNULL)
+                    conn.sendall(result.stdout)
+                    return
+
+                message = f"unknown service {request}".encode("utf-8")
+                conn.sendall(b"FAIL" + b"%04x" % len(message) + message)
+                return
+
+
+if __name__ == "__main__":
+    # python copilot_front_end/adb_protocol.py [device_id] [rounds]
+    # without a device id, the client is checked against a local stand-in server
+    device_id = sys.argv[1] if len(sys.argv) > 1 else None
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    if device_id is None:
+        stand_in = _StandInAdbServer()
+        client = AdbServerClient(port=stand_in.port)
+
+        assert client.list_devices() == ["stand-in"]
+        result = client.shell("stand-in", "printf hello; echo oops >&2; exit 3")
+        assert (result.stdout, result.stderr, result.returncode) == ("hello", "oops\n", 3), result
+        assert client.exec_out("stand-in", "printf '\\211PNG\\r\\n'") == b"\x89PNG\r\n"
+
+        # a server that accepts but never answers times out in the transport handshake
+        silent_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent_server.bind(("127.0.0.1", 0))
+        silent_server.listen(8)
+        silent_client = AdbServerClient(port=silent_server.getsockname()[1], pool_size=0)
+        silent_client._features["stand-in"] = ["shell_v2"]
+        for call in [silent_client.shell, silent_client.exec_out]:
+            try:
+                call("stand-in", "true", timeout=0.2)
+                raise AssertionError(f"{call.__name__} did not time out")
+            except subprocess.TimeoutExpired:
+                pass
+
+        latencies = []
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            client.shell("stand-in", "true")
+            latencies.append(time.perf_counter() - start_time)
+        latencies.sort()
+        print(f"[socket stand-in] shell true: mean_ms={1000 * sum(latencies) / len(latencies):.2f}, p50_ms={1000 * latencies[len(latencies) // 2]:.2f}")
+    else:
+        from copilot_front_end.adb_session import benchmark_adb_backends
+
+        benchmark_adb_backends(device_id, "getprop ro.product.manufacturer", rounds)
+        benchmark_adb_backends(device_id, "input keyevent 0", rounds)
@@ -0,0 +1,329 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
+import subprocess
+
+from uuid import uuid4
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+from copilot_front_end.adb_protocol import get_adb_client
+
+# backends to run a shell command on the device:
+# 1. "session": multiplex commands over one long-lived `adb -s <id> shell` process per device
+# 2. "cli": spawn a new `adb -s <id> shell <cmd>` process for every command (legacy behaviour)
+# 3. "socket": talk to the adb server socket directly, see copilot_front_end/adb_protocol.py
+_SUPPORTED_ADB_BACKENDS = ["session", "cli", "socket"]
+
+_adb_backend = os.environ.get("GELAB_ADB_BACKEND", "session")
+
+
+def set_adb_backend(backend):
+    """
+    Set the backend used by adb_shell, one of _SUPPORTED_ADB_BACKENDS.
+    """
+    global _adb_backend
+    assert backend in _SUPPORTED_ADB_BACKENDS, f"Unknown adb backend: {backend}, supported: {_SUPPORTED_ADB_BACKENDS}"
+    _adb_backend = backend
+
+
+def get_adb_backend():
+    return _adb_backend
+
+
+# called with the device id whenever a shell session has to be restarted, e.g. after the device reconnects
+_reconnect_callbacks = []
+
+
+def add_reconnect_callback(callback):
+    """
+    Register a callback(device_id) to run when the shell session of a device is restarted.
+    """
+    if callback not in _reconnect_callbacks:
+        _reconnect_callbacks.append(callback)
+
+
+def _cli_prefix(device_id):
+    if device_id is None:
+        return ["adb"]
+    return ["adb", "-s", device_id]
+
+
+class AdbShellSession:
+    """
+    A long-lived `adb shell` process for one device.
+
+    Commands are written to the stdin of the shell, and the output of each command is framed by
+    a unique sentinel line carrying the exit code, so one process can serve many commands.
+    The process is restarted automatically when it dies or when a command times out.
+    """
+
+    def __init__(self, device_id=None, default_timeout=30):
+        self.device_id = device_id
+        self.default_timeout = default_timeout
+
+        self._lock = threading.Lock()
+        self._process = None
+        self._output_queue = None
+
+        self.start_count = 0
+        self.command_count = 0
+
+    def _is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            _cli_prefix(self.device_id) + ["shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+        self._output_queue = queue.Queue()
+
+        def reader(stdout, output_queue):
+            for line in iter(stdout.readline, b""):
+                output_queue.put(line)
+            # EOF, the shell process is gone
+            output_queue.put(None)
+
+        threading.Thread(target=reader, args=(self._process.stdout, self._output_queue), daemon=True).start()
+
+        self.start_count += 1
+        if self.start_count > 1:
+            for callback in _reconnect_callbacks:
+                callback(self.device_id)
+
+    def _kill(self):
+        if self._process is None:
+            return
+        try:
+            self._process.kill()
+            self._process.wait(timeout=5)
+        except Exception as e:
+            print(f"Error killing adb shell session for device {self.device_id}: {e}")
+        self._process = None
+        self._output_queue = None
+
+    def close(self):
+        """
+        Close the shell process of this session.
+        """
+        with self._lock:
+            if self._is_alive():
+                try:
+                    self._process.stdin.write(b"exit\n")
+                    self._process.stdin.flush()
+                    self._process.wait(timeout=2)
+                except Exception:
+                    pass
+            self._kill()
+
+    def run(self, command, timeout=None):
+        """
+        Run a shell command on the device and return a subprocess.CompletedProcess.
+        stderr is merged into stdout on the device side.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+
+        with self._lock:
+            # the session is (re)started only before a command is sent, so a command is never executed twice
+            if not self._is_alive():
+                self._kill()
+                self._start()
+
+            sentinel = f"__GELAB_END_{uuid4().hex}__"
+            # stdin is detached so that the command can never consume the following commands
+            framed_command = f"{{ {command}\n}} </dev/null 2>&1; echo \"{sentinel}:$?\"\n"
+
+            try:
+                self._process.stdin.write(framed_command.encode("utf-8"))
+                self._process.stdin.flush()
+            except (BrokenPipeError, OSError):
+                # the shell died between the liveness check and the write, retry once on a new process
+                self._kill()
+                self._start()
+                self._process.stdin.write(framed_command.encode("utf-8"))
+                self._process.stdin.flush()
+
+            self.command_count += 1
+
+            output_lines = []
+            return_code = None
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                try:
+                    if remaining <= 0:
+                        raise queue.Empty
+                    line = self._output_queue.get(timeout=remaining)
+                except queue.Empty:
+                    # the framing is lost, the process can not be reused
+                    self._kill()
+                    raise subprocess.TimeoutExpired(command, timeout, output="".join(output_lines))
+
+                if line is None:
+                    # the shell exited in the middle of the command, e.g. the device was disconnected
+                    self._kill()
+                    return_code = 255
+                    break
+
+                line = line.decode("utf-8", errors="replace").replace("\r\n", "\n")
+                if sentinel in line:
+                    head, tail = line.split(sentinel, 1)
+                    # the output of the command may not end with a newline
+                    output_lines.append(head)
+                    try:
+                        return_code = int(tail.strip().lstrip(":"))
+                    except ValueError:
+                        return_code = 255
+                    break
+
+                output_lines.append(line)
+
+        return subprocess.CompletedProcess(
+            args=" ".join(_cli_prefix(self.device_id) + ["shell", command]),
+            returncode=return_code,
+            stdout="".join(output_lines),
+            stderr="",
+        )
+
+
+_session_pool = {}
+_session_pool_lock = threading.Lock()
+
+
+def get_adb_session(device_id):
+    """
+    Get the shell session of the specified device, create one if it does not exist.
+    """
+    with _session_pool_lock:
+        session = _session_pool.get(device_id, None)
+        if session is None:
+            session = AdbShellSession(device_id)
+            _session_pool[device_id] = session
+        return session
+
+
+def close_adb_session(device_id):
+    """
+    Close and drop the shell session of the specified device.
+    """
+    with _session_pool_lock:
+        session = _session_pool.pop(device_id, None)
+    if session is not None:
+        session.close()
+
+
+def close_all_adb_sessions():
+    with _session_pool_lock:
+        sessions = list(_session_pool.values())
+        _session_pool.clear()
+    for session in sessions:
+        session.close()
+
+atexit.register(close_all_adb_sessions)
+
+
+def _cli_shell(device_id, command, timeout=None):
+    args = _cli_prefix(device_id) + ["shell", command]
+    result = subprocess.run(args, capture_output=True, text=True, encoding="utf-8", errors="replace", timeout=timeout)
+    return result
+
+
+def adb_shell(device_id, command, timeout=None, print_command=False):
+    """
+    Run a shell command on the specified device with the current backend.
+    :param device_id: The device ID, None for the only connected device.
+    :param command: The command line to be interpreted by the device shell, e.g. "input tap 100 200".
+    :return: subprocess.CompletedProcess with decoded stdout.
+    """
+    if print_command:
+        print(f"Executing command: {' '.join(_cli_prefix(device_id))} shell {command}")
+
+    if _adb_backend == "session":
+        return get_adb_session(device_id).run(command, timeout=timeout)
+    elif _adb_backend == "cli":
+        return _cli_shell(device_id, command, timeout=timeout)
+    elif _adb_backend == "socket":
+        return get_adb_client().shell(device_id, command, timeout=timeout)
+    else:
+        raise ValueError(f"Unknown adb backend: {_adb_backend}")
+
+
+def adb_exec_out(device_id, command, timeout=None, print_command=False):
+    """
+    Run a command on the specified device and return its raw stdout as bytes.
+    exec-out streams binary output without tty translation, so nothing is written to the device storage.
+    """
+    args = _cli_prefix(device_id) + ["exec-out", command]
+    if print_command:
+        print(f"Executing command: {' '.join(args)}")
+
+    if _adb_backend == "socket":
+        return get_adb_client().exec_out(device_id, command, timeout=timeout)
+
+    result = subprocess.run(args, capture_output=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"adb exec-out {command} failed on device {device_id}: {result.stderr.decode('utf-8', errors='replace').strip()}")
+    return result.stdout
+
+
+def adb_push(device_id, local_path, remote_path, print_command=False):
+    """
+    Push a local file to the device, over the sync service with the socket backend.
+    """
+    args = _cli_prefix(device_id) + ["push", local_path, remote_path]
+    if print_command:
+        print(f"Executing command: {' '.join(args)}")
+
+    if _adb_backend == "socket":
+        get_adb_client().push(device_id, local_path, remote_path)
+        return
+
+    result = subprocess.run(args, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    if result.returncode != 0:
+        raise RuntimeError(f"adb push {local_path} failed on device {device_id}: {result.stderr.strip()}")
+
+
+def benchmark_adb_backends(device_id, command="getprop ro.product.manufacturer", rounds=50):
+    """
+    Compare the per-command latency of the available backends on a real device.
+    """
+    results = {}
+    for backend in _SUPPORTED_ADB_BACKENDS:
+        set_adb_backend(backend)
+        # warm up, the first session command includes the process start
+        adb_shell(device_id, command)
+
+        latencies = []
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            adb_shell(device_id, command)
+            latencies.append(time.perf_counter() - start_time)
+
+        latencies.sort()
+        results[backend] = {
+            "mean_ms": 1000 * sum(latencies) / len(latencies),
+            "p50_ms": 1000 * latencies[len(latencies) // 2],
+            "p95_ms": 1000 * latencies[int(len(latencies) * 0.95) - 1],
+        }
+        print(f"[{backend}] {command}: " + ", ".join([f"{k}={v:.1f}" for k, v in results[backend].items()]))
+
+    return results
+
+
+if __name__ == "__main__":
+    # python copilot_front_end/adb_session.py [device_id] [rounds]
+    device_id = sys.argv[1] if len(sys.argv) > 1 else None
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    benchmark_adb_backends(device_id, "getprop ro.product.manufacturer", rounds)
+    benchmark_adb_backends(device_id, "input keyevent 0", rounds)
+    benchmark_adb_backends(device_id, "dumpsys display | grep mScreenState", rounds)
@@ -0,0 +1,193 @@
+import sys
+import struct
+import asyncio
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+from copilot_front_end.adb_session import get_adb_backend, get_adb_session, _cli_prefix
+from copilot_front_end.adb_protocol import AdbProtocolError, get_adb_client
+from copilot_front_end.adb_protocol import _SHELL_ID_STDOUT, _SHELL_ID_STDERR, _SHELL_ID_EXIT, _SHELL_ID_CLOSE_STDIN
+
+# the blocking "session" backend runs in these threads, sized for dozens of devices on one event loop
+_session_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="gelab-adb-session")
+
+# device id -> feature list of the device, queried once
+_device_features = {}
+
+
+async def _read_status(reader, request):
+    status = await reader.readexactly(4)
+    if status == b"OKAY":
+        return
+    if status == b"FAIL":
+        length = int(await reader.readexactly(4), 16)
+        message = (await reader.readexactly(length)).decode("utf-8", errors="replace")
+        raise AdbProtocolError(f"adb server refused {request}: {message}")
+    raise AdbProtocolError(f"Unexpected adb server status {status} for {request}")
+
+
+async def _send_request(reader, writer, request):
+    payload = request.encode("utf-8")
+    writer.write(b"%04x" % len(payload) + payload)
+    await writer.drain()
+    await _read_status(reader, request)
+
+
+async def _open_connection():
+    client = get_adb_client()
+    return await asyncio.open_connection(client.host, client.port)
+
+
+async def _host_request(request):
+    reader, writer = await _open_connection()
+    try:
+        await _send_request(reader, writer, request)
+        length = int(await reader.readexactly(4), 16)
+        return (await reader.readexactly(length)).decode("utf-8", errors="replace")
+    finally:
+        writer.close()
+
+
+async def _open_service(device_id, service):
+    reader, writer = await _open_connection()
+    try:
+        await _send_request(reader, writer, "host:transport-any" if device_id is None else f"host:transport:{device_id}")
+        await _send_request(reader, writer, service)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def _features(device_id):
+    if device_id not in _device_features:
+        request = "host:features" if device_id is None else f"host-serial:{device_id}:features"
+        _device_features[device_id] = (await _host_request(request)).split(",")
+    return _device_features[device_id]
+
+
+async def _socket_shell(device_id, command):
+    if "shell_v2" not in await _features(device_id):
+        # the legacy shell protocol has no exit code framing, reuse the blocking client
+        return await asyncio.get_running_loop().run_in_executor(_session_executor, get_adb_client().shell, device_id, command)
+
+    reader, writer = await _open_service(device_id, f"shell,v2,raw:{command}")
+    try:
+        writer.write(struct.pack("<BI", _SHELL_ID_CLOSE_STDIN, 0))
+        await writer.drain()
+
+        stdout, stderr, return_code = [], [], 255
+        while True:
+            try:
+                header = await reader.readexactly(5)
+            except asyncio.IncompleteReadError:
+                break
+            packet_id, length = struct.unpack("<BI", header)
+            data = await reader.readexactly(length) if length > 0 else b""
+
+            if packet_id == _SHELL_ID_STDOUT:
+                stdout.append(data)
+            elif packet_id == _SHELL_ID_STDERR:
+                stderr.append(data)
+            elif packet_id == _SHELL_ID_EXIT:
+                return_code = data[0] if data else 255
+                break
+    finally:
+        writer.close()
+
+    return subprocess.CompletedProcess(
+        args=" ".join(_cli_prefix(device_id) + ["shell", command]),
+        returncode=return_code,
+        stdout=b"".join(stdout).decode("utf-8", errors="replace"),
+        stderr=b"".join(stderr).decode("utf-8", errors="replace"),
+    )
+
+
+async def _run_cli(args):
+    process = await asyncio.create_subprocess_exec(*args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate()
+    except BaseException:
+        # timed out or cancelled, do not leave the adb process behind
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, stdout, stderr
+
+
+async def _cli_shell(device_id, command):
+    args = _cli_prefix(device_id) + ["shell", command]
+    return_code, stdout, stderr = await _run_cli(args)
+    return subprocess.CompletedProcess(
+        args=args,
+        returncode=return_code,
+        stdout=stdout.decode("utf-8", errors="replace"),
+        stderr=stderr.decode("utf-8", errors="replace"),
+    )
+
+
+async def async_adb_shell(device_id, command, timeout=None, print_command=False):
+    """
+    Async version of adb_shell, with the current backend.
+    "socket" and "cli" are natively async and can be cancelled at any time,
+    "session" runs in a thread pool and relies on the timeout of the session itself.
+    :return: subprocess.CompletedProcess with decoded stdout.
+    :raises subprocess.TimeoutExpired: if the command does not finish within timeout seconds.
+    """
+    if print_command:
+        print(f"Executing command: {' '.join(_cli_prefix(device_id))} shell {command}")
+
+    backend = get_adb_backend()
+    if backend == "session":
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_session_executor, get_adb_session(device_id).run, command, timeout)
+    elif backend == "socket":
+        coro = _socket_shell(device_id, command)
+    elif backend == "cli":
+        coro = _cli_shell(device_id, command)
+    else:
+        raise ValueError(f"Unknown adb backend: {backend}")
+
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(command, timeout)
+
+
+async def _socket_exec_out(device_id, command):
+    reader, writer = await _open_service(device_id, f"exec:{command}")
+    try:
+        return await reader.read()
+    finally:
+        writer.close()
+
+
+async def _cli_exec_out(device_id, command):
+    return_code, stdout, stderr = await _run_cli(_cli_prefix(device_id) + ["exec-out", command])
+    if return_code != 0:
+        raise RuntimeError(f"adb exec-out {command} failed on device {device_id}: {stderr.decode('utf-8', errors='replace').strip()}")
+    return stdout
+
+
+async def async_adb_exec_out(device_id, command, timeout=None, print_command=False, backend=None):
+    """
+    Async version of adb_exec_out, returns the raw stdout of the command as bytes.
+    :param backend: "socket" to skip spawning an adb process whatever the current backend, e.g. for frequent captures.
+    """
+    if print_command:
+        print(f"Executing command: {' '.join(_cli_prefix(device_id))} exec-out {command}")
+
+    if (backend or get_adb_backend()) == "socket":
+        coro = _socket_exec_out(device_id, command)
+    else:
+        coro = _cli_exec_out(device_id, command)
+
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(command, timeout)
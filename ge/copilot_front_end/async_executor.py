@@ -0,0 +1,437 @@
+import io
+import os
+import sys
+import time
+import struct
+import asyncio
+
+from PIL import Image
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+from copilot_front_end.installed_apps import async_find_installed_package_name
+from copilot_front_end.adb_session import close_adb_session
+from copilot_front_end.async_adb import async_adb_shell, async_adb_exec_out
+from copilot_front_end.device_registry import get_device_registry
+from copilot_front_end.device_property_cache import get_property_cache, invalidate_after_action, invalidate_on_reconnect, note_frame_size
+from copilot_front_end.screen_settle import async_wait_after_action
+
+from tools.image_tools import decode_raw_screencap, raw_pixels_to_image
+
+# screenshot capture modes:
+# 1. "png": `screencap -p`, the device compresses a PNG, small transfer but slow on low-end devices
+# 2. "raw": `screencap` without compression, the host wraps the framebuffer directly, falls back to "png" for unknown formats
+_SUPPORTED_CAPTURE_MODES = ["png", "raw"]
+
+_default_capture_mode = os.environ.get("GELAB_CAPTURE_MODE", "png")
+_device_capture_mode = {}
+
+
+def _on_device_event(event, device_id):
+    """
+    Drop the cached state of a device when it connects or disconnects.
+    """
+    invalidate_on_reconnect(device_id)
+    if event == "disconnected":
+        close_adb_session(device_id)
+
+
+def _get_device_registry():
+    registry = get_device_registry()
+    registry.add_listener(_on_device_event)
+    return registry
+
+
+async def async_check_device(device_id):
+    """
+    Assert that the device is connected, the registry is refreshed once before failing.
+    """
+    if device_id is None:
+        return
+    registry = _get_device_registry()
+    if not registry.is_connected(device_id):
+        # the device may have been connected a moment ago, ask the adb server once before failing
+        await asyncio.to_thread(registry.refresh)
+    assert registry.is_connected(device_id), f"Device {device_id} not found in connected devices."
+
+
+def set_capture_mode(device_id, capture_mode):
+    """
+    Set the screenshot capture mode of the specified device, one of _SUPPORTED_CAPTURE_MODES.
+    """
+    assert capture_mode in _SUPPORTED_CAPTURE_MODES, f"Unknown capture mode: {capture_mode}, supported: {_SUPPORTED_CAPTURE_MODES}"
+    _device_capture_mode[device_id] = capture_mode
+
+
+def get_capture_mode(device_id):
+    """
+    Get the screenshot capture mode of the specified device.
+    """
+    return _device_capture_mode.get(device_id, _default_capture_mode)
+
+
+async def async_capture_screenshot_bytes(device_id, print_command=False):
+    """
+    Capture a screenshot of the specified device as PNG bytes, streamed over exec-out.
+    """
+    await async_check_device(device_id)
+
+    image_bytes = await async_adb_exec_out(device_id, "screencap -p", print_command=print_command)
+
+    if not image_bytes.startswith(b"\x89PNG"):
+        raise ValueError(f"Unexpected screencap output for device {device_id}: {image_bytes[:64]}")
+
+    # the width and height of the IHDR chunk, a rotation drops the cached orientation
+    note_frame_size(device_id, *struct.unpack(">II", image_bytes[16:24]))
+    return image_bytes
+
+
+def _decode_png(image_bytes):
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    return image
+
+
+async def async_capture_screenshot_image(device_id, print_command=False):
+    """
+    Capture a screenshot of the specified device as a decoded PIL Image.
+    The PNG is decoded in a worker thread, so other devices keep running meanwhile.
+    """
+    image_bytes = await async_capture_screenshot_bytes(device_id, print_command=print_command)
+    return await asyncio.to_thread(_decode_png, image_bytes)
+
+
+async def async_capture_screenshot_raw(device_id, print_command=False):
+    """
+    Capture the uncompressed framebuffer of the specified device.
+    :return: (pixels, raw_mode) as returned by decode_raw_screencap, None if the framebuffer format is unknown.
+    """
+    await async_check_device(device_id)
+
+    raw_data = await async_adb_exec_out(device_id, "screencap", print_command=print_command)
+    raw_frame = decode_raw_screencap(raw_data)
+    if raw_frame is not None:
+        note_frame_size(device_id, raw_frame[0].shape[1], raw_frame[0].shape[0])
+    return raw_frame
+
+
+async def async_capture_screenshot_frame(device_id, print_command=False):
+    """
+    Capture a screenshot of the specified device as a decoded PIL Image (RGB or RGBX), with the capture mode of the device.
+    """
+    if get_capture_mode(device_id) == "raw":
+        raw_frame = await async_capture_screenshot_raw(device_id, print_command=print_command)
+        if raw_frame is not None:
+            return raw_pixels_to_image(*raw_frame)
+
+        print(f"Unknown raw screencap format on device {device_id}, falling back to png capture mode.")
+        set_capture_mode(device_id, "png")
+
+    image = await async_capture_screenshot_image(device_id, print_command=print_command)
+    if image.mode != "RGB":
+        image = await asyncio.to_thread(image.convert, "RGB")
+    return image
+
+
+async def async_dectect_screen_on(device_id, print_command=False):
+    """
+    Detect whether the screen is on for the specified device.
+    """
+    await async_check_device(device_id)
+
+    async def query_screen_on():
+        # the pipe is interpreted by the device shell, so the same command works on every host platform
+        result = await async_adb_shell(device_id, "dumpsys display | grep mScreenState", print_command=print_command)
+        return "ON" in result.stdout.strip()
+
+    return await get_property_cache().async_get(device_id, "screen_on", query_screen_on)
+
+
+async def async_get_device_wm_size(device_id):
+    """
+    Get the screen size of the specified device, cached until the device reconnects.
+    """
+    return await get_property_cache().async_get(device_id, "wm_size", lambda: _async_query_device_wm_size(device_id))
+
+
+async def _async_query_device_wm_size(device_id):
+    """
+    Query the screen size of the specified device with `wm size`.
+    """
+    await async_check_device(device_id)
+    try:
+        result = await async_adb_shell(device_id, "wm size")
+
+        result_str = result.stdout.strip()
+
+        assert "Physical size:" in result_str or "Override size:" in result_str, f"Unexpected wm size output: {result_str}"
+
+        if "override size" in result_str.lower():
+            size = result_str.split('Override size:')[1].strip()
+        else:
+            size = result_str.split('Physical size:')[1].strip()
+
+        size = size.split('x')
+        if "\n" in size[1]:
+            size[1] = size[1].split("\n")[0]
+        size = (int(size[0]), int(size[1]))
+        return size
+    except Exception as e:
+        print(f"Error getting device size: {e}")
+        return None
+
+
+def _convert_point_to_realworld_point(point, wm_size):
+    x, y = point
+    real_x = (float(x) / 1000) * wm_size[0]
+    real_y = (float(y) / 1000) * wm_size[1]
+    return (real_x, real_y)
+
+
+async def async_detect_screen_orientation(device_id):
+    """
+    Detect the screen orientation of the specified device, cached until a rotation-capable action is executed.
+    adb shell dumpsys input | grep -m 1 -o -E "orientation=[0-9]"
+    """
+    async def query_orientation():
+        # the pipe is interpreted by the device shell, so the same command works on every host platform
+        result = await async_adb_shell(device_id, 'dumpsys input | grep -m 1 -o -E "orientation=[0-9]"')
+
+        result_str = result.stdout.strip()
+
+        return int(result_str.split("=")[-1].strip())
+
+    return await get_property_cache().async_get(device_id, "orientation", query_orientation)
+
+
+async def async_act_on_device(frontend_action, device_id, wm_size, print_command=False, reflush_app=True, settle_config=None):
+    """
+    Execute the frontend action on the device, see act_on_device in pu_frontend_executor for the action space.
+    :param settle_config: the waits inside the action, e.g. after the force-stop of AWAKE, wait for the screen to
+        settle with it instead of sleeping a fixed second, see copilot_front_end/screen_settle.py.
+    """
+    valid_actions = ["CLICK", "LONGPRESS", "TYPE", "SCROLL", "AWAKE", "SLIDE", "BACK", "HOME", "COMPLETE", "ABORT", "INFO", "WAIT", "HOT_KEY"]
+
+    assert "action_type" in frontend_action, "Missing action_type in frontend_action"
+    assert frontend_action["action_type"] in valid_actions, f"Invalid action type: {frontend_action['action_type']}"
+
+    result = await _async_execute_frontend_action(frontend_action, device_id, wm_size, print_command=print_command, reflush_app=reflush_app, settle_config=settle_config)
+
+    # the action may have changed cached device properties, e.g. a click opening a landscape activity
+    invalidate_after_action(device_id, frontend_action["action_type"])
+
+    return result
+
+
+async def _async_execute_frontend_action(frontend_action, device_id, wm_size, print_command = False, reflush_app = True, settle_config = None):
+    """
+    Execute a validated frontend action on the device, see async_act_on_device.
+    """
+    action_type = frontend_action["action_type"]
+
+    if action_type == "CLICK":
+        assert "point" in frontend_action, "Missing point in CLICK action"
+
+        orientation = await async_detect_screen_orientation(device_id)
+
+        if orientation in [1, 3]:
+            wm_size = (wm_size[1], wm_size[0])
+
+        x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
+
+        result = await async_adb_shell(device_id, f"input tap {x} {y}", print_command=print_command)
+
+        return result
+    
+    elif action_type == "LONGPRESS":
+        assert "point" in frontend_action, "Missing point in LONGPRESS action"
+        assert "duration" in frontend_action, "Missing duration in LONGPRESS action"
+        x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
+        duration = frontend_action["duration"]
+        result = await async_adb_shell(device_id, f"app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -touch {x} {y} {int(duration * 1000)}", print_command=print_command)
+
+        return result
+
+    # adb shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -keyboard "{text}"
+    elif action_type == "TYPE":
+        assert "value" in frontend_action, "Missing value in TYPE action"
+
+        value = frontend_action["value"]
+        keyboard_exists = frontend_action.get("keyboard_exists", True)
+        if not keyboard_exists:
+            if "point" in frontend_action:
+                x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
+                result = await async_adb_shell(device_id, f"input tap {x} {y}", print_command=print_command)
+                await async_wait_after_action(device_id, "FOCUS_BEFORE_TYPE", settle_config, fixed_wait=1)
+            else:
+                print("Warning: keyboard does not exist and point is not given. Using current focus box.")
+
+        # def preprocess_text_for_adb(text):
+        #     # Escape special characters for adb shell input
+        #     text = text.replace("\n", " ").replace("\t", " ")
+        #     text = text.replace(" ", "\\ ")
+        #     return text
+
+
+        # cmd = f"adb -s {device_id} shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -keyboard '{preprocess_text_for_adb(value)}'"
+        
+        # Method: using ADBKeyboard broadcast intent (Requires ADBKeyboard installed and active)
+        # adb shell am broadcast -a ADB_INPUT_TEXT --es msg "text"
+        def preprocess_text_for_adb_broadcast(text):
+            # Escape double quotes which wrap the msg argument
+            text = text.replace('"', '\\"')
+            return text
+
+        processed_value = preprocess_text_for_adb_broadcast(value)
+        result = await async_adb_shell(device_id, f'am broadcast -a ADB_INPUT_TEXT --es msg "{processed_value}"', print_command=print_command)
+        return result
+    
+    elif action_type == "SCROLL":
+        assert "point" in frontend_action, "Missing point in SCROLL action"
+        assert "direction" in frontend_action, "Missing direction in SCROLL action"
+        x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
+
+        deltax = int(0.3 * wm_size[0])
+        deltay = int(0.3 * wm_size[1])
+
+        direction = frontend_action["direction"]
+        if direction == "down":
+            x1, y1 = x, y
+            x2, y2 = x, y - deltay
+        elif direction == "up":
+            x1, y1 = x, y
+            x2, y2 = x, y + deltay
+        elif direction == "left":
+            x1, y1 = x, y
+            x2, y2 = x - deltax, y
+        elif direction == "right":
+            x1, y1 = x, y
+            x2, y2 = x + deltax, y
+        else:
+            raise ValueError(f"Invalid direction: {direction}")
+        
+        result = await async_adb_shell(device_id, f"input swipe {x1} {y1} {x2} {y2} 1200", print_command=print_command)
+
+        return result
+        
+    elif action_type == "AWAKE":
+        assert "value" in frontend_action, "Missing value in AWAKE action"
+        app_name = frontend_action["value"]
+        package_name = await async_find_installed_package_name(app_name, device_id)
+        if package_name is None:
+            raise ValueError(f"App name {app_name} not found on device {device_id}.")
+        
+        if reflush_app:
+            result = await async_adb_shell(device_id, f"am force-stop {package_name}", print_command=print_command)
+            await async_wait_after_action(device_id, "FORCE_STOP", settle_config, fixed_wait=1)
+
+        result = await async_adb_shell(device_id, f"monkey -p {package_name} -c android.intent.category.LAUNCHER 1", print_command=print_command)
+
+        return result
+
+    elif action_type == "SLIDE":
+        assert "point1" in frontend_action, "Missing point1 in SLIDE action"
+        assert "point2" in frontend_action, "Missing point2 in SLIDE action"
+        x1, y1 = _convert_point_to_realworld_point(frontend_action["point1"], wm_size)
+        x2, y2 = _convert_point_to_realworld_point(frontend_action["point2"], wm_size)
+        
+        duration = frontend_action.get("duration", 1.5)
+        result = await async_adb_shell(device_id, f"input swipe {x1} {y1} {x2} {y2} {int(duration * 1000)}", print_command=print_command)
+
+        return result
+    
+    elif action_type == "BACK":
+        result = await async_adb_shell(device_id, "input keyevent 4", print_command=print_command)
+
+        return result
+    
+    elif action_type == "HOME":
+        result = await async_adb_shell(device_id, "input keyevent 3", print_command=print_command)
+
+        return result
+    
+    elif action_type == "COMPLETE":
+        if print_command:
+            print("Task completed.")
+        return None
+
+    elif action_type == "ABORT":
+        if print_command:
+            print("Task aborted.")
+        return None
+
+    elif action_type == "INFO":
+        if print_command:
+            print("Info action executed.")
+        return None
+
+    elif action_type == "WAIT":
+        assert "seconds" in frontend_action, "Missing seconds in WAIT action"
+        seconds = frontend_action["seconds"]
+        if print_command:
+            print(f"Waiting for {seconds} seconds.")
+        await asyncio.sleep(seconds)
+        return None
+    
+    elif action_type == "HOT_KEY":
+        assert "key" in frontend_action, "Missing key in HOT_KEY action"
+        key = frontend_action["key"]
+        key_event_map = {
+            "volume_up": 24,
+            "volume_down": 25,
+            "power": 26,
+            "home": 3,
+            "back": 4,
+            "menu": 82,
+        }
+        if key.lower() not in key_event_map:
+            raise ValueError(f"Unsupported hot key: {key}")
+
+        key_event = key_event_map[key.lower()]
+        result = await async_adb_shell(device_id, f"input keyevent {key_event}", print_command=print_command)
+
+        return result
+
+    else:
+        raise ValueError(f"Unsupported action type: {action_type}")    
+    
+        
+
+
+async def _async_observe_device(device_id, rounds):
+    """
+    Check the screen and capture screenshots of one device, for the concurrency demo below.
+    """
+    latencies = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        await async_dectect_screen_on(device_id)
+        await async_capture_screenshot_frame(device_id)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+async def _async_observe_all_devices(device_ids, rounds, timeout):
+    tasks = [asyncio.wait_for(_async_observe_device(device_id, rounds), timeout) for device_id in device_ids]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    # python copilot_front_end/async_executor.py [rounds]
+    # drives every connected device from one event loop, each step is a screen check and a screenshot
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    device_ids = _get_device_registry().list_devices()
+    print(f"Connected devices: {device_ids}")
+
+    start_time = time.perf_counter()
+    results = asyncio.run(_async_observe_all_devices(device_ids, rounds, timeout=60))
+    total_time = time.perf_counter() - start_time
+
+    for device_id, latencies in zip(device_ids, results):
+        if isinstance(latencies, BaseException):
+            print(f"{device_id}: failed with {latencies!r}")
+        else:
+            print(f"{device_id}: mean step {1000 * sum(latencies) / len(latencies):.1f}ms")
+    print(f"{len(device_ids)} devices x {rounds} steps in {total_time:.2f}s")
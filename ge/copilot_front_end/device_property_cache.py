@@ -0,0 +1,177 @@
+import time
+import atexit
+import threading
+
+# property name -> time to live in seconds, None means valid until invalidated
+_PROPERTY_TTL = {
+    # the manufacturer never changes, cache it for the process lifetime
+    "manufacturer": None,
+    # the screen size only changes with the device, it is dropped when the device reconnects
+    "wm_size": None,
+    # the orientation is also dropped after the actions switching apps, and when a captured frame turns
+    # between portrait and landscape, see note_frame_size
+    "orientation": 30,
+    # the screen state is also dropped after power key events; the steps of a rollout keep the screen awake,
+    # the ttl covers a device left idle past its screen timeout
+    "screen_on": 300,
+}
+
+# front-end actions that switch apps and so may rotate the screen, for both executors;
+# a click rotating the screen is seen in the next captured frame
+ROTATION_CAPABLE_ACTIONS = [
+    "AWAKE", "BACK", "HOME", "HOT_KEY",
+    "Awake",
+]
+
+
+class DevicePropertyCache:
+    """
+    Cache of slow-to-query device properties, e.g. `wm size` or `dumpsys input` results.
+    Every lookup counts a hit or a miss for its property, see get_stats.
+    """
+
+    def __init__(self, property_ttl=None):
+        self.property_ttl = dict(_PROPERTY_TTL)
+        if property_ttl is not None:
+            self.property_ttl.update(property_ttl)
+
+        self._lock = threading.Lock()
+        # (device_id, property_name) -> (value, expire_time)
+        self._entries = {}
+
+        self._hits = {}
+        self._misses = {}
+
+        # device_id -> whether its last captured frame was landscape
+        self._frame_landscape = {}
+        self.rotations = 0
+
+    def get(self, device_id, property_name, loader):
+        """
+        Get the cached property of the device, call loader() to query it on a miss.
+        None results are not cached, so a failed query is retried next time.
+        """
+        key = (device_id, property_name)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                self._hits[property_name] = self._hits.get(property_name, 0) + 1
+                return entry[0]
+            self._misses[property_name] = self._misses.get(property_name, 0) + 1
+
+        value = loader()
+        if value is not None:
+            self.set(device_id, property_name, value)
+        return value
+
+    async def async_get(self, device_id, property_name, async_loader):
+        """
+        Same as get, with a coroutine function as the loader.
+        """
+        key = (device_id, property_name)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                self._hits[property_name] = self._hits.get(property_name, 0) + 1
+                return entry[0]
+            self._misses[property_name] = self._misses.get(property_name, 0) + 1
+
+        value = await async_loader()
+        if value is not None:
+            self.set(device_id, property_name, value)
+        return value
+
+    def set(self, device_id, property_name, value):
+        ttl = self.property_ttl.get(property_name, None)
+        expire_time = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries[(device_id, property_name)] = (value, expire_time)
+
+    def invalidate(self, device_id, property_names=None):
+        """
+        Drop the cached properties of the device, all of them if property_names is None.
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if key[0] == device_id and (property_names is None or key[1] in property_names):
+                    del self._entries[key]
+
+    def note_frame_size(self, device_id, width, height):
+        """
+        Drop the cached orientation of the device when a captured frame turned between portrait and landscape.
+        """
+        landscape = width > height
+        with self._lock:
+            previous = self._frame_landscape.get(device_id, None)
+            self._frame_landscape[device_id] = landscape
+            if previous is None or previous == landscape:
+                return
+            self.rotations += 1
+        self.invalidate(device_id, ["orientation"])
+
+    def get_stats(self):
+        """
+        Get the hit and miss counters and the hit rate of every property.
+        """
+        with self._lock:
+            property_names = set(self._hits.keys()) | set(self._misses.keys())
+            stats = {}
+            for name in sorted(property_names):
+                hits, misses = self._hits.get(name, 0), self._misses.get(name, 0)
+                stats[name] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses),
+                }
+            return stats
+
+    def report(self):
+        stats = self.get_stats()
+        if len(stats) == 0:
+            return
+        print("Device property cache: " + ", ".join(
+            f"{name} {100 * counters['hit_rate']:.1f}% of {counters['hits'] + counters['misses']}" for name, counters in stats.items()
+        ) + f"; {self.rotations} rotations seen in frames")
+
+
+_property_cache = DevicePropertyCache()
+# the hit rates of the process, e.g. of screen_on, checked once per step
+atexit.register(_property_cache.report)
+
+
+def get_property_cache():
+    return _property_cache
+
+
+def get_property_cache_stats():
+    return _property_cache.get_stats()
+
+
+def invalidate_after_action(device_id, action_type):
+    """
+    Drop the properties that the executed action may have changed.
+    """
+    if action_type in ROTATION_CAPABLE_ACTIONS:
+        _property_cache.invalidate(device_id, ["orientation"])
+
+    # a hot key may be the power key
+    if action_type == "HOT_KEY":
+        _property_cache.invalidate(device_id, ["screen_on"])
+
+
+def note_frame_size(device_id, width, height):
+    """
+    Called with the size of every captured frame, see DevicePropertyCache.note_frame_size.
+    """
+    _property_cache.note_frame_size(device_id, width, height)
+
+
+def invalidate_after_power_key(device_id):
+    _property_cache.invalidate(device_id, ["screen_on", "orientation"])
+
+
+def invalidate_on_reconnect(device_id):
+    """
+    Drop everything that may differ after a reconnect, the manufacturer is kept.
+    """
+    _property_cache.invalidate(device_id, ["wm_size", "orientation", "screen_on"])
@@ -0,0 +1,173 @@
+import sys
+import threading
+import subprocess
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+
+def parse_device_states(devices_output):
+    """
+    Parse the body of `adb devices` or of one `adb track-devices` message into {serial: state}.
+    """
+    device_states = {}
+    for line in devices_output.splitlines():
+        line = line.strip()
+        if not line or line.startswith("List of devices") or line.startswith("*"):
+            continue
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        device_states[parts[0]] = parts[1]
+    return device_states
+
+
+class DeviceRegistry:
+    """
+    In-memory view of the devices known to the adb server.
+
+    A background thread follows `adb track-devices`, which pushes the full device list on every change.
+    When the stream is unavailable, the thread falls back to polling `adb devices`.
+    Listeners are called with ("connected" | "disconnected", device_id) on every change.
+    """
+
+    def __init__(self, poll_interval=2.0):
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._device_states = {}
+        self._listeners = []
+
+        self._thread = None
+        self._track_process = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """
+        Take a synchronous snapshot of the devices, then start following changes in the background.
+        """
+        if self._thread is not None:
+            return
+        self.refresh()
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._track_process is not None:
+            self._track_process.kill()
+        self._thread = None
+
+    def add_listener(self, callback):
+        """
+        Register a callback(event, device_id), event is "connected" or "disconnected".
+        """
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def refresh(self):
+        """
+        Update the registry from one `adb devices` call.
+        """
+        try:
+            result = subprocess.run(["adb", "devices"], capture_output=True, text=True)
+            self._update(parse_device_states(result.stdout))
+        except Exception as e:
+            print(f"Error listing devices: {e}")
+
+    def _update(self, device_states):
+        with self._lock:
+            old_online = set([serial for serial, state in self._device_states.items() if state == "device"])
+            new_online = set([serial for serial, state in device_states.items() if state == "device"])
+            self._device_states = device_states
+
+        events = [("disconnected", serial) for serial in sorted(old_online - new_online)]
+        events += [("connected", serial) for serial in sorted(new_online - old_online)]
+
+        for event, serial in events:
+            for callback in self._listeners:
+                try:
+                    callback(event, serial)
+                except Exception as e:
+                    print(f"Error in device registry listener for {event} {serial}: {e}")
+
+    def _track_devices(self):
+        """
+        Follow `adb track-devices` until the stream ends.
+        Each message is a 4 hex digit length followed by the `adb devices` body.
+        """
+        self._track_process = subprocess.Popen(["adb", "track-devices"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        stdout = self._track_process.stdout
+        try:
+            while not self._stop_event.is_set():
+                length_hex = stdout.read(4)
+                if len(length_hex) < 4:
+                    break
+                length = int(length_hex, 16)
+                body = stdout.read(length) if length > 0 else b""
+                self._update(parse_device_states(body.decode("utf-8", errors="replace")))
+        finally:
+            self._track_process.kill()
+            self._track_process.wait()
+            self._track_process = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._track_devices()
+            except Exception as e:
+                print(f"Error tracking devices, falling back to polling: {e}")
+
+            if self._stop_event.is_set():
+                break
+
+            # the stream ended, e.g. the adb server restarted; poll once and then try to track again
+            self.refresh()
+            self._stop_event.wait(self.poll_interval)
+
+    def is_connected(self, device_id):
+        """
+        Check whether the device is online, without spawning any process.
+        """
+        return self._device_states.get(device_id, None) == "device"
+
+    def list_devices(self):
+        """
+        List the online devices.
+        """
+        with self._lock:
+            return [serial for serial, state in self._device_states.items() if state == "device"]
+
+    def get_device_states(self):
+        """
+        Get {serial: state} of all devices known to the adb server, including unauthorized and offline ones.
+        """
+        with self._lock:
+            return dict(self._device_states)
+
+
+_device_registry = None
+_device_registry_lock = threading.Lock()
+
+
+def get_device_registry():
+    """
+    Get the process wide device registry, started on first use.
+    """
+    global _device_registry
+    with _device_registry_lock:
+        if _device_registry is None:
+            _device_registry = DeviceRegistry()
+            _device_registry.start()
+        return _device_registry
+
+
+if __name__ == "__main__":
+    registry = get_device_registry()
+    registry.add_listener(lambda event, device_id: print(f"{event}: {device_id}"))
+    print(f"Connected devices: {registry.list_devices()}")
+
+    # print connect and disconnect events until interrupted
+    threading.Event().wait()
@@ -0,0 +1,307 @@
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import threading
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+from copilot_front_end.async_adb import async_adb_shell
+from copilot_front_end.package_map import package_name_map, app_name_aliases, AppNameResolver, get_app_name_resolver
+from tools.async_runner import run_sync
+
+# the installed packages of each device are persisted here, so restarts do not re-scan the devices
+_cache_dir = os.environ.get("GELAB_DEVICE_CACHE_DIR", "running_log/device_cache")
+
+# a scan is trusted for a day, apps are rarely installed in the middle of an evaluation
+_CACHE_TTL = 24 * 3600
+# scans of an older version are made again, e.g. the version 1 scans listed every package
+_CACHE_VERSION = 2
+# an app name that can not be resolved triggers a re-scan, at most this often per device
+_MIN_REFRESH_INTERVAL = 60
+
+# package segments that say nothing about the app, dropped when a label is derived from the package name
+_GENERIC_PACKAGE_SEGMENTS = set([
+    "com", "cn", "org", "net", "me", "io", "co", "android", "app", "apps", "mobile", "phone", "client", "main",
+])
+
+# the aapt binary dumping the app labels on the device, when there is none on its PATH
+_device_aapt = os.environ.get("GELAB_DEVICE_AAPT", "/data/local/tmp/aapt")
+# the packages whose labels are dumped by one shell command
+_LABEL_BATCH_SIZE = 20
+
+# a component of an activity, "com.tencent.mm/.ui.LauncherUI"
+_component_pattern = re.compile(r"^\s*([A-Za-z][\w]*(?:\.[\w]+)+)/\S+$")
+# the labels of aapt dump badging, the Chinese ones first
+_label_pattern = re.compile(r"^application-label(-zh-CN|-zh)?:'(.*)'$")
+
+_lock = threading.Lock()
+# device id -> {"version": int, "updated_at": float, "packages": [package names], "labels": {package: label}}
+_installed_packages = {}
+# device id -> AppNameResolver over the installed apps
+_device_resolvers = {}
+
+
+def _cache_path(device_id):
+    safe_device_id = "".join([c if c.isalnum() or c in "-_." else "_" for c in str(device_id)])
+    return os.path.join(_cache_dir, f"installed_apps_{safe_device_id}.json")
+
+
+def _load_cache(device_id):
+    path = _cache_path(device_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+    except Exception as e:
+        print(f"Error loading installed apps cache {path}: {e}")
+        return None
+    if entry.get("version", 1) != _CACHE_VERSION:
+        return None
+    return entry
+
+
+def _save_cache(device_id, entry):
+    path = _cache_path(device_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename, so a crash never leaves a half written cache behind
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def derive_app_label(package_name):
+    """
+    Derive a readable label from a package name, e.g. "com.zhihu.android" -> "zhihu".
+    The fallback for the apps missing from package_name_map whose label could not be dumped, see _async_dump_labels.
+    """
+    segments = [segment for segment in package_name.lower().split(".") if segment not in _GENERIC_PACKAGE_SEGMENTS]
+    if len(segments) == 0:
+        return package_name
+    return " ".join(segments)
+
+
+def _build_device_resolver(packages, labels):
+    """
+    Index the installed apps by the names of package_name_map, then by their labels, then by the derived labels.
+    """
+    installed = set(packages)
+    name_map = {app_name: package for app_name, package in package_name_map.items() if package in installed}
+    for package in packages:
+        if package in labels and labels[package] not in name_map:
+            name_map[labels[package]] = package
+    for package in packages:
+        label = derive_app_label(package)
+        if label not in name_map:
+            name_map[label] = package
+    return AppNameResolver(name_map, app_name_aliases)
+
+
+def _parse_launcher_packages(stdout):
+    packages = []
+    for line in stdout.splitlines():
+        match = _component_pattern.match(line)
+        if match is not None and match.group(1) not in packages:
+            packages.append(match.group(1))
+    return packages
+
+
+def _parse_package_list(stdout):
+    packages = []
+    for line in stdout.splitlines():
+        line = line.strip()
+        if line.startswith("package:"):
+            packages.append(line[len("package:"):])
+    return packages
+
+
+async def _async_scan_packages(device_id):
+    """
+    The packages with a launcher activity, the only ones AWAKE can start. Devices without
+    `cmd package query-activities` (before Android 7) get the third-party packages and the installed ones
+    of package_name_map instead.
+    """
+    result = await async_adb_shell(device_id,
+        "cmd package query-activities --brief -a android.intent.action.MAIN -c android.intent.category.LAUNCHER", timeout=30)
+    packages = _parse_launcher_packages(result.stdout)
+    if len(packages) > 0:
+        return packages
+
+    result = await async_adb_shell(device_id, "pm list packages -3", timeout=30)
+    packages = _parse_package_list(result.stdout)
+    known_packages = set(package_name_map.values())
+    result = await async_adb_shell(device_id, "pm list packages", timeout=30)
+    packages += [package for package in _parse_package_list(result.stdout) if package in known_packages and package not in packages]
+    return packages
+
+
+def _parse_labels(stdout):
+    """
+    The labels of an "@@package" line followed by its application-label lines, for each package.
+    """
+    labels, package, priority = {}, None, None
+    for line in stdout.splitlines():
+        line = line.strip()
+        if line.startswith("@@"):
+            package, priority = line[2:], None
+            continue
+        match = _label_pattern.match(line)
+        if package is None or match is None or len(match.group(2)) == 0:
+            continue
+        # -zh-CN before -zh before the default label
+        line_priority = {"-zh-CN": 0, "-zh": 1, None: 2}[match.group(1)]
+        if priority is None or line_priority < priority:
+            labels[package], priority = match.group(2), line_priority
+    return labels
+
+
+async def _async_dump_labels(device_id, packages):
+    """
+    The labels of the packages, dumped once per scan with the aapt of the device; empty if it has none,
+    the derived labels are used then.
+    """
+    known_packages = set(package_name_map.values())
+    packages = [package for package in packages if package not in known_packages]
+    if len(packages) == 0:
+        return {}
+
+    result = await async_adb_shell(device_id, "pm list packages -f", timeout=30)
+    apk_paths = {}
+    for line in _parse_package_list(result.stdout):
+        # /data/app/~~abc==/com.foo-xyz==/base.apk=com.foo, the path may hold a "=" too
+        path, _, package = line.rpartition("=")
+        apk_paths[package] = path
+
+    labels = {}
+    aapt = f'$(command -v aapt || echo {shlex.quote(_device_aapt)})'
+    for i in range(0, len(packages), _LABEL_BATCH_SIZE):
+        commands = [f"aapt={aapt}", '[ -x "$aapt" ] || exit 0']
+        for package in packages[i:i + _LABEL_BATCH_SIZE]:
+            if package in apk_paths:
+                commands.append(f'echo @@{package}; "$aapt" dump badging {shlex.quote(apk_paths[package])} 2>/dev/null | grep "^application-label"')
+        result = await async_adb_shell(device_id, "; ".join(commands), timeout=60)
+        labels.update(_parse_labels(result.stdout))
+    return labels
+
+
+async def async_get_installed_packages(device_id, force_refresh=False):
+    """
+    Get the launchable packages of the device, from memory, then from the disk cache, then from a scan.
+    """
+    return (await async_get_installed_apps(device_id, force_refresh))["packages"]
+
+
+async def async_get_installed_apps(device_id, force_refresh=False):
+    """
+    The cache entry of the launchable packages of the device and their labels, see async_get_installed_packages.
+    """
+    with _lock:
+        entry = _installed_packages.get(device_id, None)
+    if entry is None and not force_refresh:
+        entry = _load_cache(device_id)
+
+    if force_refresh or entry is None or time.time() - entry["updated_at"] > _CACHE_TTL:
+        packages = await _async_scan_packages(device_id)
+        if len(packages) == 0:
+            # a failed scan must not wipe a good cache
+            print(f"No packages listed on device {device_id}, keeping the previous scan")
+            if entry is None:
+                return {"packages": [], "labels": {}}
+        else:
+            labels = await _async_dump_labels(device_id, packages)
+            entry = {"version": _CACHE_VERSION, "updated_at": time.time(), "packages": packages, "labels": labels}
+            _save_cache(device_id, entry)
+
+    with _lock:
+        if _installed_packages.get(device_id, None) is not entry:
+            _installed_packages[device_id] = entry
+            _device_resolvers.pop(device_id, None)
+    return entry
+
+
+def get_installed_packages(device_id, force_refresh=False):
+    return run_sync(async_get_installed_packages(device_id, force_refresh))
+
+
+async def _async_get_device_resolver(device_id, force_refresh=False):
+    entry = await async_get_installed_apps(device_id, force_refresh)
+    with _lock:
+        resolver = _device_resolvers.get(device_id, None)
+        if resolver is None:
+            resolver = _build_device_resolver(entry["packages"], entry["labels"])
+            _device_resolvers[device_id] = resolver
+    return resolver, set(entry["packages"])
+
+
+async def async_find_installed_package_name(app_name, device_id, min_score=0.5):
+    """
+    Find the package name of an app installed on the device, None if no installed app matches.
+
+    The static package_name_map wins when its match is installed; otherwise the launchable apps are searched
+    by label, then by derived label. A miss re-scans the device, at most once per _MIN_REFRESH_INTERVAL.
+    """
+    static_package, static_app_name, static_score = get_app_name_resolver().resolve(app_name)
+
+    for attempt in range(2):
+        resolver, installed = await _async_get_device_resolver(device_id, force_refresh=attempt > 0)
+        if len(installed) == 0:
+            # the device could not be scanned, trust the static map as before
+            break
+
+        if static_package in installed and static_score >= min_score:
+            return static_package
+
+        package_name, matched_app_name, score = resolver.resolve(app_name)
+        if package_name is not None and score >= min_score:
+            return package_name
+
+        with _lock:
+            updated_at = _installed_packages[device_id]["updated_at"]
+        if attempt > 0 or time.time() - updated_at < _MIN_REFRESH_INTERVAL:
+            print(f"App {app_name} is not installed on device {device_id}, best match: {matched_app_name} ({score:.2f})")
+            return None
+
+    if static_package is None or static_score < min_score:
+        return None
+    return static_package
+
+
+def find_installed_package_name(app_name, device_id, min_score=0.5):
+    return run_sync(async_find_installed_package_name(app_name, device_id, min_score))
+
+
+def get_installed_app_names(device_id):
+    """
+    Get the names of the launchable apps of the device, names of package_name_map first, then their labels,
+    derived from the package name for the apps whose label could not be dumped.
+    """
+    entry = run_sync(async_get_installed_apps(device_id))
+    packages, labels = entry["packages"], entry["labels"]
+    installed = set(packages)
+    known_packages = set()
+    app_names = []
+    for app_name, package in package_name_map.items():
+        if package in installed:
+            app_names.append(app_name)
+            known_packages.add(package)
+    app_names += [labels.get(package, None) or derive_app_label(package) for package in packages if package not in known_packages]
+    return app_names
+
+
+if __name__ == "__main__":
+    # python copilot_front_end/installed_apps.py <device_id> [app_name ...]
+    device_id = sys.argv[1]
+    app_names = sys.argv[2:] or ["抖音", "微信", "settings"]
+
+    for force_refresh in [True, False]:
+        start_time = time.perf_counter()
+        packages = get_installed_packages(device_id, force_refresh=force_refresh)
+        print(f"{len(packages)} packages, force_refresh={force_refresh}: {1000 * (time.perf_counter() - start_time):.1f}ms")
+
+    for app_name in app_names:
+        print(f"{app_name}: {find_installed_package_name(app_name, device_id)}")
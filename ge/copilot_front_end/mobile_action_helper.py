@@ -7,12 +7,23 @@ from uuid import uuid4
 if "." not in sys.path:
     sys.path.append(".")
 from copilot_front_end.package_map import find_package_name
+from copilot_front_end.adb_session import adb_shell, adb_push, add_reconnect_callback
+from copilot_front_end.device_property_cache import get_property_cache, invalidate_after_action, invalidate_after_power_key, invalidate_on_reconnect
+from copilot_front_end.screen_settle import settle_enabled, wait_after_action
 
 import time
 from tqdm import tqdm
 
 from megfile import smart_copy
 
+from tools.async_runner import run_sync
+from copilot_front_end.async_executor import _SUPPORTED_CAPTURE_MODES, set_capture_mode, get_capture_mode, _get_device_registry
+from copilot_front_end.async_executor import async_capture_screenshot_bytes, async_capture_screenshot_image, async_capture_screenshot_raw, async_capture_screenshot_frame
+from copilot_front_end.async_executor import async_dectect_screen_on, async_get_device_wm_size
+
+# cached device properties are dropped when the shell session of the device has to reconnect
+add_reconnect_callback(invalidate_on_reconnect)
+
 def _get_adb_command(device_id=None):
     """
     Get the ADB command for the specified device ID.
@@ -20,7 +31,11 @@ def _get_adb_command(device_id=None):
     if device_id is None:
         adb_command = "adb "
     else:
-        assert device_id in list_devices(), f"Device {device_id} not found in connected devices."
+        registry = _get_device_registry()
+        if not registry.is_connected(device_id):
+            # the device may have been connected a moment ago, ask the adb server once before failing
+            registry.refresh()
+        assert registry.is_connected(device_id), f"Device {device_id} not found in connected devices."
         adb_command = f"adb -s {device_id} "
     return adb_command
 
@@ -53,15 +68,11 @@ def close_app_on_device(device_id, app_name, print_command = False):
     """
     adb_command = _get_adb_command(device_id)
     
-    package_name = find_package_name(app_name)
+    package_name = find_package_name(app_name, device_id=device_id)
     if package_name is None:
-        raise ValueError(f"App {app_name} not found in package map.")
+        raise ValueError(f"App {app_name} not found on device {device_id}.")
     
-    command = f"{adb_command} shell am force-stop {package_name}"
-    if print_command:
-        print(f"Executing command: {command}")
-    
-    subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
+    adb_shell(device_id, f"am force-stop {package_name}", print_command=print_command)
 
 def press_home_key(device_id, print_command = False):
     """
@@ -69,11 +80,7 @@ def press_home_key(device_id, print_command = False):
     """
     adb_command = _get_adb_command(device_id)
     
-    command = f"{adb_command} shell input keyevent 3"
-    if print_command:
-        print(f"Executing command: {command}")
-    
-    subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
+    adb_shell(device_id, "input keyevent 3", print_command=print_command)
 
 def init_device(device_id, print_command = False):
     """
@@ -83,21 +90,12 @@ def init_device(device_id, print_command = False):
     
     # adb -s DEVICE_ID shell ls /data/local/tmp 
     # except yadb 
-    command = f"{adb_command} shell md5sum /data/local/tmp/yadb"
-    if print_command:
-        print(f"Executing command: {command}")
-    
-    result = subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
+    result = adb_shell(device_id, "md5sum /data/local/tmp/yadb", print_command=print_command)
     if "29a0cd3b3adea92350dd5a25594593df" not in result.stdout:
         # to push yadb into the device
-        command = f"{adb_command} push yadb /data/local/tmp"
         print(f"YADB is not installed on the device. Installing now...")
 
-        if print_command:
-            # print(f"Executing command: {command}")
-            print(f"Executing command: {command}")
-
-        subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
+        adb_push(device_id, "yadb", "/data/local/tmp", print_command=print_command)
     else:
         print("yadb is already installed on the device.")
 
@@ -116,38 +114,7 @@ def dectect_screen_on(device_id, print_command = False):
     """
     Detect whether the screen is on for the specified device.
     """
-    adb_command = _get_adb_command(device_id)
-    
-    # adb shell dumpsys display | grep mScreenState
-
-    #duplicate the command, support win platform
-    # command = f"{adb_command} shell dumpsys display | grep mScreenState"
-    # if print_command:
-    #     print(f"Executing command: {command}")
-    
-    # result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    # screen_state = result.stdout.strip()
-
-
-    if sys.platform == "win32":
-        # On Windows, we need to decode the output
-        command = f"{adb_command} shell dumpsys display"
-        if print_command:
-            print(f"Executing command: {command}")
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
-        # result.stdout = result.stdout.encode('utf-8').decode('utf-8')
-        screen_state = local_str_grep(result.stdout, "mScreenState").strip()
-    else:
-        command = f"{adb_command} shell dumpsys display | grep mScreenState"
-        if print_command:
-            print(f"Executing command: {command}")
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
-        screen_state = result.stdout.strip()
-    
-    if "ON" in screen_state:
-        return True
-    else:
-        return False
+    return run_sync(async_dectect_screen_on(device_id, print_command=print_command))
 
 def press_power_key(device_id, print_command = False):
     """
@@ -155,11 +122,8 @@ def press_power_key(device_id, print_command = False):
     """
     adb_command = _get_adb_command(device_id)
     
-    command = f"{adb_command} shell input keyevent 26"
-    if print_command:
-        print(f"Executing command: {command}")
-    
-    subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
+    adb_shell(device_id, "input keyevent 26", print_command=print_command)
+    invalidate_after_power_key(device_id)
 
 def swipe_up_to_unlock(device_id, wm_size=(1000,2000), print_command = False):
     """
@@ -171,20 +135,19 @@ def swipe_up_to_unlock(device_id, wm_size=(1000,2000), print_command = False):
     y_start = int(wm_size[1] * 0.9)
     y_end = int(wm_size[1] * 0.2)
 
-    command = f"{adb_command} shell input swipe {x} {y_start} {x} {y_end}"
-    if print_command:
-        print(f"Executing command: {command}")
-    subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
+    adb_shell(device_id, f"input swipe {x} {y_start} {x} {y_end}", print_command=print_command)
 
 def get_manufacturer(device_id):
     """
     Get the manufacturer of the specified device.
     """
     adb_command = _get_adb_command(device_id)
-    command = f"{adb_command} shell getprop ro.product.manufacturer"
-    result = subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
-    manufacturer = result.stdout.strip().lower()
-    return manufacturer
+    def query_manufacturer():
+        result = adb_shell(device_id, "getprop ro.product.manufacturer")
+        manufacturer = result.stdout.strip().lower()
+        return manufacturer
+
+    return get_property_cache().get(device_id, "manufacturer", query_manufacturer)
 
 def _open_screen(device_id, print_command = False):
     """
@@ -219,44 +182,50 @@ def list_devices():
     """
     List all connected mobile devices.
     """
-    try:
-        result = subprocess.run(['adb', 'devices'], capture_output=True, text=True)
-        devices = result.stdout.splitlines()[1:]
-        devices = [line.split()[0].strip() for line in devices if line.strip() and 'device' in line]
-        return devices
-    except Exception as e:
-        print(f"Error listing devices: {e}")
-        return []
+    return _get_device_registry().list_devices()
+
+def capture_screenshot_bytes(device_id, print_command = False):
+    """
+    Capture a screenshot of the specified device as PNG bytes.
+    The image is streamed over the stdout of `adb exec-out`, neither the device nor the local filesystem is touched.
+    """
+    return run_sync(async_capture_screenshot_bytes(device_id, print_command=print_command))
+
+def capture_screenshot_image(device_id, print_command = False):
+    """
+    Capture a screenshot of the specified device as a decoded PIL Image.
+    """
+    return run_sync(async_capture_screenshot_image(device_id, print_command=print_command))
+
+def capture_screenshot_raw(device_id, print_command = False):
+    """
+    Capture the uncompressed framebuffer of the specified device.
+    :return: (pixels, raw_mode) as returned by decode_raw_screencap, None if the framebuffer format is unknown.
+    """
+    return run_sync(async_capture_screenshot_raw(device_id, print_command=print_command))
+
+def capture_screenshot_frame(device_id, print_command = False):
+    """
+    Capture a screenshot of the specified device as a decoded PIL Image (RGB or RGBX), with the capture mode of the device.
+    """
+    return run_sync(async_capture_screenshot_frame(device_id, print_command=print_command))
 
 def _capture_save_screenshot(device_id, tmp_file_dir="tmp_screenshot", image_name = None, print_command = False):
     if not os.path.exists(tmp_file_dir):
         os.makedirs(tmp_file_dir)
         print(f"Created temporary directory: {tmp_file_dir}")
     
-    adb_command = _get_adb_command(device_id)
-    
     if image_name is None:
         screen_shot_pic_name = f"uuid_{uuid4()}.png"
+    else:
+        screen_shot_pic_name = image_name
     
     screen_shot_pic_path = os.path.join(tmp_file_dir, screen_shot_pic_name)
     try:
-        # result = subprocess.run([adb_command, 'shell', 'screencap', '-p'], capture_output=True, text=True)
-        command = f"{adb_command} shell screencap -p /sdcard/{screen_shot_pic_name}"
-        if print_command:   
-            print(f"Executing command: {command}")
-        subprocess.run(command, shell=True, capture_output=True, text=True)
-
-        # time.sleep(0.2)
-
-        command = f"{adb_command} pull /sdcard/{screen_shot_pic_name} {screen_shot_pic_path}"
-        if print_command:
-            print(f"Executing command: {command}")
-        subprocess.run(command, shell=True, capture_output=True, text=True)
+        image_bytes = capture_screenshot_bytes(device_id, print_command=print_command)
 
-        remove_command = f"{adb_command} shell rm /sdcard/{screen_shot_pic_name}"
-        if print_command:
-            print(f"Executing command: {remove_command}")
-        subprocess.run(remove_command, shell=True, capture_output=True, text=True)
+        with open(screen_shot_pic_path, "wb") as f:
+            f.write(image_bytes)
 
         return screen_shot_pic_path
     except Exception as e:
@@ -275,36 +244,9 @@ def capture_screenshot(device_id, tmp_file_dir="tmp_screenshot", image_name = No
 
 def get_device_wm_size(device_id):
     """
-    Get the screen size of the specified device.
+    Get the screen size of the specified device, cached until the device reconnects.
     """
-    
-
-    adb_command = _get_adb_command(device_id)
-    try:
-        # result = subprocess.run([adb_command, 'shell', 'wm', 'size'], capture_output=True, text=True)
-        command = f"{adb_command} shell wm size"
-
-        # print(f"Getting device {device_id} wm size with command: {command}")
-
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-
-        result_str = result.stdout.strip()
-        
-        assert "Physical size:" in result_str or "Override size:" in result_str, f"Unexpected wm size output: {result_str}"
-
-        if "override size" in result_str.lower():
-            size = result_str.split('Override size:')[1].strip()
-        else:
-            size = result_str.split('Physical size:')[1].strip()
-
-        size = size.split('x')
-        if "\n" in size[1]:
-            size[1] = size[1].split("\n")[0]
-        size = (int(size[0]), int(size[1]))
-        return size
-    except Exception as e:
-        print(f"Error getting device size: {e}")
-        return None
+    return run_sync(async_get_device_wm_size(device_id))
 
 # convert model action from api to a front-end action
 def model_act2front_act(act, wm_size):
@@ -511,11 +453,15 @@ def normlize_point(point, wm_size):
     return real_world_point
 
 
-def act_on_device(device_id, action, print_command = False, refush_app = True, device_wm_size = None):
+def act_on_device(device_id, action, print_command = False, refush_app = True, device_wm_size = None, settle_config = None):
     """
     Perform an action on a specific device.
+    The waits inside the action wait for the screen to settle with settle_config, if given, instead of fixed sleeps.
     """
-    adb_command = _get_adb_command(device_id)
+    _get_adb_command(device_id)
+
+    # the command line to run in the device shell, None for actions without device interaction
+    shell_command = None
 
     if action['action_type'] == "Click":
 
@@ -524,34 +470,31 @@ def act_on_device(device_id, action, print_command = False, refush_app = True, d
         else:
             normalized_point = action['args']['normalized_point']
             real_point = (int(normalized_point[0] * device_wm_size[0]), int(normalized_point[1] * device_wm_size[1]))
-        adb_command += f" shell input tap {real_point[0]} {real_point[1]}"
+        shell_command = f"input tap {real_point[0]} {real_point[1]}"
 
     
-        # print(f"Executing command: {adb_command}")
+        # print(f"Executing command: {shell_command}")
     elif action['action_type'] == "Awake":
         app_name = action['args']['text']
 
-        package_name = find_package_name(app_name)
+        package_name = find_package_name(app_name, device_id=device_id)
         
         if package_name is None:
-            raise ValueError(f"App {app_name} not found in package map.")
+            raise ValueError(f"App {app_name} not found on device {device_id}.")
         # adb shell monkey -p com.sankuai.meituan -c android.intent.category.LAUNCHER 1
 
         if refush_app:
-            refush_command = f"{adb_command} shell am force-stop {package_name}"
-            if print_command:
-                print(f"Executing command: {refush_command}")
-            subprocess.run(refush_command, shell=True, capture_output=True, text=True)
+            adb_shell(device_id, f"am force-stop {package_name}", print_command=print_command)
+            wait_after_action(device_id, "FORCE_STOP", settle_config, fixed_wait=2)
+        elif not settle_enabled(settle_config):
+            time.sleep(2)
 
         # else:
-        adb_command = f"{adb_command} shell monkey -p {package_name} -c android.intent.category.LAUNCHER 1"
-        time.sleep(2)
-
-        # adb_command += f" shell monkey -p {package_name} -c android.intent.category.LAUNCHER 1"
+        shell_command = f"monkey -p {package_name} -c android.intent.category.LAUNCHER 1"
 
     elif action['action_type'] == "Type":
         text = action['args']['text']
-        # adb_command += f" shell input text '{text}'"
+        # shell_command = f"input text '{text}'"
         # adb shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -keyboard 你好，世界
 
         if device_wm_size is None:
@@ -561,11 +504,11 @@ def act_on_device(device_id, action, print_command = False, refush_app = True, d
             point = (int(normalized_point[0] * device_wm_size[0]), int(normalized_point[1] * device_wm_size[1]))
             
         if "keyboard_exists" in action['args'] and not action['args']['keyboard_exists']:
-            click_commmand = f"{adb_command} shell input tap {point[0]} {point[1]}"
-            subprocess.run(click_commmand, shell=True, capture_output=True, text=True)
+            adb_shell(device_id, f"input tap {point[0]} {point[1]}", print_command=print_command)
+            wait_after_action(device_id, "FOCUS_BEFORE_TYPE", settle_config)
 
 
-        adb_command += f' shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -keyboard "{text}"'
+        shell_command = f'app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -keyboard "{text}"'
 
     elif action['action_type'] == "Pop":
         pass
@@ -584,7 +527,7 @@ def act_on_device(device_id, action, print_command = False, refush_app = True, d
             path = [(int(normalized_path[0][0] * device_wm_size[0]), int(normalized_path[0][1] * device_wm_size[1])),
                     (int(normalized_path[1][0] * device_wm_size[0]), int(normalized_path[1][1] * device_wm_size[1]))]
 
-        adb_command += f" shell input swipe {path[0][0]} {path[0][1]} {path[1][0]} {path[1][1]} 1000"
+        shell_command = f"input swipe {path[0][0]} {path[0][1]} {path[1][0]} {path[1][1]} 1000"
 
     elif action['action_type'] == "LongPress":
         # adb shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -touch 500 500 2000
@@ -595,7 +538,7 @@ def act_on_device(device_id, action, print_command = False, refush_app = True, d
             normalized_point = action['args']['normalized_point']
             point = (int(normalized_point[0] * device_wm_size[0]), int(normalized_point[1] * device_wm_size[1]))
 
-        adb_command += f" shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -touch {point[0]} {point[1]} 2000"
+        shell_command = f"app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -touch {point[0]} {point[1]} 2000"
 
     elif action['action_type'] == "Abort":
 
@@ -609,10 +552,12 @@ def act_on_device(device_id, action, print_command = False, refush_app = True, d
     else:
         raise ValueError(f"Invalid action type: {action['action_type']}")
 
-    if print_command:
-        print(f"Executing command: {adb_command}")
+    if shell_command is None:
+        return
+
+    result = adb_shell(device_id, shell_command, print_command=print_command)
 
-    result = subprocess.run(adb_command, shell=True, capture_output=True, text=True)
+    invalidate_after_action(device_id, action['action_type'])
 
     if print_command:
         print(f"Command output: {result.stdout}")
@@ -213,31 +213,155 @@ package_name_map = {
 }
 
 import difflib 
+from functools import lru_cache
 
-def find_package_name(app_name):
-    app_name_lowered = app_name.lower()
-    package_name = package_name_map.get(app_name_lowered, None)
-    
-    max_match = {
-        "name": None,
-        "score": 0
-    }
-    
-    if package_name is None:
-        # to search a similar app name
-        for key in package_name_map.keys():
-            # Use the lowercase input for comparison
-            score = difflib.SequenceMatcher(None, app_name_lowered, key.lower()).ratio() 
-            
-            if score > max_match["score"]:
-                max_match["name"] = key
-                max_match["score"] = score
-        
-        # Check if a match was found with a score > 0 (or some threshold, though the assert below only checks if name is not None)
-        assert max_match['name'] is not None, f"Cannot find package name for app {app_name}"
-        
-        # We retrieve the actual package name using the original (correctly cased) key from the map
-        package_name = package_name_map[max_match['name']]
+try:
+    # optional, to match pinyin queries such as "douyin" or "zhihu" against chinese app names
+    from pypinyin import lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+# alias -> app name in package_name_map, for names the model often uses but fuzzy matching can not guess
+app_name_aliases = {
+    "weather": "天气",
+    "calculator": "计算器",
+    "douyin": "抖音",
+    "tiktok": "抖音",
+    "zhihu": "知乎",
+    "didi": "滴滴出行",
+    "滴滴": "滴滴出行",
+    "eleme": "饿了么",
+    "tieba": "百度贴吧",
+    "youku": "优酷视频",
+    "优酷": "优酷视频",
+    "fliggy": "飞猪旅行",
+    "飞猪": "飞猪旅行",
+    "有道词典": "网易有道词典",
+    "osmand": "osmAnd",
+}
+
+
+def _normalize_app_name(app_name):
+    return "".join(app_name.lower().split())
+
+
+def _char_ngrams(text, ngram_size):
+    """
+    Character n-grams of the text padded with spaces, so that short names and name boundaries are indexed too.
+    """
+    padded = f" {text} "
+    if len(padded) <= ngram_size:
+        return set([padded])
+    return set([padded[i:i + ngram_size] for i in range(len(padded) - ngram_size + 1)])
+
+
+class AppNameResolver:
+    """
+    Resolve a free-form app name to a package name.
+
+    Exact names and aliases are dict lookups; other queries are scored with difflib only against the
+    few names sharing character n-grams with the query. Results are memoized in a bounded LRU.
+    """
+
+    def __init__(self, name_map, aliases=None, ngram_size=2, max_candidates=8, cache_size=4096):
+        self.ngram_size = ngram_size
+        self.max_candidates = max_candidates
+
+        # normalized key -> (app name, package name), the keys are app names, aliases and their pinyin
+        self._exact = {}
+        self._keys = []
+        self._key_targets = []
+        self._ngram_index = {}
+
+        for app_name, package_name in name_map.items():
+            self._add_key(app_name, app_name, package_name)
+        for alias, app_name in (aliases or {}).items():
+            if app_name in name_map:
+                self._add_key(alias, app_name, name_map[app_name])
+
+        if lazy_pinyin is not None:
+            for app_name, package_name in name_map.items():
+                pinyin = "".join(lazy_pinyin(app_name))
+                if pinyin != app_name:
+                    self._add_key(pinyin, app_name, package_name)
+
+        self._resolve_cached = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _add_key(self, key, app_name, package_name):
+        key = _normalize_app_name(key)
+        if not key or key in self._exact:
+            return
+        self._exact[key] = (app_name, package_name)
+
+        key_idx = len(self._keys)
+        self._keys.append(key)
+        self._key_targets.append((app_name, package_name))
+        for ngram in _char_ngrams(key, self.ngram_size):
+            self._ngram_index.setdefault(ngram, []).append(key_idx)
+
+    def _resolve(self, query):
+        if query in self._exact:
+            app_name, package_name = self._exact[query]
+            return package_name, app_name, 1.0
+
+        # count the shared n-grams of every indexed key, only the best few are scored with difflib
+        overlap = {}
+        for ngram in _char_ngrams(query, self.ngram_size):
+            for key_idx in self._ngram_index.get(ngram, []):
+                overlap[key_idx] = overlap.get(key_idx, 0) + 1
+        if len(overlap) == 0:
+            return None, None, 0.0
+
+        candidates = sorted(overlap.keys(), key=lambda key_idx: -overlap[key_idx])[:self.max_candidates]
+
+        best_idx, best_score = None, 0.0
+        for key_idx in candidates:
+            score = difflib.SequenceMatcher(None, query, self._keys[key_idx]).ratio()
+            if score > best_score:
+                best_idx, best_score = key_idx, score
+
+        app_name, package_name = self._key_targets[best_idx]
+        return package_name, app_name, best_score
+
+    def resolve(self, app_name):
+        """
+        :return: (package_name, matched_app_name, score), score is 1.0 for exact and alias matches,
+            the difflib ratio of the best fuzzy match otherwise; (None, None, 0.0) if nothing is similar.
+        """
+        return self._resolve_cached(_normalize_app_name(app_name))
+
+    def cache_info(self):
+        return self._resolve_cached.cache_info()
+
+
+_app_name_resolver = None
+
+
+def get_app_name_resolver():
+    """
+    Get the resolver of package_name_map, built on first use.
+    """
+    global _app_name_resolver
+    if _app_name_resolver is None:
+        _app_name_resolver = AppNameResolver(package_name_map, app_name_aliases)
+    return _app_name_resolver
+
+
+def find_package_name(app_name, device_id=None, min_score=0.5):
+    """
+    Find the package name of the app, None if no app name is similar enough.
+    :param device_id: if given, only apps installed on the device are considered, see installed_apps.
+    :param min_score: the minimum confidence of a fuzzy match, see AppNameResolver.resolve.
+    """
+    if device_id is not None:
+        # imported here, the device scan needs adb while the static map does not
+        from copilot_front_end.installed_apps import find_installed_package_name
+        return find_installed_package_name(app_name, device_id, min_score=min_score)
+
+    package_name, matched_app_name, score = get_app_name_resolver().resolve(app_name)
+    if package_name is None or score < min_score:
+        print(f"Cannot find package name for app {app_name}, best match: {matched_app_name} ({score:.2f})")
+        return None
 
     return package_name
 
@@ -248,3 +372,65 @@ def get_list_of_package_names():
     """
     applications = [{"app_name": app_name, "package_name": package_name} for app_name, package_name in package_name_map.items()]
     return applications
+
+
+if __name__ == "__main__":
+    import time
+    import random
+
+    def find_package_name_linear(app_name):
+        # the previous implementation, a difflib scan over the whole map on every miss
+        app_name_lowered = app_name.lower()
+        package_name = package_name_map.get(app_name_lowered, None)
+        if package_name is None:
+            best_name, best_score = None, 0
+            for key in package_name_map.keys():
+                score = difflib.SequenceMatcher(None, app_name_lowered, key.lower()).ratio()
+                if score > best_score:
+                    best_name, best_score = key, score
+            package_name = package_name_map[best_name]
+        return package_name
+
+    def make_synthetic_query(rng, app_name):
+        chars = list(app_name)
+        mutation = rng.choice(["exact", "upper", "drop", "swap", "suffix", "prefix"])
+        if mutation == "upper":
+            return app_name.upper()
+        if mutation == "drop" and len(chars) > 2:
+            del chars[rng.randrange(len(chars))]
+        elif mutation == "swap" and len(chars) > 2:
+            i = rng.randrange(len(chars) - 1)
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+        elif mutation == "suffix":
+            chars += list(rng.choice([" app", "应用", "官方版"]))
+        elif mutation == "prefix":
+            chars = list(rng.choice(["打开", "open "])) + chars
+        return "".join(chars)
+
+    rng = random.Random(0)
+    app_names = list(package_name_map.keys())
+    queries = [make_synthetic_query(rng, rng.choice(app_names)) for _ in range(10000)]
+
+    start_time = time.perf_counter()
+    linear_results = [find_package_name_linear(query) for query in queries]
+    linear_time = time.perf_counter() - start_time
+
+    # a resolver without memoization, to measure the index itself
+    resolver = AppNameResolver(package_name_map, app_name_aliases, cache_size=0)
+    start_time = time.perf_counter()
+    indexed_results = [resolver.resolve(query) for query in queries]
+    indexed_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for query in queries:
+        find_package_name(query, min_score=0.0)
+    cached_time = time.perf_counter() - start_time
+
+    agreement = sum([linear == indexed[0] for linear, indexed in zip(linear_results, indexed_results)]) / len(queries)
+    low_confidence = sum([indexed[2] < 0.5 for indexed in indexed_results])
+
+    print(f"{len(queries)} queries over {len(package_name_map)} apps, pinyin index: {lazy_pinyin is not None}")
+    print(f"linear scan: {1e6 * linear_time / len(queries):.1f}us/query")
+    print(f"n-gram index: {1e6 * indexed_time / len(queries):.1f}us/query")
+    print(f"n-gram index + LRU: {1e6 * cached_time / len(queries):.1f}us/query, {get_app_name_resolver().cache_info()}")
+    print(f"agreement with the linear scan: {agreement:.1%}, low confidence (< 0.5): {low_confidence}")
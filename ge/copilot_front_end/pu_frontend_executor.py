@@ -2,9 +2,7 @@
 # to define some different format of parsers;
 # to define executors to execute the front-end actions;
 
-import subprocess
 import time
-import subprocess
 import os
 
 import sys
@@ -13,7 +11,8 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 # add parent directory to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from copilot_front_end.package_map import find_package_name
+from copilot_front_end.async_executor import async_act_on_device, async_detect_screen_orientation, _convert_point_to_realworld_point
+from tools.async_runner import run_sync
 
 
 def parser0729_to_frontend_action(parser_action):
@@ -180,50 +179,14 @@ def step_api_to_frontend_action(step_api_action, default_duration=1.5):
         raise ValueError(f"Unsupported action type: {action_type}")
     
 
-def _convert_point_to_realworld_point(point, wm_size):
-    x, y = point
-    real_x = (float(x) / 1000) * wm_size[0]
-    real_y = (float(y) / 1000) * wm_size[1]
-    return (real_x, real_y)
-
 def _detect_screen_orientation(device_id):
     """
-    Detect the screen orientation of the specified device.
-    adb shell dumpsys input | grep -m 1 -o -E "orientation=[0-9]" | head -n 1 | grep -m 1 -o -E "[0-9]"
+    Detect the screen orientation of the specified device, cached until a rotation-capable action is executed.
     """
-    # adb_command = _get_adb_command(device_id)
-    if device_id is None:
-        adb_command = "adb"
-    else:
-        adb_command = f"adb -s {device_id}"
-    if os.name == 'nt':
-        # Windows
-        command = f'{adb_command}' + ''' shell dumpsys input | Select-String 'orientation=\d+' | Select -First 1 | % { $_.Matches.Value -replace 'orientation=', '' }'''
-        
-        # 使用 subprocess 运行 PowerShell 命令
-        result = subprocess.run(
-            ["powershell.exe", "-Command", command],  # 核心参数
-            capture_output=True,  # 捕获 stdout/stderr（可选）
-            encoding="utf-8",     # 编码（避免乱码）
-            shell=False,          # 无需开启 shell（PowerShell 本身就是解释器）
-            check=False           # 是否抛出非0退出码异常（可选）
-        )
-
-    else:
-        # Unix/Linux/Mac
-        command = f'''{adb_command} shell dumpsys input | grep -m 1 -o -E "orientation=[0-9]" | head -n 1 | grep -m 1 -o -E "[0-9]"'''
-
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-
-
-    result_str = result.stdout.strip()
+    return run_sync(async_detect_screen_orientation(device_id))
 
-    result = int(result_str.strip())
 
-    return result
-
-
-def act_on_device(frontend_action, device_id, wm_size, print_command = False, reflush_app = True):
+def act_on_device(frontend_action, device_id, wm_size, print_command = False, reflush_app = True, settle_config = None):
     """
     Execute the frontend action on the device.
     1. # CLICK(point=(x,y))
@@ -248,223 +211,6 @@ def act_on_device(frontend_action, device_id, wm_size, print_command = False, re
         ...
     }
 
+    A blocking wrapper of async_act_on_device, the waits inside the action settle with settle_config if given.
     """
-    valid_actions = ["CLICK", "LONGPRESS", "TYPE", "SCROLL", "AWAKE", "SLIDE", "BACK", "HOME", "COMPLETE", "ABORT", "INFO", "WAIT", "HOT_KEY"]
-
-    assert "action_type" in frontend_action, "Missing action_type in frontend_action"
-    assert frontend_action["action_type"] in valid_actions, f"Invalid action type: {frontend_action['action_type']}"
-
-    action_type = frontend_action["action_type"]
-
-    if action_type == "CLICK":
-        assert "point" in frontend_action, "Missing point in CLICK action"
-
-        orientation = _detect_screen_orientation(device_id)
-
-        if orientation in [1, 3]:
-            wm_size = (wm_size[1], wm_size[0])
-
-        x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
-
-        cmd = f"adb -s {device_id} shell input tap {x} {y}"
-        if print_command:
-            print(f"Executing command: {cmd}")
-        
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-    
-    elif action_type == "LONGPRESS":
-        assert "point" in frontend_action, "Missing point in LONGPRESS action"
-        assert "duration" in frontend_action, "Missing duration in LONGPRESS action"
-        x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
-        duration = frontend_action["duration"]
-        cmd = f"adb -s {device_id} shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -touch {x} {y} {int(duration * 1000)}"
-
-        if print_command:
-            print(f"Executing command: {cmd}")
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-
-    # adb shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -keyboard "{text}"
-    elif action_type == "TYPE":
-        assert "value" in frontend_action, "Missing value in TYPE action"
-
-        value = frontend_action["value"]
-        keyboard_exists = frontend_action.get("keyboard_exists", True)
-        if not keyboard_exists:
-            if "point" in frontend_action:
-                x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
-                cmd = f"adb -s {device_id} shell input tap {x} {y}"
-                if print_command:
-                    print(f"Executing command: {cmd}")
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-                time.sleep(1)
-            else:
-                print("Warning: keyboard does not exist and point is not given. Using current focus box.")
-
-        # def preprocess_text_for_adb(text):
-        #     # Escape special characters for adb shell input
-        #     text = text.replace("\n", " ").replace("\t", " ")
-        #     text = text.replace(" ", "\\ ")
-        #     return text
-
-
-        # cmd = f"adb -s {device_id} shell app_process -Djava.class.path=/data/local/tmp/yadb /data/local/tmp com.ysbing.yadb.Main -keyboard '{preprocess_text_for_adb(value)}'"
-        
-        # Method: using ADBKeyboard broadcast intent (Requires ADBKeyboard installed and active)
-        # adb shell am broadcast -a ADB_INPUT_TEXT --es msg "text"
-        def preprocess_text_for_adb_broadcast(text):
-            # Escape double quotes which wrap the msg argument
-            text = text.replace('"', '\\"')
-            return text
-
-        processed_value = preprocess_text_for_adb_broadcast(value)
-        cmd = f'adb -s {device_id} shell am broadcast -a ADB_INPUT_TEXT --es msg "{processed_value}"'
-
-        if print_command:
-            print(f"Executing command: {cmd}")
-
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-        return result
-    
-    elif action_type == "SCROLL":
-        assert "point" in frontend_action, "Missing point in SCROLL action"
-        assert "direction" in frontend_action, "Missing direction in SCROLL action"
-        x, y = _convert_point_to_realworld_point(frontend_action["point"], wm_size)
-
-        deltax = int(0.3 * wm_size[0])
-        deltay = int(0.3 * wm_size[1])
-
-        direction = frontend_action["direction"]
-        if direction == "down":
-            x1, y1 = x, y
-            x2, y2 = x, y - deltay
-        elif direction == "up":
-            x1, y1 = x, y
-            x2, y2 = x, y + deltay
-        elif direction == "left":
-            x1, y1 = x, y
-            x2, y2 = x - deltax, y
-        elif direction == "right":
-            x1, y1 = x, y
-            x2, y2 = x + deltax, y
-        else:
-            raise ValueError(f"Invalid direction: {direction}")
-        
-        cmd = f"adb -s {device_id} shell input swipe {x1} {y1} {x2} {y2} 1200"
-        if print_command:
-            print(f"Executing command: {cmd}")
-
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-        
-    elif action_type == "AWAKE":
-        assert "value" in frontend_action, "Missing value in AWAKE action"
-        app_name = frontend_action["value"]
-        package_name = find_package_name(app_name)
-        if package_name is None:
-            raise ValueError(f"App name {app_name} not found in package map.")
-        
-        if reflush_app:
-            cmd = f"adb -s {device_id} shell am force-stop {package_name}"
-            if print_command:
-                print(f"Executing command: {cmd}")
-
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-            time.sleep(1)
-
-        cmd = f"adb -s {device_id} shell monkey -p {package_name} -c android.intent.category.LAUNCHER 1"
-        if print_command:
-            print(f"Executing command: {cmd}")
-
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-
-    elif action_type == "SLIDE":
-        assert "point1" in frontend_action, "Missing point1 in SLIDE action"
-        assert "point2" in frontend_action, "Missing point2 in SLIDE action"
-        x1, y1 = _convert_point_to_realworld_point(frontend_action["point1"], wm_size)
-        x2, y2 = _convert_point_to_realworld_point(frontend_action["point2"], wm_size)
-        
-        duration = frontend_action.get("duration", 1.5)
-        cmd = f"adb -s {device_id} shell input swipe {x1} {y1} {x2} {y2} {int(duration * 1000)}"
-        if print_command:
-            print(f"Executing command: {cmd}")
-
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-    
-    elif action_type == "BACK":
-        cmd = f"adb -s {device_id} shell input keyevent 4"
-        if print_command:
-            print(f"Executing command: {cmd}")
-
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-    
-    elif action_type == "HOME":
-        cmd = f"adb -s {device_id} shell input keyevent 3"
-        if print_command:
-            print(f"Executing command: {cmd}")
-
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-    
-    elif action_type == "COMPLETE":
-        if print_command:
-            print("Task completed.")
-        return None
-
-    elif action_type == "ABORT":
-        if print_command:
-            print("Task aborted.")
-        return None
-
-    elif action_type == "INFO":
-        if print_command:
-            print("Info action executed.")
-        return None
-
-    elif action_type == "WAIT":
-        assert "seconds" in frontend_action, "Missing seconds in WAIT action"
-        seconds = frontend_action["seconds"]
-        if print_command:
-            print(f"Waiting for {seconds} seconds.")
-        time.sleep(seconds)
-        return None
-    
-    elif action_type == "HOT_KEY":
-        assert "key" in frontend_action, "Missing key in HOT_KEY action"
-        key = frontend_action["key"]
-        key_event_map = {
-            "volume_up": 24,
-            "volume_down": 25,
-            "power": 26,
-            "home": 3,
-            "back": 4,
-            "menu": 82,
-        }
-        if key.lower() not in key_event_map:
-            raise ValueError(f"Unsupported hot key: {key}")
-
-        key_event = key_event_map[key.lower()]
-        cmd = f"adb -s {device_id} shell input keyevent {key_event}"
-        if print_command:
-            print(f"Executing command: {cmd}")
-
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding='utf-8')
-
-        return result
-
-    else:
-        raise ValueError(f"Unsupported action type: {action_type}")    
-    
-        
-
+    return run_sync(async_act_on_device(frontend_action, device_id, wm_size, print_command=print_command, reflush_app=reflush_app, settle_config=settle_config))
@@ -0,0 +1,319 @@
+import io
+import os
+import sys
+import gzip
+import zlib
+import time
+import asyncio
+
+import numpy as np
+from PIL import Image
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+from copilot_front_end.async_adb import async_adb_exec_out
+from copilot_front_end.adb_protocol import AdbProtocolError
+from copilot_front_end.device_property_cache import note_frame_size
+from tools.image_tools import decode_raw_screencap
+from tools.async_runner import run_sync
+
+# action type -> (min_wait, max_wait) in seconds, for both executors
+# min_wait gives the device time to start reacting, e.g. the tap animation, before frames are compared
+_DEFAULT_SETTLE_BOUNDS = {
+    "default": (0.3, 2.0),
+    # app launches are the slowest transitions
+    "AWAKE": (1.0, 4.0),
+    "Awake": (1.0, 4.0),
+    # scrolls keep moving with inertia after the swipe returns
+    "SCROLL": (0.5, 2.5),
+    "SLIDE": (0.5, 2.5),
+    "Scroll": (0.5, 2.5),
+    # the text is already committed when the broadcast returns
+    "TYPE": (0.2, 1.5),
+    "Type": (0.2, 1.5),
+    # the model asked a question or waited explicitly, nothing is moving
+    "INFO": (0.0, 0.5),
+    "WAIT": (0.0, 0.5),
+    "Wait": (0.0, 0.5),
+    # inside act_on_device: the tap focusing the input box before typing
+    "FOCUS_BEFORE_TYPE": (0.2, 1.0),
+    # inside act_on_device: the app closed by force-stop before it is launched again
+    "FORCE_STOP": (0.2, 1.0),
+}
+
+_DEFAULT_SETTLE_CONFIG = {
+    # set False to sleep the fixed delay of the caller instead, see wait_after_action
+    "enabled": True,
+    # mean absolute difference of two consecutive frames, on a 0-1 scale, below which the screen is settled
+    "threshold": 0.005,
+    # only every n-th pixel in both directions is compared
+    "subsample": 8,
+    # the pause between two frame captures
+    "poll_interval": 0.05,
+    # "socket" reads the frames from the adb server socket, whatever the adb backend, so no adb process is
+    # spawned per poll; "backend" follows GELAB_ADB_BACKEND
+    "transport": "socket",
+    # gzip the raw framebuffer on the device, a mostly flat UI shrinks about tenfold; it costs device CPU,
+    # so it only pays off over slow links (USB 2, adb over Wi-Fi), compare with benchmark_settle_poll
+    "compress": False,
+    # per action type overrides of _DEFAULT_SETTLE_BOUNDS, e.g. {"AWAKE": [1.5, 6.0]}
+    "bounds": {},
+}
+
+def settle_enabled(settle_config):
+    """
+    Whether the caller waits for the screen to settle: only when a settle_config is given and not disabled.
+    """
+    return settle_config is not None and settle_config.get("enabled", True)
+
+
+def _merge_settle_config(settle_config):
+    merged = dict(_DEFAULT_SETTLE_CONFIG)
+    if settle_config is not None:
+        merged.update(settle_config)
+    return merged
+
+
+def get_settle_bounds(action_type, settle_config=None):
+    """
+    Get (min_wait, max_wait) of the action type.
+    """
+    config = _merge_settle_config(settle_config)
+    bounds = config.get("bounds", {})
+
+    if action_type in bounds:
+        min_wait, max_wait = bounds[action_type]
+    elif "default" in bounds:
+        min_wait, max_wait = _DEFAULT_SETTLE_BOUNDS.get(action_type, bounds["default"])
+    else:
+        min_wait, max_wait = _DEFAULT_SETTLE_BOUNDS.get(action_type, _DEFAULT_SETTLE_BOUNDS["default"])
+
+    assert 0 <= min_wait <= max_wait, f"Invalid settle bounds for {action_type}: {(min_wait, max_wait)}"
+    return min_wait, max_wait
+
+
+def _decode_png_settle_frame(png_bytes, subsample):
+    image = Image.open(io.BytesIO(png_bytes))
+    image.draft("RGB", (image.width // subsample, image.height // subsample))
+    image = image.convert("RGB").reduce(subsample)
+    return np.asarray(image, dtype=np.int16)
+
+
+# device id -> the capture options which failed on the device, e.g. {"compress"} without a gzip
+_unsupported_capture_options = {}
+
+
+async def _async_capture_raw_screencap(device_id, transport, compress):
+    backend = "socket" if transport == "socket" else None
+    if not compress:
+        return await async_adb_exec_out(device_id, "screencap", backend=backend)
+
+    compressed = await async_adb_exec_out(device_id, "screencap | gzip -1", backend=backend)
+    if not compressed.startswith(b"\x1f\x8b"):
+        raise ValueError(f"No gzip output, {len(compressed)} bytes")
+    return await asyncio.to_thread(gzip.decompress, compressed)
+
+
+async def async_capture_settle_frame(device_id, subsample=8, transport="socket", compress=False):
+    """
+    Capture a low resolution frame for change detection, as an int16 array of (h // subsample, w // subsample, 3).
+    The raw framebuffer is subsampled with a strided view, nothing is decoded at full resolution.
+    The options failing on the device, the socket transport or the compression, are dropped for the next captures.
+    """
+    unsupported = _unsupported_capture_options.setdefault(device_id, set())
+    while True:
+        transport = "backend" if "transport" in unsupported else transport
+        compress = compress and "compress" not in unsupported
+        try:
+            raw_bytes = await _async_capture_raw_screencap(device_id, transport, compress)
+            break
+        except (ValueError, EOFError, zlib.error, gzip.BadGzipFile) as e:
+            # before OSError, BadGzipFile is one
+            if not compress:
+                raise
+            print(f"Settle frames of device {device_id} cannot be compressed, capturing them uncompressed: {e}")
+            unsupported.add("compress")
+        except (OSError, AdbProtocolError) as e:
+            if transport != "socket":
+                raise
+            print(f"Settle frames of device {device_id} cannot be read from the adb server socket, using the adb backend: {e}")
+            unsupported.add("transport")
+
+    raw_frame = decode_raw_screencap(raw_bytes)
+    if raw_frame is not None:
+        pixels = raw_frame[0]
+        frame = pixels[::subsample, ::subsample, :3].astype(np.int16)
+    else:
+        # unknown framebuffer format, decode a PNG at reduced size instead
+        png_bytes = await async_adb_exec_out(device_id, "screencap -p")
+        frame = await asyncio.to_thread(_decode_png_settle_frame, png_bytes, subsample)
+
+    # a rotation during the wait drops the cached orientation
+    note_frame_size(device_id, frame.shape[1], frame.shape[0])
+    return frame
+
+
+def capture_settle_frame(device_id, subsample=8, transport="socket", compress=False):
+    return run_sync(async_capture_settle_frame(device_id, subsample, transport, compress))
+
+
+def frame_difference(frame1, frame2):
+    """
+    Mean absolute difference of two frames on a 0-1 scale, 1.0 if their sizes differ (e.g. after a rotation).
+    """
+    if frame1.shape != frame2.shape:
+        return 1.0
+    return float(np.abs(frame1 - frame2).mean()) / 255.0
+
+
+async def async_wait_for_screen_settle(device_id, action_type=None, settle_config=None):
+    """
+    Wait until the screen of the device stops changing after an action.
+
+    Waits min_wait first, then captures low resolution frames in quick succession, and returns as soon as
+    two consecutive frames differ less than the threshold, or when max_wait is reached.
+
+    :return: {"action_type", "waited", "frames", "settled", "last_difference"}
+    """
+    config = _merge_settle_config(settle_config)
+    min_wait, max_wait = get_settle_bounds(action_type, config)
+
+    start_time = time.time()
+    settle_stats = {
+        "action_type": action_type,
+        "waited": 0.0,
+        "frames": 0,
+        "settled": False,
+        "last_difference": None,
+    }
+
+    if not config["enabled"]:
+        await asyncio.sleep(max_wait)
+        settle_stats["waited"] = time.time() - start_time
+        return settle_stats
+
+    if min_wait > 0:
+        await asyncio.sleep(min_wait)
+
+    deadline = start_time + max_wait
+    last_frame = None
+    while time.time() < deadline:
+        try:
+            frame = await async_capture_settle_frame(device_id, config["subsample"], config["transport"], config["compress"])
+        except Exception as e:
+            # the settle detection is best effort, fall back to waiting out the max_wait
+            print(f"Error capturing settle frame on device {device_id}: {e}")
+            await asyncio.sleep(max(0.0, deadline - time.time()))
+            break
+        settle_stats["frames"] += 1
+
+        if last_frame is not None:
+            difference = frame_difference(last_frame, frame)
+            settle_stats["last_difference"] = difference
+            if difference < config["threshold"]:
+                settle_stats["settled"] = True
+                break
+
+        last_frame = frame
+        await asyncio.sleep(min(config["poll_interval"], max(0.0, deadline - time.time())))
+
+    settle_stats["waited"] = time.time() - start_time
+    return settle_stats
+
+
+def wait_for_screen_settle(device_id, action_type=None, settle_config=None):
+    """
+    Sync version of async_wait_for_screen_settle.
+    """
+    return run_sync(async_wait_for_screen_settle(device_id, action_type, settle_config))
+
+
+async def async_wait_after_action(device_id, action_type, settle_config=None, fixed_wait=0.0):
+    """
+    Sleep the fixed_wait of the caller, or wait for the screen to settle when settle_config enables it.
+    :return: the stats of async_wait_for_screen_settle, None after the fixed sleep.
+    """
+    if not settle_enabled(settle_config):
+        if fixed_wait > 0:
+            await asyncio.sleep(fixed_wait)
+        return None
+    return await async_wait_for_screen_settle(device_id, action_type, settle_config)
+
+
+def wait_after_action(device_id, action_type, settle_config=None, fixed_wait=0.0):
+    """
+    Sync version of async_wait_after_action.
+    """
+    if not settle_enabled(settle_config):
+        if fixed_wait > 0:
+            time.sleep(fixed_wait)
+        return None
+    return wait_for_screen_settle(device_id, action_type, settle_config)
+
+
+def benchmark_settle_poll(device_id, rounds=20, subsample=8):
+    """
+    Compare the capture options of the settle frames, the time of one capture bounds the poll interval.
+    """
+    async def capture(transport, compress):
+        raw_frame = decode_raw_screencap(await _async_capture_raw_screencap(device_id, transport, compress))
+        assert raw_frame is not None, "Unknown framebuffer format"
+        return raw_frame[0][::subsample, ::subsample, :3].astype(np.int16)
+
+    for transport, compress in [("backend", False), ("socket", False), ("socket", True)]:
+        try:
+            run_sync(capture(transport, compress))
+        except Exception as e:
+            print(f"[settle poll] transport={transport}, compress={compress}: failed, {e}")
+            continue
+
+        latencies = []
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            run_sync(capture(transport, compress))
+            latencies.append(time.perf_counter() - start_time)
+        latencies.sort()
+        print(f"[settle poll] transport={transport}, compress={compress}: "
+              f"mean_ms={1000 * sum(latencies) / len(latencies):.1f}, p50_ms={1000 * latencies[len(latencies) // 2]:.1f}, "
+              f"frames_per_s={len(latencies) / sum(latencies):.1f}")
+
+
+if __name__ == "__main__":
+    # python copilot_front_end/screen_settle.py [device_id]
+    # taps nothing, it only measures how long a settle frame and the current screen take
+    # without a device id, the frames come from a local stand-in adb server, "backend" needs a real adb
+    device_id = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if device_id is None:
+        import struct
+        import tempfile
+
+        # a 1080x2400 RGBA UI: flat background, a few bars, a noisy photo area
+        pixels = np.full((2400, 1080, 4), 245, dtype=np.uint8)
+        pixels[:180] = (30, 120, 220, 255)
+        pixels[400:1400:100, 60:1020] = (60, 60, 60, 255)
+        pixels[1500:2100, 60:1020] = np.random.default_rng(0).integers(0, 256, (600, 960, 4), dtype=np.uint8)
+
+        bin_dir = tempfile.mkdtemp()
+        with open(os.path.join(bin_dir, "frame.raw"), "wb") as f:
+            f.write(struct.pack("<IIII", 1080, 2400, 1, 0) + pixels.tobytes())
+        with open(os.path.join(bin_dir, "screencap"), "w") as f:
+            f.write(f"#!/bin/sh\ncat {bin_dir}/frame.raw\n")
+        os.chmod(os.path.join(bin_dir, "screencap"), 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+        from copilot_front_end.adb_protocol import _StandInAdbServer
+
+        stand_in = _StandInAdbServer()
+        os.environ["ANDROID_ADB_SERVER_PORT"] = str(stand_in.port)
+        device_id = "stand-in"
+
+        frame = capture_settle_frame(device_id)
+        assert frame.shape == (300, 135, 3) and frame_difference(frame, capture_settle_frame(device_id, compress=True)) == 0.0
+        benchmark_settle_poll(device_id)
+    else:
+        benchmark_settle_poll(device_id)
+        for action_type in ["default", "CLICK", "AWAKE", "TYPE"]:
+            settle_stats = wait_for_screen_settle(device_id, action_type)
+            print(f"{action_type}: bounds={get_settle_bounds(action_type)}, {settle_stats}")
@@ -1,5 +1,19 @@
 
 
+PROMPT_LAYOUTS = ["default", "cache_friendly"]
+
+
+def get_prompt_layout(parser_config):
+    """
+    The "prompt_layout" of a parser_config: "default", the prompt the models were trained with, or "cache_friendly":
+    a system message byte-identical across sessions, then the task, then the past steps, only ever appended to,
+    so an inference server with prefix caching reuses all but the newest turn of the step before.
+    """
+    prompt_layout = (parser_config or {}).get("prompt_layout", None) or "default"
+    assert prompt_layout in PROMPT_LAYOUTS, f"Unknown prompt_layout {prompt_layout}, should be one of {PROMPT_LAYOUTS}"
+    return prompt_layout
+
+
 class BaseParser:
     # option screen resolution: width, height
     def __init__(self, parser_config: dict):
@@ -20,3 +34,41 @@ class BaseParser:
 
     def get_tools(self):
         return None
+
+    def make_stream_parser(self):
+        """
+        An object whose feed(delta) returns the action once a streamed response holds all of it, None if not supported.
+        """
+        return None
+
+    def make_prompt_builder(self, task, hints=[]):
+        """
+        A PromptBuilder of the messages asked at each step of one session, fed one step at a time.
+        """
+        return PromptBuilder(self, task, hints)
+
+
+class PromptBuilder:
+    """
+    Builds the same messages as env2messages4ask, one session step at a time: append(environment, action) once
+    a step is done, build(current_environment) to get the messages of the next one.
+
+    The leading kept_prefix messages of a build are the very objects of the build of the step before, so a caller
+    may reuse what it derived from them and only log the messages after them.
+    This one rebuilds all the messages at every step, the parsers override it to only build what a step changes.
+    """
+
+    def __init__(self, parser, task, hints=[]):
+        self.parser = parser
+        self.task = task
+        self.hints = hints
+        self.environments = []
+        self.actions = []
+        self.kept_prefix = 0
+
+    def append(self, environment, action):
+        self.environments.append(environment)
+        self.actions.append(action)
+
+    def build(self, current_environment):
+        return self.parser.env2messages4ask(self.task, self.environments + [current_environment], self.actions, hints=self.hints)
@@ -1,16 +1,41 @@
 import json
 import sys
 import os
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from copy import deepcopy
+from types import SimpleNamespace
 
-from copilot_tools.base_parser import BaseParser
+if "." not in sys.path:
+    sys.path.append(".")
+
+from copilot_tools.base_parser import BaseParser, PromptBuilder, get_prompt_layout
 from copilot_tools.tool_definitions import tools
 from copilot_tools.action_tools import action_assertion
+from copilot_tools.history_policy import HistoryPolicy, estimate_text_tokens
+
+system_prompt = """You are a mobile GUI Agent expert. You need to interact with the mobile phone based on the user's task, screen screenshots, and interaction history to complete the user's task.
+Please keep in mind that the mobile screen coordinate system has the top-left corner as the origin, the x-axis to the right, and the y-axis down, with values ranging from 0-1000.
+
+# Action Principles:
+1. You need to strictly follow the user's instructions.
+2. You must use the provided tools to interact with the device.
+3. Before calling a tool, you MUST analyze the current state and plan your action. Output your thought process first, then call the tool.
+"""
 
 class FunctionCallParser(BaseParser):
     def __init__(self, parser_config: dict = None):
         super().__init__(parser_config if parser_config else {})
+        # how the messages are laid out, see get_prompt_layout
+        self.prompt_layout = get_prompt_layout(self.parser_config)
+        # which screenshots and turns of the past steps are sent, see HistoryPolicy
+        history_policy = self.parser_config.get("history_policy", None)
+        if self.prompt_layout == "cache_friendly":
+            # a past step is sent the same way from the next step on, so it never keeps its screenshot
+            history_policy = dict({"max_images": 0}, **(history_policy or {}))
+        self.history_policy = HistoryPolicy.from_config(history_policy)
+        if self.prompt_layout == "cache_friendly":
+            assert self.history_policy.is_append_only() and self.history_policy.max_images == 0, \
+                "the cache_friendly prompt_layout takes no max_images, max_turns or max_prompt_tokens"
 
     def action_assertion(self, action: dict):
         action_assertion(action)
@@ -21,6 +46,9 @@ class FunctionCallParser(BaseParser):
     def get_tools(self):
         return tools
 
+    def make_stream_parser(self):
+        return FunctionCallStreamParser(self)
+
     def str2action(self, response) -> dict:
         # response is now a message object from openai
         if hasattr(response, 'tool_calls') and response.tool_calls:
@@ -52,89 +80,94 @@ class FunctionCallParser(BaseParser):
             content = response.content if hasattr(response, 'content') else str(response)
             return {"action_type": "ABORT", "value": f"Model did not call a function. Content: {content}", "explain": "Model failure", "summary": "Model failure"}
 
-    def env2messages4ask(self, task, environments, actions, return_sft=False, hints=[]) -> list:
+    def make_prompt_builder(self, task, hints=[]):
+        if self.history_policy.is_append_only():
+            return FunctionCallPromptBuilder(self, task, hints)
+        return FunctionCallWindowPromptBuilder(self, task, hints)
+
+    def prompt_head(self, task, hints=[]):
+        """
+        The messages before the past steps: the system message, and the task and hints in the cache_friendly layout.
+        """
+        messages = [{"role": "system", "content": system_prompt}]
+        if self.prompt_layout == "cache_friendly":
+            task_text = f"Task: {task}\n"
+            if hints:
+                task_text += "Hints:\n" + "\n".join([f"- {h}" for h in hints]) + "\n"
+            messages.append({"role": "user", "content": [{"type": "text", "text": task_text}]})
+        return messages
+
+    def history_messages(self, task, step_idx, env, action, keep_image):
+        """
+        The user, assistant and tool messages of a past step; only the last past step keeps its screenshot.
+        """
+        # User message with screenshot and comment
+        user_content = []
         
-        system_prompt = """You are a mobile GUI Agent expert. You need to interact with the mobile phone based on the user's task, screen screenshots, and interaction history to complete the user's task.
-Please keep in mind that the mobile screen coordinate system has the top-left corner as the origin, the x-axis to the right, and the y-axis down, with values ranging from 0-1000.
+        # Add task info to the first message, the cache_friendly layout has it in the head
+        if step_idx == 0 and self.prompt_layout == "default":
+            user_content.append({"type": "text", "text": f"Task: {task}"})
 
-# Action Principles:
-1. You need to strictly follow the user's instructions.
-2. You must use the provided tools to interact with the device.
-3. Before calling a tool, you MUST analyze the current state and plan your action. Output your thought process first, then call the tool.
-"""
+        if env.get("user_comment"):
+            user_content.append({"type": "text", "text": env["user_comment"]})
         
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
+        # Only keep the last historical image
+        if keep_image:
+            if env.get("image"):
+                user_content.append({"type": "image_url", "image_url": {"url": env["image"]}})
+        else:
+            # If image is omitted and no other content, add a placeholder
+            if not user_content:
+                user_content.append({"type": "text", "text": "(Screenshot omitted)"})
+            
+        messages = [{"role": "user", "content": user_content}]
         
-        # Add history
-        # environments has one more element than actions (the current environment)
-        num_history = len(actions)
+        # Assistant message (previous action)
+        tool_call_id = f"call_{step_idx}"
+        function_name = action.get("action_type", action.get("action"))
         
-        for i, (env, action) in enumerate(zip(environments[:-1], actions)):
-            # User message with screenshot and comment
-            user_content = []
-            
-            # Add task info to the first message
-            if i == 0:
-                user_content.append({"type": "text", "text": f"Task: {task}"})
+        # Filter arguments to match tool definition
+        arguments = {}
+        for k, v in action.items():
+            if k not in ["action_type", "action", "cot", "summary"]:
+                arguments[k] = v
+        
+        # Ensure explain is present
+        if "explain" not in arguments and "summary" in action:
+            arguments["explain"] = action["summary"]
+        
+        content = action.get("cot")
 
-            if env.get("user_comment"):
-                user_content.append({"type": "text", "text": env["user_comment"]})
-            
-            # Only keep the last historical image
-            if i == num_history - 1:
-                if env.get("image"):
-                    user_content.append({"type": "image_url", "image_url": {"url": env["image"]}})
-            else:
-                # If image is omitted and no other content, add a placeholder
-                if not user_content:
-                    user_content.append({"type": "text", "text": "(Screenshot omitted)"})
-                
-            messages.append({"role": "user", "content": user_content})
-            
-            # Assistant message (previous action)
-            tool_call_id = f"call_{i}"
-            function_name = action.get("action_type", action.get("action"))
-            
-            # Filter arguments to match tool definition
-            arguments = {}
-            for k, v in action.items():
-                if k not in ["action_type", "action", "cot", "summary"]:
-                    arguments[k] = v
-            
-            # Ensure explain is present
-            if "explain" not in arguments and "summary" in action:
-                arguments["explain"] = action["summary"]
-            
-            content = action.get("cot")
-
-            messages.append({
-                "role": "assistant",
-                "content": content,
-                "tool_calls": [{
-                    "id": tool_call_id,
-                    "type": "function",
-                    "function": {
-                        "name": function_name,
-                        "arguments": json.dumps(arguments)
-                    }
-                }]
-            })
-            
-            # Tool output
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tool_call_id,
-                "content": "success"
-            })
+        messages.append({
+            "role": "assistant",
+            "content": content,
+            "tool_calls": [{
+                "id": tool_call_id,
+                "type": "function",
+                "function": {
+                    "name": function_name,
+                    "arguments": json.dumps(arguments)
+                }
+            }]
+        })
+        
+        # Tool output
+        messages.append({
+            "role": "tool",
+            "tool_call_id": tool_call_id,
+            "content": "success"
+        })
+        return messages
 
-        # Current step
-        current_env = environments[-1]
+    def current_message(self, task, current_env, is_first_step, hints=[]):
         user_content = []
+
+        if self.prompt_layout == "cache_friendly":
+            # the task and hints are in the head, see prompt_head
+            is_first_step, hints = False, []
         
         task_text = ""
-        if len(environments) == 1:
+        if is_first_step:
              task_text += f"Task: {task}\n"
 
         if hints:
@@ -149,10 +182,224 @@ Please keep in mind that the mobile screen coordinate system has the top-left co
         if current_env.get("image"):
             user_content.append({"type": "image_url", "image_url": {"url": current_env["image"]}})
             
-        messages.append({"role": "user", "content": user_content})
+        return {"role": "user", "content": user_content}
+
+    def collapsed_line(self, step_idx, env, action):
+        """
+        The line of a past step in the summary of the steps before the tool-call turns.
+        """
+        function_name = action.get("action_type", action.get("action"))
+        line = f"Step {step_idx + 1}: {function_name}, {action.get('summary', action.get('explain', ''))}"
+        if env.get("user_comment"):
+            line += f" (User Comment: {env['user_comment']})"
+        return line
+
+    def history_window_messages(self, task, steps, current_env, hints=[], head=None, step_lines=None):
+        """
+        The messages of the past steps, a list of (environment, action), and of the current step, as the history
+        policy says. head, if given, is the prompt_head; step_lines the (collapsed_line, estimated tokens)
+        of every past step.
+        """
+        policy = self.history_policy
+        if head is None:
+            head = self.prompt_head(task, hints)
+        current = self.current_message(task, current_env, len(steps) == 0, hints)
+
+        num_turns = len(steps) if policy.max_turns is None else min(policy.max_turns, len(steps))
+        first_turn = len(steps) - num_turns
+        # Only keep the last historical images
+        first_image = len(steps) - policy.max_images
+        turns = [self.history_messages(task, i, steps[i][0], steps[i][1], keep_image=(i >= first_image)) for i in range(first_turn, len(steps))]
+
+        def get_line(i):
+            if step_lines is not None:
+                return step_lines[i]
+            line = self.collapsed_line(i, *steps[i])
+            return line, estimate_text_tokens(line)
+
+        first_line = 0
+        if policy.max_prompt_tokens is not None:
+            budget = policy.max_prompt_tokens - policy.estimate_tokens(head + [current])
+            turn_tokens = [policy.estimate_tokens(turn) for turn in turns]
+            total = sum(turn_tokens)
+            # the summary message without its lines, with room for the note of the omitted steps
+            header_tokens = 4 + estimate_text_tokens(f"Task: {task}\nEarlier steps, summarized:\n(steps 1 to 10000 omitted)")
+            # the turns only go if they alone exceed the budget, the oldest first
+            while len(turns) > 0 and total + (header_tokens if first_turn > 0 else 0) > budget:
+                total -= turn_tokens.pop(0)
+                turns.pop(0)
+                first_turn += 1
+            # then the most recent summary lines that fit
+            remaining = budget - total - header_tokens
+            first_line = first_turn
+            while first_line > 0:
+                line, tokens = get_line(first_line - 1)
+                if tokens + 1 > remaining:
+                    break
+                remaining -= tokens + 1
+                first_line -= 1
+
+        messages = list(head)
+        if first_turn > 0:
+            # the task was in the first turn, which is collapsed
+            text = f"Task: {task}\nEarlier steps, summarized:"
+            if first_line > 0:
+                text += f"\n(steps 1 to {first_line} omitted)"
+            text += "".join("\n" + get_line(i)[0] for i in range(first_line, first_turn))
+            messages.append({"role": "user", "content": [{"type": "text", "text": text}]})
+        for turn in turns:
+            messages.extend(turn)
+
+        # Current step
+        messages.append(current)
+        return messages
+
+    def env2messages4ask(self, task, environments, actions, return_sft=False, hints=[]) -> list:
+        
+        # Add history
+        # environments has one more element than actions (the current environment)
+        messages = self.history_window_messages(task, list(zip(environments[:-1], actions)), environments[-1], hints)
         
         if return_sft:
             # SFT not implemented for this parser yet
             return messages, []
         else:
             return messages
+
+
+class FunctionCallPromptBuilder(PromptBuilder):
+    """
+    A past step is final once max_images newer ones dropped its screenshot: those steps are kept as a message
+    prefix, only the past steps still with a screenshot and the current step are built at each step.
+    For the history policies sending every turn without a token budget.
+    """
+
+    def __init__(self, parser, task, hints=[]):
+        super().__init__(parser, task, hints)
+        self.prefix = parser.prompt_head(task, hints)
+        # (step index, environment, action) of the past steps keeping their screenshot, oldest first
+        self.recent_steps = deque()
+        self.steps = 0
+
+    def append(self, environment, action):
+        # the prefix of the previous build is kept as it is, only extended
+        self.kept_prefix = len(self.prefix)
+        self.recent_steps.append((self.steps, environment, action))
+        self.steps += 1
+        while len(self.recent_steps) > self.parser.history_policy.max_images:
+            self.prefix.extend(self.parser.history_messages(self.task, *self.recent_steps.popleft(), keep_image=False))
+
+    def build(self, current_environment):
+        messages = list(self.prefix)
+        for step in self.recent_steps:
+            messages.extend(self.parser.history_messages(self.task, *step, keep_image=True))
+        messages.append(self.parser.current_message(self.task, current_environment, self.steps == 0, self.hints))
+        return messages
+
+
+class FunctionCallWindowPromptBuilder(PromptBuilder):
+    """
+    For the history policies with a window of turns or a token budget: the steps leaving the window change the
+    front of the messages, so only the head is kept; the summary line of a step is made once.
+    """
+
+    def __init__(self, parser, task, hints=[]):
+        super().__init__(parser, task, hints)
+        self.head = parser.prompt_head(task, hints)
+        self.steps = []
+        self.step_lines = []
+
+    def append(self, environment, action):
+        self.kept_prefix = len(self.head)
+        line = self.parser.collapsed_line(len(self.steps), environment, action)
+        self.step_lines.append((line, estimate_text_tokens(line)))
+        self.steps.append((environment, action))
+
+    def build(self, current_environment):
+        return self.parser.history_window_messages(self.task, self.steps, current_environment, self.hints,
+            head=self.head, step_lines=self.step_lines)
+
+
+class FunctionCallStreamParser:
+    """
+    Finds the action in a streamed response as soon as the arguments of the first tool call are complete,
+    the content before the tool call is the cot.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.content_parts = []
+        self.function_name = ""
+        self.arguments_parts = []
+        self.action = None
+
+    def feed(self, delta):
+        """
+        Feed the delta of one chunk, returns the action the first time it is complete, None otherwise.
+        """
+        if self.action is not None:
+            return None
+
+        if delta.content:
+            self.content_parts.append(delta.content)
+
+        for tool_call_delta in (delta.tool_calls or []):
+            if tool_call_delta.index != 0 or tool_call_delta.function is None:
+                continue
+            if tool_call_delta.function.name:
+                self.function_name += tool_call_delta.function.name
+            arguments = tool_call_delta.function.arguments
+            if not arguments:
+                continue
+            self.arguments_parts.append(arguments)
+
+            # the arguments are a JSON object, only worth parsing once they may be closed
+            if not arguments.rstrip().endswith("}"):
+                continue
+            arguments = "".join(self.arguments_parts)
+            try:
+                json.loads(arguments)
+            except ValueError:
+                continue
+
+            content = "".join(self.content_parts)
+            response = SimpleNamespace(
+                content=content if len(content) > 0 else None,
+                tool_calls=[SimpleNamespace(function=SimpleNamespace(name=self.function_name, arguments=arguments))],
+            )
+            self.action = self.parser.str2action(response)
+            return self.action
+
+        return None
+
+
+if __name__ == "__main__":
+    # python copilot_tools/function_call_parser.py
+    # the time to build the messages of a step and the size of what is logged, at growing session lengths
+    import time
+
+    parser = FunctionCallParser()
+    environments, actions = [], []
+    prompt_builder = parser.make_prompt_builder("open the settings")
+    for length in range(401):
+        if length in [10, 100, 400]:
+            current_env = {"image": f"images/step_{length + 1}.jpeg", "user_comment": ""}
+
+            start_time = time.perf_counter()
+            messages = parser.env2messages4ask("open the settings", environments + [current_env], actions)
+            full_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            built = prompt_builder.build(current_env)
+            incremental_time = time.perf_counter() - start_time
+            assert json.dumps(built) == json.dumps(messages)
+
+            full_size = len(json.dumps(messages, ensure_ascii=False))
+            delta_size = len(json.dumps(built[prompt_builder.kept_prefix:], ensure_ascii=False))
+            print(f"step {length + 1}: rebuild {1000 * full_time:.3f}ms, {full_size} bytes logged; "
+                  f"incremental {1000 * incremental_time:.3f}ms, {delta_size} bytes logged")
+
+        environment = {"image": f"images/step_{length + 1}.jpeg", "user_comment": ""}
+        action = {"action_type": "CLICK", "point": [500, 500], "explain": "open it", "cot": "the icon is in the middle", "summary": f"step {length + 1}"}
+        environments.append(environment)
+        actions.append(action)
+        prompt_builder.append(environment, action)
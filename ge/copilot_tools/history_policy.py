@@ -0,0 +1,129 @@
+import sys
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+
+def estimate_text_tokens(text):
+    """
+    A rough token count without a tokenizer: one token per 4 ASCII characters, one per other character, e.g. Chinese.
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    # the other characters take 2 or 3 bytes in UTF-8, mostly 3 for Chinese
+    other_chars = min(chars, (len(text.encode("utf-8")) - chars) // 2)
+    return (chars - other_chars + 3) // 4 + other_chars
+
+
+def estimate_tokens(messages, image_tokens=1500):
+    """
+    A rough count of the prompt tokens of chat messages, image_tokens per image, see estimate_text_tokens.
+    """
+    tokens = 0
+    for msg in messages:
+        # the role and the separators of the chat template
+        tokens += 4
+        content = msg.get("content")
+        if type(content) == str:
+            tokens += estimate_text_tokens(content)
+        elif type(content) == list:
+            for item in content:
+                if item["type"] == "text":
+                    tokens += estimate_text_tokens(item["text"])
+                else:
+                    tokens += image_tokens
+        for tool_call in msg.get("tool_calls") or []:
+            tokens += estimate_text_tokens(tool_call["function"]["name"]) + estimate_text_tokens(tool_call["function"]["arguments"])
+    return tokens
+
+
+class HistoryPolicy:
+    """
+    Which part of the history of a session the model is asked with, see FunctionCallParser:
+
+    - max_images: the screenshots of the most recent past steps that are sent
+    - max_turns: the most recent past steps sent as tool-call turns, None for all of them;
+      the steps before are collapsed into one message with a line per step, a rolling summary
+    - max_prompt_tokens: a hard budget of the estimated prompt tokens, see estimate_tokens; the oldest summary lines
+      are dropped first, then the oldest turns with their screenshots; None for no budget
+    - image_tokens: the estimated tokens of a screenshot, depends on the model and the image size
+
+    The defaults keep the last screenshot and every turn, the prompt of the parser before there were policies.
+    """
+
+    def __init__(self, max_images=1, max_turns=None, max_prompt_tokens=None, image_tokens=1500):
+        assert max_images >= 0, "max_images must not be negative"
+        assert max_turns is None or max_turns >= 0, "max_turns must not be negative"
+        self.max_images = max_images
+        self.max_turns = max_turns
+        self.max_prompt_tokens = max_prompt_tokens
+        self.image_tokens = image_tokens
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        The policy of a model_config "history_policy" dict, the default one for None.
+        """
+        return cls(**(config or {}))
+
+    def is_append_only(self):
+        """
+        Whether a past step is sent the same way at every later step once it lost its screenshot,
+        so the messages of the session only grow at the end.
+        """
+        return self.max_turns is None and self.max_prompt_tokens is None
+
+    def estimate_tokens(self, messages):
+        return estimate_tokens(messages, self.image_tokens)
+
+
+if __name__ == "__main__":
+    # python copilot_tools/history_policy.py
+    # prompt size, build time and model latency against session length, for the default policy and a windowed one;
+    # the stand-in server answers after 20ms plus 0.05ms per prompt token, as the prefill of an inference server
+    import os
+    import json
+    import time
+    import tempfile
+
+    import yaml
+
+    from tools.llm_providers import _StandInOpenAIServer
+
+    server = _StandInOpenAIServer(latency=lambda request: 0.02 + 0.00005 * estimate_tokens(request["messages"]))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, "model_config.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump({"stand-in": {"api_base": server.api_base}}, f)
+        os.environ["GELAB_MODEL_CONFIG"] = config_path
+
+        from tools.ask_llm_v2 import ask_llm_anything
+        from copilot_tools.function_call_parser import FunctionCallParser
+
+        # a tiny JPEG stands in for the screenshots, the estimate counts image_tokens for each one anyway
+        image_url = "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAP//////////////////////////////////////////////////////////////////////////////////////wAALCAABAAEBAREA/8QAFAABAAAAAAAAAAAAAAAAAAAAA//EABQQAQAAAAAAAAAAAAAAAAAAAAD/2gAIAQEAAD8AN//Z"
+
+        policies = {
+            "default": None,
+            "2 images, 8 turns, 12k tokens": {"max_images": 2, "max_turns": 8, "max_prompt_tokens": 12000},
+        }
+        for name, policy_config in policies.items():
+            parser = FunctionCallParser({"history_policy": policy_config})
+            prompt_builder = parser.make_prompt_builder("open the settings and turn on the dark mode")
+            for step in range(401):
+                current_env = {"image": image_url, "user_comment": ""}
+                if step in [10, 100, 400]:
+                    start_time = time.perf_counter()
+                    messages = prompt_builder.build(current_env)
+                    build_time = time.perf_counter() - start_time
+                    start_time = time.perf_counter()
+                    ask_llm_anything("stand-in", "stand-in", json.loads(json.dumps(messages)), args={"max_tokens": 64})
+                    llm_time = time.perf_counter() - start_time
+                    print(f"{name}, step {step + 1}: {len(messages)} messages, {parser.history_policy.estimate_tokens(messages)} tokens, "
+                          f"build {1000 * build_time:.2f}ms, model {1000 * llm_time:.0f}ms")
+
+                action = {"action_type": "CLICK", "point": [500, 500], "explain": "tap the next item of the list",
+                          "cot": "the item is in the middle of the screen", "summary": "tap the next item of the list"}
+                prompt_builder.append(current_env, action)
+    server.close()
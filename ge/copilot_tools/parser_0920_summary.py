@@ -15,9 +15,10 @@ sys.path.append(current_dir)
 if "." not in sys.path:
     sys.path.append(".")
 
-# from tools.prompt_tools import messages2sft
+from tools.prompt_tools import messages2sft
+from copilot_tools.base_parser import PromptBuilder, get_prompt_layout
+from copilot_tools.protocol_0920 import parse_action, normalize_action, format_action
 
-from copy import deepcopy
 
 
 task_define_prompt = """你是一个手机 GUI-Agent 操作专家，你需要根据用户下发的任务、手机屏幕截图和交互操作的历史记录，借助既定的动作空间与手机进行交互，从而完成用户的任务。
@@ -51,6 +52,17 @@ task_define_prompt = """你是一个手机 GUI-Agent 操作专家，你需要根
 例如：action:LONGPRESS\tpoint:x,y
 """
 
+output_format_prompt = '''
+
+在执行操作之前，请务必回顾你的历史操作记录和限定的动作空间，先进行思考和解释然后输出动作空间和对应的参数：
+1. 思考（THINK）：在 <THINK> 和 </THINK> 标签之间。
+2. 解释（explain）：在动作格式中，使用 explain: 开头，简要说明当前动作的目的和执行方式。
+在执行完操作后，请输出执行完当前步骤后的新历史总结。
+输出格式示例：
+<THINK> 思考的内容 </THINK>
+explain:解释的内容\taction:动作空间和对应的参数\tsummary:执行完当前步骤后的新历史总结
+'''
+
 def make_status_prompt(task, current_image, hints, summary_history="", user_comment=""):
 
     if len(hints) == 0:
@@ -83,16 +95,7 @@ def make_status_prompt(task, current_image, hints, summary_history="", user_comm
         },
         {
             "type": "text",
-            "text": f'''
-
-在执行操作之前，请务必回顾你的历史操作记录和限定的动作空间，先进行思考和解释然后输出动作空间和对应的参数：
-1. 思考（THINK）：在 <THINK> 和 </THINK> 标签之间。
-2. 解释（explain）：在动作格式中，使用 explain: 开头，简要说明当前动作的目的和执行方式。
-在执行完操作后，请输出执行完当前步骤后的新历史总结。
-输出格式示例：
-<THINK> 思考的内容 </THINK>
-explain:解释的内容\taction:动作空间和对应的参数\tsummary:执行完当前步骤后的新历史总结
-'''
+            "text": output_format_prompt
         }
     ]
 
@@ -100,225 +103,139 @@ explain:解释的内容\taction:动作空间和对应的参数\tsummary:执行
 
 
 class Parser0920Summary():
-    def __init__(self, *args, **kwargs):
+    def __init__(self, parser_config=None, *args, **kwargs):
         # super().__init__(*args, **kwargs)
-        pass
+        # how the messages are laid out, see get_prompt_layout
+        self.prompt_layout = get_prompt_layout(parser_config)
 
     def get_tools(self):
         return None
 
+    def make_stream_parser(self):
+        return Parser0920StreamParser(self)
+
     def action2action(self, action):
         # assert single actions
-        assert "action" in action or "action_type" in action, f"action {action} should have action or action_type field"
-        assert "explain" in action, f"action {action} should have explain field"
-        assert "cot" in action, f"action {action} should have cot field"
-
-        explain = action['explain']
-        cot = action['cot']
-        summary = action.get('summary', '')  
-        action_type = action.get('action_type', action.get('action', None))
-
-        return_action = OrderedDict(
-            {
-                "cot": cot,
-                "explain": explain,
-                "action": action_type,
-                "summary": summary
-            }
-        )
-
-
-        if action_type == "TYPE":
-            # assert "is_keyboard" in action or "keyboard_exists" in action, f"action {action} should have is_keyboard or keyboard_exists field"
-            assert "value" in action, f"action {action} should have value field"
-            # assert "point" in action, f"action {action} should have point field"
-            
-            keyboard_exists = action.get("is_keyboard", action.get("keyboard_exists", False))
-            if type(keyboard_exists) == str:
-                keyboard_exists = keyboard_exists.lower() == "true"
-
-            # point = action['point'] 
-            value = action['value']
-
-            return_action.update({
-                "value": value, 
-                # "point": point, 
-                # "keyboard_exists": keyboard_exists
-            })
-
-        elif action_type == "CLICK":
-            assert "point" in action, f"action {action} should have point field"
-            point = action['point']
-            
-            return_action.update({
-                "point": point
-            })
-
-        elif action_type == "AWAKE":
-            assert "value" in action, f"action {action} should have value field"
-            value = action['value']
+        return normalize_action(action)
 
-            return_action.update({
-                "value": value
-            })
-
-        elif action_type == "INFO":
-            assert "value" in action, f"action {action} should have value field"
-            value = action['value']
-
-            return_action.update({
-                "value": value
-            })
-
-        elif action_type == "WAIT":
-            assert "value" in action, f"action {action} should have value field"
-            value = action['value']
-
-            return_action.update({
-                "value": value
-            })
-
-        elif action_type == "COMPLETE":
-            assert "return" in action, f"action {action} should have return field"
-            return_value = action['return']
-
-            return_action.update({
-                "return": return_value
-            })
-
-        
-        elif action_type == "ABORT":
-
-            pass
-
-        
-        elif action_type == "SLIDE":
-            assert "point1" in action, f"action {action} should have point1 field"
-            assert "point2" in action, f"action {action} should have point2 field"
-            point1 = action['point1']
-            point2 = action['point2']
-
-            return_action.update({
-                "point1": point1, 
-                "point2": point2
-            })
-
-
-        elif action_type == "LONGPRESS":
-            assert "point" in action, f"action {action} should have point field"
-            point = action['point']
-
-            return_action.update({
-                "point": point
-            })
-        
-        else:
-            raise ValueError(f"Unknown action type {action_type} in action {action}")
-
-        return return_action
-
-    def action2str(self, actions):
+    def action2str(self, actions, with_cot=True):
         assert (type(actions) == list and len(actions) == 0) or type(actions) == dict or type(actions) == OrderedDict, f"actions {actions} should be a list or a dict; only one action is supported"
 
         if type(actions) == dict or type(actions) == OrderedDict:
             actions = [actions]
-        # action = actions[0]
-        action = deepcopy(actions[0])
-
-        # assert action type field
-        if "action" in action and "action_type" in action:
-            assert action['action'] == action['action_type'], f"action {action} should have same action and action_type field"
-            assert len(action['action']) > 0, f"action {action} should have non-empty action and action_type field"
-            del action['action_type']
+        return format_action(actions[0], with_cot=with_cot)
 
-        action = self.action2action(action)
+    def str2action(self, command_str):
+        # Expected format: <THINK> cot </THINK>\nexplain:xxx\taction:xx\tvalue:xxx\tsummary:xxx
+        return parse_action(command_str)
+
+    def make_prompt_builder(self, task, hints=[]):
+        if self.prompt_layout == "cache_friendly":
+            return Parser0920CacheFriendlyPromptBuilder(self, task, hints)
+        return Parser0920PromptBuilder(self, task, hints)
+
+    def history_qa(self, prev_act, env):
+        """
+        The question and the answer of the user in env, the environment following prev_act; None if the user said nothing.
+        """
+        if prev_act['action'] == "INFO":
+            q = prev_act['value']
+            a = env['user_comment'].strip()
+            return (q, a)
+        elif env['user_comment'].strip() != "":
+            q = "指令是："
+            a = env['user_comment'].strip()
+            return (q, a)
+        return None
 
-        kvs = []
-        for key, value in action.items():
-            key = key.strip()
+    def make_messages(self, task, current_env, hints, summary_history, historica_qa):
 
-            if key in ['cot']:
-                continue
-        
-            if type(value) == list:
-                value = ",".join([str(v).strip() for v in value])
-            elif type(value) == bool:
-                value = str(value).lower()
-            elif type(value) == int or type(value) == float:
-                value = str(value)
-            else:
-                value = value.replace("\n", "").replace("\t", "").strip()
-
-            kvs.append(f"{key}:{value}")
+        if len(historica_qa) > 0:
+            qa_prompt = "这是你和用户的对话历史： " + "\n" + "\n".join([f"你曾经提出的问题：{qa[0]}\n\n用户对你的指示：{qa[1]}" for qa in historica_qa]) + "\n\n 你需要更加注意用户最后的指示。 " if len(historica_qa) > 0 else ""
+        else:
+            qa_prompt = ""
 
-        action_str = f"<THINK> {action['cot']} </THINK>\n" + "\t".join(kvs) + "\n"
-        return action_str
-    
 
-    def str2action(self, command_str):
-        command_str = command_str.strip()
-        
-        # Normalize THINK tags: fix typos, case, and spacing
-        command_str = (
-            command_str
-            .replace("<TINK>", "<THINK>").replace("</TINK>", "</THINK>")
-            .replace("<think>", "<THINK>").replace("</think>", "</THINK>")
+        conversations = [
+            {
+                "type": "text",
+                "text": task_define_prompt
+            }
+        ] + make_status_prompt(
+            task, 
+            current_env['image'], 
+            hints,
+            summary_history,
+            qa_prompt
         )
-        command_str = re.sub(r"<\s*/?THINK\s*>", lambda m: "<THINK>" if "/" not in m.group() else "</THINK>", command_str, flags=re.IGNORECASE)
-        
-        # Extract CoT and key-value parts
-        # Expected format: <THINK> cot </THINK>\nexplain:xxx\taction:xx\tvalue:xxx\tsummary:xxx
-        try:
-            cot_part = command_str.split("<THINK>")[1].split("</THINK>")[0].strip()
-            kv_part = command_str.split("</THINK>")[1].strip()
-        except IndexError:
-            print(f"[Parser Warning] Missing <THINK> tags, treating entire response as kv")
-            kv_part = command_str
-            cot_part = ""
-
-        action = OrderedDict()
-        action['cot'] = cot_part
-        
-        # FIX:issue 13
-        # Error split by \n, should split by tab separator 
-        kvs = [kv.strip() for kv in kv_part.split("\t") if kv.strip()]
 
-        for kv in kvs:
-            if ":" not in kv:
-                continue
+        messages = [
+            {
+                "role": "user",
+                "content": conversations
+            }
+        ]
+        return messages
+
+    def cache_friendly_head(self, task, hints):
+        """
+        The messages before the steps in the cache_friendly layout: the instructions, the same for every session,
+        and the task.
+        """
+        if len(hints) == 0:
+            hint_str = ""
+        else:
+            hint_str = "\n".join([f"- {hint}" for hint in hints])
+            hint_str = f"\n### HINT：\n{hint_str}\n"
 
-            key = kv.split(":", 1)[0].strip()
-            value = kv.split(":", 1)[1].strip()
-
-            if key == "action":
-                action['action'] = value
-            elif key == "summary":
-                action['summary'] = value
-            elif "point" in key:
-                # Parse point format: "x,y" or "x y"
-                try:
-                    # Replace comma with space for unified processing
-                    coords = value.replace(",", " ").split()
-                    if len(coords) < 2:
-                        raise ValueError(f"Expected 2 coordinates, got {len(coords)}")
-                    
-                    x, y = int(coords[0]), int(coords[1])
-                    action[key] = [x, y]
-                    
-                except (ValueError, IndexError) as e:
-                    raise ValueError(
-                        f"[Parser Error] Failed to parse point '{value}' for key '{key}': {str(e)}. "
-                        f"Expected format: 'x,y' or 'x y' with integer values"
-                    ) from e
-            else:
-                action[key] = value
+        return [
+            {"role": "system", "content": task_define_prompt + output_format_prompt},
+            {"role": "user", "content": [{"type": "text", "text": f"已知用户指令为：{task}指令结束\n{hint_str}"}]},
+        ]
 
-        return action
+    def cache_friendly_step_message(self, step_idx, env, prev_action, current):
+        """
+        The user message of a step in the cache_friendly layout, with what the user said after prev_action;
+        only the current step has its screenshot.
+        """
+        text = ""
+        # as in the default layout, a comment on the first screenshot is not shown
+        qa = self.history_qa(prev_action, env) if prev_action is not None else None
+        if qa is not None:
+            text += f"你曾经提出的问题：{qa[0]}\n\n用户对你的指示：{qa[1]}\n\n你需要更加注意用户最后的指示。\n\n"
+
+        if not current:
+            return {"role": "user", "content": [{"type": "text", "text": text + f"第{step_idx + 1}步的手机屏幕截图已省略"}]}
+        return {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": text + f"第{step_idx + 1}步，当前手机屏幕截图如下："},
+                {"type": "image_url", "image_url": {"url": env['image']}},
+            ]
+        }
+
+    def cache_friendly_action_message(self, action):
+        """
+        The assistant message of a past step in the cache_friendly layout, its action and summary without the cot.
+        """
+        return {"role": "assistant", "content": self.action2str(action, with_cot=False)}
 
     def env2messages4ask(self, task, environments, actions, markov_mode=False, return_sft = False, hints = [], ) -> list:
 
         assert len(environments) > 0, f"environments {environments} should not be empty"
         assert len(environments) - 1 == len(actions), f"environments {environments} should be one more than actions {actions}"
+
+        if self.prompt_layout == "cache_friendly":
+            messages = self.cache_friendly_head(task, hints)
+            for idx in range(len(actions)):
+                prev_action = actions[idx - 1] if idx > 0 else None
+                messages.append(self.cache_friendly_step_message(idx, environments[idx], prev_action, current=False))
+                messages.append(self.cache_friendly_action_message(actions[idx]))
+            prev_action = actions[-1] if len(actions) > 0 else None
+            messages.append(self.cache_friendly_step_message(len(actions), environments[-1], prev_action, current=True))
+            if return_sft:
+                return messages, messages2sft(messages)
+            return messages
         
         # Use the summary of the last action as the historical summary
         summary_history = ""
@@ -335,43 +252,11 @@ class Parser0920Summary():
         historica_qa = []
 
         for idx in range(1, len(environments)):
-            prev_act = actions[idx - 1]
-            current_env = environments[idx]
-
-            if prev_act['action'] == "INFO":
-                q = prev_act['value']
-                a = current_env['user_comment'].strip()
-                historica_qa.append((q, a))
-            elif current_env['user_comment'].strip() != "":
-                q = "指令是："
-                a = current_env['user_comment'].strip()
-                historica_qa.append((q, a))
+            qa = self.history_qa(actions[idx - 1], environments[idx])
+            if qa is not None:
+                historica_qa.append(qa)
 
-        if len(historica_qa) > 0:
-            qa_prompt = "这是你和用户的对话历史： " + "\n" + "\n".join([f"你曾经提出的问题：{qa[0]}\n\n用户对你的指示：{qa[1]}" for qa in historica_qa]) + "\n\n 你需要更加注意用户最后的指示。 " if len(historica_qa) > 0 else ""
-        else:
-            qa_prompt = ""
-
-
-        conversations = [
-            {
-                "type": "text",
-                "text": task_define_prompt
-            }
-        ] + make_status_prompt(
-            task, 
-            current_env['image'], 
-            hints,
-            summary_history,
-            qa_prompt
-        )
-
-        messages = [
-            {
-                "role": "user",
-                "content": conversations
-            }
-        ]
+        messages = self.make_messages(task, current_env, hints, summary_history, historica_qa)
         # print(f"=============================================messages: \n\n{messages}\n=============================================")
         # print(f"{'='*45}\nmessages:\n{messages}\n{'='*45}")
 
@@ -381,6 +266,126 @@ class Parser0920Summary():
         else:
             return messages
 
+class Parser0920PromptBuilder(PromptBuilder):
+    """
+    The prompt holds the current screenshot and the summary of the last action, so it is made anew at each step;
+    only the conversation with the user is carried over, extended by one step at a time.
+    """
+
+    def __init__(self, parser, task, hints=[]):
+        super().__init__(parser, task, hints)
+        self.historica_qa = []
+        self.last_action = None
+
+    def append(self, environment, action):
+        if self.last_action is not None:
+            qa = self.parser.history_qa(self.last_action, environment)
+            if qa is not None:
+                self.historica_qa.append(qa)
+        self.last_action = action
+
+    def build(self, current_environment):
+        historica_qa = self.historica_qa
+        summary_history = ""
+        if self.last_action is not None:
+            qa = self.parser.history_qa(self.last_action, current_environment)
+            if qa is not None:
+                historica_qa = historica_qa + [qa]
+            summary_history = self.parser.action2action(self.last_action).get('summary', '')
+        return self.parser.make_messages(self.task, current_environment, self.hints, summary_history, historica_qa)
+
+class Parser0920CacheFriendlyPromptBuilder(PromptBuilder):
+    """
+    In the cache_friendly layout a past step is final once the next one starts, the messages only grow at the end.
+    """
+
+    def __init__(self, parser, task, hints=[]):
+        super().__init__(parser, task, hints)
+        self.prefix = parser.cache_friendly_head(task, hints)
+        self.last_action = None
+        self.steps = 0
+
+    def append(self, environment, action):
+        # the prefix of the previous build is kept as it is, only extended
+        self.kept_prefix = len(self.prefix)
+        self.prefix.append(self.parser.cache_friendly_step_message(self.steps, environment, self.last_action, current=False))
+        self.prefix.append(self.parser.cache_friendly_action_message(action))
+        self.last_action = action
+        self.steps += 1
+
+    def build(self, current_environment):
+        current = self.parser.cache_friendly_step_message(self.steps, current_environment, self.last_action, current=True)
+        return self.prefix + [current]
+
+class Parser0920StreamParser:
+    """
+    Finds the action in a streamed response as soon as it is complete. The fields come in the order of the prompt,
+    explain, action and its parameters, then summary, so the action is complete once the summary field starts.
+    Only the new text of each delta is scanned.
+    """
+
+    _think_end_pattern = re.compile(r"<\s*/\s*(THINK|TINK)\s*>", flags=re.IGNORECASE)
+    _summary_start_pattern = re.compile(r"\t\s*summary\s*:")
+    # the longest match that may be split across two deltas
+    _overlap = 32
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.reasoning_parts = []
+        self.content_parts = []
+        self.content_length = 0
+        # the last characters of the content, for the matches split across deltas
+        self.tail = ""
+        # offset of the key-value part in the content, once the cot is closed
+        self.kv_start = None
+        self.action = None
+
+    def feed(self, delta):
+        """
+        Feed the delta of one chunk, returns the action the first time it is complete, None otherwise.
+        """
+        if self.action is not None:
+            return None
+
+        reasoning = getattr(delta, "reasoning_content", None)
+        if reasoning:
+            self.reasoning_parts.append(reasoning)
+
+        text = delta.content
+        if not text:
+            return None
+        window_offset = self.content_length - len(self.tail)
+        window = self.tail + text
+        self.content_parts.append(text)
+        self.content_length += len(text)
+        self.tail = window[-self._overlap:]
+
+        if self.kv_start is None:
+            if len(self.reasoning_parts) > 0:
+                # the reasoning is the cot, wrapped in think tags before the content, see ask_llm_anything
+                self.kv_start = 0
+            else:
+                match = self._think_end_pattern.search(window)
+                if match is None:
+                    return None
+                self.kv_start = window_offset + match.end()
+
+        for match in self._summary_start_pattern.finditer(window, max(0, self.kv_start - window_offset)):
+            end = window_offset + match.start()
+            response = "".join(self.content_parts)[:end]
+            if len(self.reasoning_parts) > 0:
+                response = "<think>" + "".join(self.reasoning_parts) + "</think>" + "\n" + response
+            try:
+                action = self.parser.str2action(response)
+                # raises if the action type or a parameter is missing
+                self.parser.action2action(action)
+            except (AssertionError, ValueError):
+                continue
+            self.action = action
+            return action
+
+        return None
+
 def tkj_action_transformer(action, width: int, height: int):
     ret_dict = {}
 
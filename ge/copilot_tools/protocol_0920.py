@@ -0,0 +1,382 @@
+import re
+import sys
+import bisect
+
+from collections import OrderedDict
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+
+class ActionParseError(ValueError):
+    """
+    A response of the parser_0920 protocol that does not parse; position is the offset in the response as given.
+    """
+
+    def __init__(self, message, position):
+        super().__init__(f"{message} at position {position}")
+        self.position = position
+
+
+# the parameters of each action type, besides cot, explain, action and summary
+ACTION_PARAMS = {
+    "TYPE": ["value"],
+    "CLICK": ["point"],
+    "AWAKE": ["value"],
+    "INFO": ["value"],
+    "WAIT": ["value"],
+    "COMPLETE": ["return"],
+    "ABORT": [],
+    "SLIDE": ["point1", "point2"],
+    "LONGPRESS": ["point"],
+}
+
+# the think tags in any case and spacing, and the <TINK> typo of the models
+_tag_pattern = re.compile(r"(?i:<\s*/?THINK\s*>)|</?TINK>")
+# the usual "x,y" of a point, the other forms take the slow path
+_point_pattern = re.compile(r"([0-9]+),([0-9]+)")
+# the tabs and newlines dropped from a value by format_action
+_drop_table = str.maketrans("", "", "\t\n")
+
+
+def _normalize_tags(text):
+    """
+    The text with its think tags written <THINK> and </THINK>, the (start, end, is_close) of each tag in it,
+    and the (position, shift) that map a position after a tag back to the text as given.
+    """
+    tags, pieces, shifts = [], [], []
+    last, shift, changed = 0, 0, False
+    for match in _tag_pattern.finditer(text):
+        is_close = "/" in match.group()
+        tag = "</THINK>" if is_close else "<THINK>"
+        start = match.start() - shift
+        tags.append((start, start + len(tag), is_close))
+        if match.group() != tag:
+            changed = True
+            pieces.append(text[last:match.start()])
+            pieces.append(tag)
+            last = match.end()
+            shift += len(match.group()) - len(tag)
+            shifts.append((start + len(tag), shift))
+    if changed:
+        pieces.append(text[last:])
+        text = "".join(pieces)
+    return text, tags, shifts
+
+
+def _parse_point(key, value, position):
+    match = _point_pattern.fullmatch(value)
+    if match is not None:
+        return [int(match.group(1)), int(match.group(2))]
+
+    # Parse point format: "x,y" or "x y"
+    coords = value.replace(",", " ").split()
+    try:
+        if len(coords) < 2:
+            raise ValueError(f"Expected 2 coordinates, got {len(coords)}")
+        return [int(coords[0]), int(coords[1])]
+    except ValueError as e:
+        raise ActionParseError(
+            f"[Parser Error] Failed to parse point '{value}' for key '{key}': {str(e)}. "
+            f"Expected format: 'x,y' or 'x y' with integer values", position
+        ) from e
+
+
+def parse_action(text):
+    """
+    The action of a response, "<THINK> cot </THINK>\\nexplain:xxx\\taction:xx\\tvalue:xxx\\tsummary:xxx":
+    the cot, then every key-value field in order, the points as [x, y] of ints.
+
+    The same as the chain of replaces and splits str2action used to be, including its handling of typos
+    and of the tags out of place, see _reference_str2action. A response with just one pair of think tags
+    around the cot, as the models write them, is cut with a few finds; any other goes to _scan_action.
+    """
+    stripped = text.strip()
+    # every tag has a "<", so with two of them these are the only tags
+    if stripped.count("<") != 2 or stripped[:7].upper() != "<THINK>":
+        return _scan_action(text)
+    close = stripped.find("</", 7)
+    if stripped[close:close + 8].upper() != "</THINK>":
+        return _scan_action(text)
+
+    action = OrderedDict()
+    action['cot'] = stripped[7:close].strip()
+    for field in stripped[close + 8:].split("\t"):
+        key, colon, value = field.partition(":")
+        if not colon:
+            continue
+        key = key.strip()
+        value = value.strip()
+        if "point" in key:
+            match = _point_pattern.fullmatch(value)
+            if match is None:
+                # the other forms of a point, and the errors with their position
+                return _scan_action(text)
+            value = [int(match.group(1)), int(match.group(2))]
+        action[key] = value
+    return action
+
+
+def _scan_action(text):
+    """
+    parse_action of any response, one scan for the tags and one over the fields, keeping the positions for the errors.
+    """
+    stripped = text.strip()
+    offset = len(text) - len(text.lstrip())
+    normalized, tags, shifts = _normalize_tags(stripped)
+
+    first_open = next((tag for tag in tags if not tag[2]), None)
+    first_close = next((tag for tag in tags if tag[2]), None)
+
+    action = OrderedDict()
+    if first_open is not None and first_close is not None:
+        # the cot runs to the next tag, the key-value part to the next closing tag
+        cot_end = next((tag[0] for tag in tags if tag[0] >= first_open[1]), len(normalized))
+        action['cot'] = normalized[first_open[1]:cot_end].strip()
+        start = first_close[1]
+        end = next((tag[0] for tag in tags if tag[2] and tag[0] >= first_close[1]), len(normalized))
+    else:
+        print(f"[Parser Warning] Missing <THINK> tags, treating entire response as kv")
+        action['cot'] = ""
+        start, end = 0, len(normalized)
+
+    while start <= end:
+        tab = normalized.find("\t", start, end)
+        if tab < 0:
+            tab = end
+        colon = normalized.find(":", start, tab)
+        if colon >= 0:
+            key = normalized[start:colon].strip()
+            raw_value = normalized[colon + 1:tab]
+            value = raw_value.strip()
+            if "point" in key:
+                position = colon + 1 + len(raw_value) - len(raw_value.lstrip())
+                if len(shifts) > 0:
+                    idx = bisect.bisect_right(shifts, (position, float("inf"))) - 1
+                    position += shifts[idx][1] if idx >= 0 else 0
+                action[key] = _parse_point(key, value, offset + position)
+            else:
+                action[key] = value
+        start = tab + 1
+
+    return action
+
+
+def normalize_action(action):
+    """
+    The fields of an action the protocol sends, in its order: cot, explain, action, summary and the parameters
+    of the action type; raises if the action type is unknown or a parameter is missing.
+    """
+    assert "action" in action or "action_type" in action, f"action {action} should have action or action_type field"
+    assert "explain" in action, f"action {action} should have explain field"
+    assert "cot" in action, f"action {action} should have cot field"
+
+    action_type = action.get('action_type', action.get('action', None))
+    return_action = OrderedDict(
+        {
+            "cot": action['cot'],
+            "explain": action['explain'],
+            "action": action_type,
+            "summary": action.get('summary', ''),
+        }
+    )
+
+    params = ACTION_PARAMS.get(action_type, None)
+    if params is None:
+        raise ValueError(f"Unknown action type {action_type} in action {action}")
+    for key in params:
+        assert key in action, f"action {action} should have {key} field"
+        return_action[key] = action[key]
+    return return_action
+
+
+def format_action(action, with_cot=True):
+    """
+    The text of an action as the model writes it, parse_action reads it back; without the cot, only the fields.
+    """
+    # the fields are only read, a shallow copy is enough to drop action_type
+    action = dict(action)
+    if "action" in action and "action_type" in action:
+        assert action['action'] == action['action_type'], f"action {action} should have same action and action_type field"
+        assert len(action['action']) > 0, f"action {action} should have non-empty action and action_type field"
+        del action['action_type']
+
+    action = normalize_action(action)
+
+    kvs = []
+    for key, value in action.items():
+        key = key.strip()
+
+        if key in ['cot']:
+            continue
+
+        if type(value) == list:
+            value = ",".join([str(v).strip() for v in value])
+        elif type(value) == bool:
+            value = str(value).lower()
+        elif type(value) == int or type(value) == float:
+            value = str(value)
+        else:
+            value = value.translate(_drop_table).strip()
+
+        kvs.append(f"{key}:{value}")
+
+    if not with_cot:
+        return "\t".join(kvs)
+    return f"<THINK> {action['cot']} </THINK>\n" + "\t".join(kvs) + "\n"
+
+
+def _reference_str2action(command_str):
+    """
+    Parser0920Summary.str2action as it was before parse_action, kept to check parse_action against, see __main__.
+    """
+    command_str = command_str.strip()
+
+    command_str = (
+        command_str
+        .replace("<TINK>", "<THINK>").replace("</TINK>", "</THINK>")
+        .replace("<think>", "<THINK>").replace("</think>", "</THINK>")
+    )
+    command_str = re.sub(r"<\s*/?THINK\s*>", lambda m: "<THINK>" if "/" not in m.group() else "</THINK>", command_str, flags=re.IGNORECASE)
+
+    try:
+        cot_part = command_str.split("<THINK>")[1].split("</THINK>")[0].strip()
+        kv_part = command_str.split("</THINK>")[1].strip()
+    except IndexError:
+        print(f"[Parser Warning] Missing <THINK> tags, treating entire response as kv")
+        kv_part = command_str
+        cot_part = ""
+
+    action = OrderedDict()
+    action['cot'] = cot_part
+
+    kvs = [kv.strip() for kv in kv_part.split("\t") if kv.strip()]
+    for kv in kvs:
+        if ":" not in kv:
+            continue
+
+        key = kv.split(":", 1)[0].strip()
+        value = kv.split(":", 1)[1].strip()
+
+        if key == "action":
+            action['action'] = value
+        elif key == "summary":
+            action['summary'] = value
+        elif "point" in key:
+            try:
+                coords = value.replace(",", " ").split()
+                if len(coords) < 2:
+                    raise ValueError(f"Expected 2 coordinates, got {len(coords)}")
+                x, y = int(coords[0]), int(coords[1])
+                action[key] = [x, y]
+            except (ValueError, IndexError) as e:
+                raise ValueError(
+                    f"[Parser Error] Failed to parse point '{value}' for key '{key}': {str(e)}. "
+                    f"Expected format: 'x,y' or 'x y' with integer values"
+                ) from e
+        else:
+            action[key] = value
+
+    return action
+
+
+if __name__ == "__main__":
+    # python copilot_tools/protocol_0920.py [cases]
+    # a fuzz corpus of well-formed, mangled and random responses, parsed by parse_action and _reference_str2action,
+    # which must agree on the action or both fail; then the round trip of format_action and a microbenchmark
+    import io
+    import time
+    import random
+    import contextlib
+
+    cases = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(0)
+
+    tags = ["<THINK>", "</THINK>", "<think>", "</think>", "<TINK>", "</TINK>", "<tink>", "< think >", "</ Think>",
+            "< /THINK>", "< / THINK>", "<\tTHINK\n>", "</TINK >", "<THINK", "THINK>",
+            "<th\u0131nk>", "</thin\u212a>", "\uff1cTHINK\uff1e"]
+    pieces = tags + ["\t", "\n", " ", ":", ",", "\u3000", "explain", "action", "summary", "point", "point1", "point2",
+                     "value", "return", "CLICK", "TYPE", "SLIDE", "500", "-3", "+7", "1_000", "\u0661\u0662", "x",
+                     "打开设置", "：", "a:b:c", "0.5"]
+
+    def well_formed():
+        action_type = rng.choice(list(ACTION_PARAMS))
+        action = {"cot": rng.choice(["", "屏幕中间有设置图标", "the icon\nis there"]), "explain": "点击设置",
+                  "action": action_type, "summary": rng.choice(["", "已打开设置", "opened: settings"])}
+        for key in ACTION_PARAMS[action_type]:
+            if key.startswith("point"):
+                action[key] = [rng.randint(0, 1000), rng.randint(0, 1000)]
+            else:
+                action[key] = rng.choice(["设置", "3", "hello world"])
+        return action
+
+    def mangle(text):
+        chars = list(text)
+        for _ in range(rng.randint(1, 4)):
+            position = rng.randint(0, len(chars))
+            operation = rng.random()
+            if operation < 0.4:
+                chars[position:position] = list(rng.choice(pieces))
+            elif operation < 0.7 and len(chars) > 0:
+                del chars[position:position + rng.randint(1, 8)]
+            else:
+                chars[position:position] = [rng.choice(" \t\n:,<>/")]
+        return "".join(chars)
+
+    corpus = [
+        "",
+        "   ",
+        "<THINK> cot </THINK>\nexplain:open it\taction:CLICK\tpoint:500,500\tsummary:done",
+        "<think>cot</think>explain:x\taction:SLIDE\tpoint1:1 2\tpoint2:3,4,5\tsummary:s",
+        "</THINK>a<THINK>b</THINK>c\td:e</THINK>f:g",
+        "<think>a<think>b</think>explain:x",
+        "explain:no tags\taction:WAIT\tvalue:3",
+        "<THINK>x</THINK>\tpoint:1",
+        "<THINK>x</THINK>\tpoint:a,b",
+        "<THINK>x</THINK>\tpoint:\u0661,\u0662",
+        "<THINK>x</THINK>\t:\t::\tkey:\tpoint:+1_0 -2",
+    ]
+    formatted = [format_action(well_formed()) for _ in range(cases // 2)]
+    corpus += formatted[:cases // 4]
+    corpus += [mangle(text) for text in formatted[cases // 4:]]
+    corpus += ["".join(rng.choice(pieces) for _ in range(rng.randint(1, 30))) for _ in range(cases // 2)]
+
+    def run(parse, text):
+        try:
+            return list(parse(text).items())
+        except ValueError as e:
+            return ("error", type(e).__name__)
+
+    errors = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for text in corpus:
+            expected, got = run(_reference_str2action, text), run(parse_action, text)
+            if expected[0] == "error":
+                assert got[0] == "error", (text, expected, got)
+                errors += 1
+                continue
+            assert got == expected, (text, expected, got)
+    print(f"fuzz: {len(corpus)} responses, parse_action agrees with the reference, {errors} rejected by both")
+
+    # the error positions point at the value in the response as given
+    for text in ["  <think>c</think>\nexplain:x\tpoint: 12,ab\tsummary:s", "< think >c< /think>explain:x\tpoint:7"]:
+        try:
+            parse_action(text)
+        except ActionParseError as e:
+            assert text[e.position:].startswith(("12,ab", "7")), (text, e.position)
+            print("error:", e)
+
+    # the round trip of the actions sent as history
+    for _ in range(cases // 10):
+        action = normalize_action(well_formed())
+        parsed = parse_action(format_action(action))
+        assert list(parsed.items()) == list(action.items()), (action, parsed)
+    print(f"round trip: {cases // 10} actions")
+
+    # microbenchmark on the well-formed responses
+    for name, parse in [("reference str2action", _reference_str2action), ("parse_action", parse_action)]:
+        start_time = time.perf_counter()
+        for text in formatted:
+            parse(text)
+        elapsed = time.perf_counter() - start_time
+        print(f"{name}: {1e6 * elapsed / len(formatted):.2f}us per response")
@@ -33,10 +33,16 @@ local_model_config = {
         #     "is_resize": True,
         #     "target_image_size": (756, 756)
         # }
+
+        # optional to execute the action as soon as it is streamed, time_to_action is logged per step
+        # "stream": True,
     },
 
     "max_steps": 400,
     "delay_after_capture": 2,
+    "settle_config": {
+        "enabled": True,
+    },
     "debug": False
 }
 
@@ -22,7 +22,7 @@ from megfile import smart_open, smart_remove
 # TODO: to manage the usage status of all devices, and meke an option to display only available devices
 def get_device_list():
     """
-    Get the list of connected devices.
+    Get the list of connected devices, from the in-memory device registry.
     
     :return: 设备列表
     :rtype: list of str, each str is a device ID
@@ -41,35 +41,29 @@ def get_screenshot(device_id: str, ):
 
     """
 
-    from copilot_front_end.mobile_action_helper import capture_screenshot
+    from copilot_front_end.mobile_action_helper import capture_screenshot_bytes
 
-    screenshot_url = capture_screenshot(device_id)
-
-
-    with smart_open(screenshot_url, "rb") as f:
-        image_data = f.read()
+    image_data = capture_screenshot_bytes(device_id)
     screenshot_b64 = base64.b64encode(image_data).decode('utf-8')
 
-    smart_remove(screenshot_url)
-
     return screenshot_b64
 
     
 
-# TODO: to get the list of running apps on the device rather than hardcoding
 # TODO: to execute command only when device is available
 def get_available_apps(device_id: str):
     """
     Get the list of available apps on the device.
+    The installed packages are scanned once per device per day, see copilot_front_end/installed_apps.py.
     :param device_id: 设备ID
     :type device_id: str
     :return: 可用应用列表
-    :rtype: list of str, each str is an app package name
+    :rtype: list of str, each str is an app name
     """
 
-    from copilot_front_end.package_map import package_name_map
+    from copilot_front_end.installed_apps import get_installed_app_names
 
-    app_list = list(package_name_map.keys())
+    app_list = get_installed_app_names(device_id)
 
     return app_list
 
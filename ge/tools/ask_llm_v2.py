@@ -2,94 +2,55 @@ import sys
 if "." not in sys.path:
     sys.path.append(".")
 
-from megfile import smart_open
-import base64
+from tools.image_pipeline import get_image_asset
+from tools.llm_providers import get_llm_balancer, get_provider_registry
+from tools.llm_cache import make_cache_key
 
-from openai import OpenAI
-import yaml
+from openai.types.chat import ChatCompletion, ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_chunk import ChoiceDelta, ChoiceDeltaToolCall, ChoiceDeltaToolCallFunction
+from openai.types.chat.chat_completion_message_tool_call import Function
 
 import json
 import time
 
-def ask_llm_anything(model_provider, model_name, messages, args= {
-    "max_tokens": 256,
-    "temperature": 0.5,
-    "top_p": 1.0,
-    "frequency_penalty": 0.0,
-}, resize_config=None):
-
-    with smart_open("model_config.yaml", "r") as f:
-        model_config = yaml.safe_load(f)
-    
-
-    if model_provider in model_config:
-        api_base = "http://192.168.120.78:12349/v1"
-        api_key = "xx"
-        client = OpenAI(api_key=api_key, base_url=api_base)
-
-    else:
-        raise ValueError(f"Unknown model provider: {model_provider}")
-    
-    # preprocess
-    def preprocess_messages(messages):
-        # Implement any necessary preprocessing steps for the messages
-        # return messages
-        for msg in messages:
-            if msg.get('content') is None:
+def preprocess_messages(messages, resize_config=None):
+    """
+    Turn the image paths and image_b64 contents of the messages into base64 image URLs, in place.
+    """
+    for msg in messages:
+        if msg.get('content') is None:
+            continue
+        if type(msg['content']) == str:
+            continue
+        assert type(msg['content']) == list
+        for content in msg['content']:
+            if content['type'] == "text":
                 continue
-            if type(msg['content']) == str:
-                continue
-            assert type(msg['content']) == list
-            for content in msg['content']:
-                if content['type'] == "text":
+            assert content['type'] == "image_url" or content['type'] == "image_b64"
+            if content['type'] == "image_url":
+                url = content['image_url']['url']
+                # to check if the image is already in base64 format
+                if url.startswith("data:image/"):
                     continue
-                assert content['type'] == "image_url" or content['type'] == "image_b64"
-                if content['type'] == "image_url":
-                    url = content['image_url']['url']
-                    # to check if the image is already in base64 format
-                    if url.startswith("data:image/"):
-                        continue
-                    else:
-                        image_bytes = smart_open(url, mode="rb").read()
-                        b64 = base64.b64encode(image_bytes).decode('utf-8')
-
-                        # to judge the image format
-                        if image_bytes[0:4] == b"\x89PNG":
-                            content['image_url']['url'] = "data:image/png;base64," + b64
-                        elif image_bytes[0:2] == b"\xff\xd8":
-                            content['image_url']['url'] = "data:image/jpeg;base64," + b64
-                        else:
-                            content['image_url']['url'] = "data:image/png;base64," + b64
-
                 else:
-                    assert content['type'] == "image_b64"
-                    b64 = content['image_b64']['b64_json']
-                    del content['image_b64']
-                    content['image_url'] = {"url": "data:image/png;base64," + b64}
-                    content['type'] = "image_url"
-                
-                if resize_config is not None and resize_config.get("is_resize", False) == True:
-                    image_url = content['image_url']['url']
-                    image_b64_url = image_url.split(",", 1)[1]
-                    image_data = base64.b64decode(image_b64_url)
-                    from PIL import Image
-                    import io
-                    image = Image.open(io.BytesIO(image_data))
-                    image = image.resize(size= resize_config['target_image_size'])
-                    image_data = io.BytesIO()
-                    image = image.convert('RGB')
-                    image.save(image_data, format="JPEG", quality=85)
-                    image_data = image_data.getvalue()
-                    b64_image = base64.b64encode(image_data).decode('utf-8')
-                    content['image_url']['url'] = f"data:image/jpeg;base64,{b64_image}"
-
-
-        return messages
-    messages = preprocess_messages(messages)
+                    # the original bytes in their own format, png or jpeg
+                    content['image_url']['url'] = get_image_asset(url).b64_url()
 
-    # current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    start_time = time.time()
-    
+            else:
+                assert content['type'] == "image_b64"
+                b64 = content['image_b64']['b64_json']
+                del content['image_b64']
+                content['image_url'] = {"url": "data:image/png;base64," + b64}
+                content['type'] = "image_url"
+            
+            if resize_config is not None and resize_config.get("is_resize", False) == True:
+                # reuses the variant if an earlier stage already resized this image
+                image_url = content['image_url']['url']
+                content['image_url']['url'] = get_image_asset(image_url).b64_url(size=resize_config['target_image_size'], quality=85)
+
+    return messages
+
+def make_completion_kwargs(model_name, messages, args):
     kwargs = {
         "model": model_name,
         "messages": messages,
@@ -103,26 +64,205 @@ def ask_llm_anything(model_provider, model_name, messages, args= {
         kwargs["tools"] = args["tools"]
     if "tool_choice" in args:
         kwargs["tool_choice"] = args["tool_choice"]
+    return kwargs
 
-    completion = client.chat.completions.create(**kwargs)
-
-    end_time = time.time()
-    print(f"LLM {model_name} inference time: {end_time - start_time:.2f} seconds")
-    
+def completion_result(completion, args):
+    """
+    What ask_llm_anything returns for a completion: the message if tools are given, the content otherwise,
+    after the reasoning if the model returned one.
+    """
+    message = completion.choices[0].message
     if "tools" in args:
-        return completion.choices[0].message
-
-    result = completion.choices[0].message.content
+        return message
 
-    print("llm ask id:", completion.id)
+    result = message.content
 
     # Try to get reasoning content if available (e.g. for DeepSeek R1)
-    message = completion.choices[0].message
     reasoning = getattr(message, "reasoning_content", None)
     
     if reasoning is not None and len(reasoning) > 0:
         result = "<think>" + reasoning + "</think>" + "\n" + result
 
+    return result
+
+def ask_llm_anything(model_provider, model_name, messages, args= {
+    "max_tokens": 256,
+    "temperature": 0.5,
+    "top_p": 1.0,
+    "frequency_penalty": 0.0,
+}, resize_config=None, session_id=None, hedge_config=None, call_stats=None, completion_fn=None, response_cache=None):
+    """
+    Ask the model of a provider, returns the content, or the message if tools are given.
+    With hedge_config (see HedgePolicy), a request slower than the recent latencies is duplicated to another endpoint;
+    call_stats, if given, receives the hedging stats of the request.
+    completion_fn(kwargs) -> ChatCompletion replaces the request to the provider, e.g. to batch it with others.
+    With a response_cache (see ResponseCache), a request identical to a cached one is answered from the cache;
+    call_stats then receives "response_cache": "hit" or "miss".
+    """
+
+    # shared keep-alive clients of the provider endpoints, with the api_base / api_key of model_config.yaml
+    balancer = get_llm_balancer(model_provider)
+    
+    # preprocess
+    messages = preprocess_messages(messages, resize_config)
+
+    # current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    start_time = time.time()
+    
+    kwargs = make_completion_kwargs(model_name, messages, args)
+
+    cache_key = None
+    if response_cache is not None:
+        cache_key = make_cache_key(kwargs)
+        cached = response_cache.get(cache_key)
+        if call_stats is not None:
+            call_stats["response_cache"] = "miss" if cached is None else "hit"
+        if cached is not None:
+            print(f"LLM {model_name} answered from the response cache")
+            return completion_result(ChatCompletion.model_validate(cached), args)
+
+    # the requests of a session stay on one endpoint, failed over to another one if it is down
+    if completion_fn is not None:
+        completion = completion_fn(kwargs)
+    elif hedge_config is not None and hedge_config.get("enabled", True):
+        policy = balancer.get_hedge_policy(model_name, hedge_config)
+        completion = balancer.call_hedged(lambda client: client.chat.completions.create(**kwargs), policy,
+            session_id=session_id, call_stats=call_stats)
+    else:
+        completion = balancer.call(lambda client: client.chat.completions.create(**kwargs), session_id=session_id)
+
+    end_time = time.time()
+    print(f"LLM {model_name} inference time: {end_time - start_time:.2f} seconds")
+
+    if cache_key is not None:
+        response_cache.put(cache_key, completion.model_dump(), model_name=model_name)
+
+    if "tools" not in args:
+        print("llm ask id:", completion.id)
+
     # print(f"LLM {model_name} says:\n--------------start--------------\n{result}\n---------------end---------------")
 
-    return result
\ No newline at end of file
+    return completion_result(completion, args)
+
+def ask_llm_batch(model_provider, kwargs_list):
+    """
+    Send several chat completion requests in one submission, for providers with a batch_api_path in model_config.yaml.
+    The endpoint takes {"requests": [chat completion request, ...]} and answers {"responses": [chat completion, ...]}
+    in the same order. Returns the ChatCompletion of each request.
+    """
+    balancer = get_llm_balancer(model_provider)
+    batch_api_path = get_provider_registry().get_provider_settings(model_provider).get("batch_api_path", None)
+    assert batch_api_path is not None, f"model provider {model_provider} has no batch_api_path"
+
+    result = balancer.call(lambda client: client.post(batch_api_path, cast_to=object, body={"requests": kwargs_list}))
+    responses = result["responses"]
+    assert len(responses) == len(kwargs_list), f"batch of {len(kwargs_list)} requests got {len(responses)} responses"
+    return [ChatCompletion.model_validate(response) for response in responses]
+
+def stream_llm_anything(model_provider, model_name, messages, args= {
+    "max_tokens": 256,
+    "temperature": 0.5,
+    "top_p": 1.0,
+    "frequency_penalty": 0.0,
+}, resize_config=None, on_delta=None, session_id=None, response_cache=None, call_stats=None):
+    """
+    Same as ask_llm_anything, with the completion streamed: on_delta(delta) is called with the delta of every chunk
+    as it arrives, e.g. to parse the action before the model is done. Returns the same result as ask_llm_anything.
+    on_delta runs on the event loop of the requests and must not block.
+    A completion from the response_cache is handed to on_delta as a single delta.
+    """
+    balancer = get_llm_balancer(model_provider)
+    messages = preprocess_messages(messages, resize_config)
+
+    start_time = time.time()
+
+    kwargs = make_completion_kwargs(model_name, messages, args)
+
+    cache_key = None
+    if response_cache is not None:
+        cache_key = make_cache_key(kwargs)
+        cached = response_cache.get(cache_key)
+        if call_stats is not None:
+            call_stats["response_cache"] = "miss" if cached is None else "hit"
+        if cached is not None:
+            print(f"LLM {model_name} answered from the response cache")
+            completion = ChatCompletion.model_validate(cached)
+            message = completion.choices[0].message
+            if on_delta is not None:
+                on_delta(ChoiceDelta(
+                    role="assistant",
+                    content=message.content,
+                    tool_calls=[
+                        ChoiceDeltaToolCall(index=index, id=tool_call.id, type="function",
+                            function=ChoiceDeltaToolCallFunction(name=tool_call.function.name, arguments=tool_call.function.arguments))
+                        for index, tool_call in enumerate(message.tool_calls or [])
+                    ] or None,
+                ))
+            return completion_result(completion, args)
+
+    kwargs["stream"] = True
+
+    # a stream is only failed over to another endpoint until its first delta is handed out
+    delivered = [False]
+
+    async def read_stream(client):
+        completion_id = None
+        content_parts, reasoning_parts = [], []
+        # index -> {"id", "name", "arguments" parts}
+        tool_calls = {}
+        async for chunk in await client.chat.completions.create(**kwargs):
+            completion_id = chunk.id
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+
+            if delta.content:
+                content_parts.append(delta.content)
+            reasoning = getattr(delta, "reasoning_content", None)
+            if reasoning:
+                reasoning_parts.append(reasoning)
+            for tool_call_delta in (delta.tool_calls or []):
+                tool_call = tool_calls.setdefault(tool_call_delta.index, {"id": None, "name": "", "arguments": []})
+                if tool_call_delta.id:
+                    tool_call["id"] = tool_call_delta.id
+                if tool_call_delta.function is not None:
+                    if tool_call_delta.function.name:
+                        tool_call["name"] += tool_call_delta.function.name
+                    if tool_call_delta.function.arguments:
+                        tool_call["arguments"].append(tool_call_delta.function.arguments)
+
+            if on_delta is not None:
+                delivered[0] = True
+                on_delta(delta)
+        return completion_id, content_parts, reasoning_parts, tool_calls
+
+    completion_id, content_parts, reasoning_parts, tool_calls = balancer.call(
+        read_stream, session_id=session_id, can_retry=lambda: not delivered[0])
+
+    end_time = time.time()
+    print(f"LLM {model_name} streamed inference time: {end_time - start_time:.2f} seconds")
+    print("llm ask id:", completion_id)
+
+    content = "".join(content_parts)
+    message = ChatCompletionMessage(
+        role="assistant",
+        content=content if len(content) > 0 or "tools" not in args else None,
+        tool_calls=[
+            ChatCompletionMessageToolCall(
+                id=tool_call["id"] or f"call_{index}",
+                type="function",
+                function=Function(name=tool_call["name"], arguments="".join(tool_call["arguments"])),
+            )
+            for index, tool_call in sorted(tool_calls.items())
+        ] or None,
+    )
+    if len(reasoning_parts) > 0:
+        message.reasoning_content = "".join(reasoning_parts)
+    completion = ChatCompletion(
+        id=completion_id or "", object="chat.completion", created=int(start_time), model=model_name,
+        choices=[{"index": 0, "finish_reason": "stop", "message": message}],
+    )
+
+    if cache_key is not None:
+        response_cache.put(cache_key, completion.model_dump(), model_name=model_name)
+    return completion_result(completion, args)
@@ -0,0 +1,59 @@
+import sys
+import asyncio
+import threading
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    """
+    Get the process wide event loop running in a daemon thread, started on first use.
+    The sync wrappers of the async APIs run their coroutines on it.
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="gelab-async-runner", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run_sync(coro, timeout=None):
+    """
+    Run a coroutine on the background loop and block until it is done.
+    Works from plain threads and from threads running their own event loop.
+    On timeout the coroutine is cancelled and concurrent.futures.TimeoutError is raised.
+    """
+    loop = get_background_loop()
+    assert threading.current_thread() is not _loop_thread, "run_sync can not be called from a coroutine on the background loop, await it instead"
+
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result(timeout=timeout)
+    except BaseException:
+        # e.g. a timeout or KeyboardInterrupt, do not leave the coroutine running
+        future.cancel()
+        raise
+
+
+if __name__ == "__main__":
+    import time
+
+    async def sleep_and_return(seconds, value):
+        await asyncio.sleep(seconds)
+        return value
+
+    start_time = time.time()
+    assert run_sync(sleep_and_return(0.1, "done")) == "done"
+
+    async def gather_many():
+        return await asyncio.gather(*[sleep_and_return(0.1, i) for i in range(100)])
+
+    assert run_sync(gather_many()) == list(range(100))
+    print(f"2 sync calls, one gathering 100 coroutines: {time.time() - start_time:.2f}s")
@@ -0,0 +1,352 @@
+import io
+import sys
+import base64
+import threading
+import contextlib
+import contextvars
+
+from collections import OrderedDict
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+from PIL import Image
+from megfile import smart_open, smart_stat
+
+# the image operations that are counted, per step and in total
+IMAGE_OPS = ["decode", "encode", "resize", "b64_decode", "b64_encode", "read"]
+
+_op_totals = {op: 0 for op in IMAGE_OPS}
+_op_totals_lock = threading.Lock()
+# the counter of the step running in the current thread or task, see count_image_ops
+_step_op_counts = contextvars.ContextVar("gelab_image_op_counts", default=None)
+
+
+def _count(op):
+    with _op_totals_lock:
+        _op_totals[op] += 1
+    counts = _step_op_counts.get()
+    if counts is not None:
+        counts[op] += 1
+
+
+@contextlib.contextmanager
+def count_image_ops():
+    """
+    Count the image operations of the enclosed code, e.g. of one step:
+
+        with count_image_ops() as image_ops:
+            ...
+        log["image_ops"] = image_ops
+    """
+    counts = {op: 0 for op in IMAGE_OPS}
+    token = _step_op_counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _step_op_counts.reset(token)
+
+
+def get_image_op_totals():
+    with _op_totals_lock:
+        return dict(_op_totals)
+
+
+def _sniff_format(data):
+    if data[:2] == b"\xff\xd8":
+        return "jpeg"
+    if data[:4] == b"\x89PNG":
+        return "png"
+    # as preprocess_messages of ask_llm_anything always assumed
+    return "png"
+
+
+class ImageAsset:
+    """
+    One screenshot through the whole pipeline: the original encoded bytes, or the frame it was captured as,
+    and every variant derived from it, each computed once and reused by the later stages.
+
+    The variants are keyed by (size, quality): size None keeps the original size, quality None keeps
+    the original encoding when there is one, so the original bytes are passed through untouched.
+    """
+
+    def __init__(self, data=None, image=None, image_format=None, b64_data=None):
+        assert data is not None or image is not None or b64_data is not None, "ImageAsset needs data, image or b64_data"
+        self._data = data
+        self._b64_data = b64_data
+        self._image = image
+        self._format = image_format
+
+        self._lock = threading.RLock()
+        # size -> resized PIL Image
+        self._resized = {}
+        # (size, quality) -> JPEG bytes
+        self._jpeg = {}
+        # (size, quality) -> base64 URL
+        self._urls = {}
+
+    @classmethod
+    def from_url(cls, url):
+        """
+        Wrap a base64 data URL or an image path, nothing is decoded until a variant needs it.
+        """
+        if url.startswith("data:image/"):
+            header, b64_data = url.split(",", 1)
+            image_format = header[len("data:image/"):].split(";", 1)[0]
+            asset = cls(b64_data=b64_data, image_format="jpeg" if image_format == "jpg" else image_format)
+            # the original URL is its own unmodified variant
+            asset._urls[(None, None)] = url
+            return asset
+
+        with smart_open(url, "rb") as f:
+            data = f.read()
+        _count("read")
+        return cls(data=data)
+
+    @property
+    def data(self):
+        """
+        The original encoded bytes; an asset made from a frame is encoded as JPEG at quality 85 once.
+        """
+        with self._lock:
+            if self._data is None:
+                if self._b64_data is not None:
+                    self._data = base64.b64decode(self._b64_data)
+                    _count("b64_decode")
+                else:
+                    self._data = self.jpeg(quality=85)
+                    self._format = "jpeg"
+            return self._data
+
+    @property
+    def format(self):
+        with self._lock:
+            if self._format is None:
+                self._format = _sniff_format(self.data)
+            return self._format
+
+    @property
+    def image(self):
+        """
+        The decoded image, shared, must not be modified.
+        """
+        with self._lock:
+            if self._image is None:
+                image = Image.open(io.BytesIO(self.data))
+                image.load()
+                _count("decode")
+                self._image = image
+            return self._image
+
+    @property
+    def size(self):
+        with self._lock:
+            if self._image is not None:
+                return self._image.size
+            # only the header is parsed, the pixels are not decoded
+            return Image.open(io.BytesIO(self.data)).size
+
+    def _normalize_size(self, size):
+        if size is None:
+            return None
+        size = (int(size[0]), int(size[1]))
+        return None if size == self.size else size
+
+    def resized(self, size=None):
+        """
+        The image at the given size, resized once per size.
+        """
+        size = self._normalize_size(size)
+        if size is None:
+            return self.image
+        with self._lock:
+            if size not in self._resized:
+                self._resized[size] = self.image.resize(size=size)
+                _count("resize")
+            return self._resized[size]
+
+    def jpeg(self, size=None, quality=85):
+        """
+        The JPEG bytes at the given size and quality; the original bytes when they already are a JPEG of that size.
+        """
+        size = self._normalize_size(size)
+        with self._lock:
+            if size is None and (self._data is not None or self._b64_data is not None) and self.format == "jpeg":
+                return self.data
+
+            key = (size, quality)
+            if key not in self._jpeg:
+                image = self.resized(size)
+                # RGBX frames wrapping a raw framebuffer are encoded as they are, without an extra conversion pass
+                if image.mode not in ["RGB", "RGBX"]:
+                    image = image.convert("RGB")
+                buffered = io.BytesIO()
+                image.save(buffered, format="JPEG", quality=quality)
+                _count("encode")
+                self._jpeg[key] = buffered.getvalue()
+            return self._jpeg[key]
+
+    def b64_url(self, size=None, quality=None):
+        """
+        The base64 URL of a variant, the original bytes in their own format if neither size nor quality is given.
+        """
+        size = self._normalize_size(size)
+        key = (size, quality)
+        with self._lock:
+            if key not in self._urls:
+                if size is None and quality is None:
+                    if self._b64_data is not None:
+                        b64_data, image_format = self._b64_data, self.format
+                    else:
+                        data = self.data
+                        b64_data, image_format = base64.b64encode(data).decode("utf-8"), self.format
+                        _count("b64_encode")
+                else:
+                    data = self.jpeg(size, 85 if quality is None else quality)
+                    if data is self._data:
+                        # a JPEG original, already at the requested size
+                        return self.b64_url()
+                    b64_data, image_format = base64.b64encode(data).decode("utf-8"), "jpeg"
+                    _count("b64_encode")
+                self._urls[key] = f"data:image/{image_format};base64,{b64_data}"
+            return self._urls[key]
+
+
+class ImageAssetRegistry:
+    """
+    LRU map from the URLs and paths an image is known by to its ImageAsset, so a stage that only gets a URL,
+    e.g. LocalServer receiving the screenshot of an in-process client, reuses the work of the stages before it.
+    An asset may hold a decoded full screen frame, about 10MB, so only the recent ones are kept.
+    A path is known by (path, mtime, size), so a file written again at the same path is read again.
+    """
+
+    def __init__(self, max_assets=32):
+        self.max_assets = max_assets
+        self._lock = threading.Lock()
+        self._assets = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, key, asset):
+        with self._lock:
+            self._assets[key] = asset
+            self._assets.move_to_end(key)
+            while len(self._assets) > self.max_assets:
+                self._assets.popitem(last=False)
+        return asset
+
+    def _key(self, url):
+        if url.startswith("data:image/"):
+            return url
+        stat = smart_stat(url)
+        return (url, stat.mtime, stat.size)
+
+    def get(self, url):
+        """
+        Get the asset of a URL or path, wrapped and registered if it is not known yet.
+        """
+        key = self._key(url)
+        with self._lock:
+            asset = self._assets.get(key, None)
+            if asset is not None:
+                self._assets.move_to_end(key)
+                self.hits += 1
+                return asset
+            self.misses += 1
+        return self.register(key, ImageAsset.from_url(url))
+
+    def register_path(self, path, asset):
+        """
+        Register the asset of an image file as it is on disk now, e.g. right after it is written.
+        """
+        return self.register(self._key(path), asset)
+
+
+_image_asset_registry = None
+_image_asset_registry_lock = threading.Lock()
+
+
+def get_image_asset_registry():
+    global _image_asset_registry
+    with _image_asset_registry_lock:
+        if _image_asset_registry is None:
+            _image_asset_registry = ImageAssetRegistry()
+        return _image_asset_registry
+
+
+def get_image_asset(url):
+    """
+    Get the ImageAsset behind a base64 URL or an image path.
+    """
+    return get_image_asset_registry().get(url)
+
+
+def image_asset_from_frame(image, resize_config=None, quality=85):
+    """
+    Wrap a captured frame and return (asset, b64_url): the JPEG URL sent to the server, resized if resize_config says so.
+    The URL is registered, so an in-process server gets the asset back instead of decoding the URL.
+    """
+    asset = ImageAsset(image=image)
+    size = None
+    if resize_config and resize_config.get("is_resize", False) == True:
+        size = resize_config["target_image_size"]
+
+    if asset._normalize_size(size) is None:
+        # the original of the asset becomes the JPEG itself, passed through untouched by the later stages
+        b64_url = asset.b64_url()
+    else:
+        b64_url = asset.b64_url(size=size, quality=quality)
+        asset = ImageAsset(data=asset.jpeg(size=size, quality=quality), image=asset.resized(size), image_format="jpeg")
+        asset._urls[(None, None)] = b64_url
+    get_image_asset_registry().register(b64_url, asset)
+    return asset, b64_url
+
+
+if __name__ == "__main__":
+    # python tools/image_pipeline.py
+    # one step of an in-process client and LocalServer: capture, send, save, resize for the model, preprocess in ask_llm
+    import time
+
+    frame = Image.effect_noise((1080, 2400), 64).convert("RGB")
+    target_size = (728, 1620)
+
+    def jpeg_url(image, size=None):
+        if size is not None:
+            image = image.resize(size=size)
+        buffered = io.BytesIO()
+        image.convert("RGB").save(buffered, format="JPEG", quality=85)
+        return "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+    def decode_url(url):
+        return Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1])))
+
+    # before: every stage decodes and re-encodes on its own, 4 decodes and 4 encodes
+    start_time = time.perf_counter()
+    url = jpeg_url(frame)
+    saved = decode_url(url)
+    saved.convert("RGB").save(io.BytesIO(), format="JPEG", quality=85)
+    resized_url = jpeg_url(decode_url(url), target_size)
+    jpeg_url(decode_url(resized_url), target_size)
+    legacy_time = time.perf_counter() - start_time
+
+    with count_image_ops() as image_ops:
+        start_time = time.perf_counter()
+        asset, url = image_asset_from_frame(frame)
+        saved = get_image_asset(url).jpeg()
+        resized_url = get_image_asset(url).b64_url(size=target_size)
+        assert get_image_asset(url).b64_url(size=target_size) is resized_url
+        pipeline_time = time.perf_counter() - start_time
+
+    print(f"legacy: {1000 * legacy_time:.1f}ms, 4 decodes and 4 encodes")
+    print(f"pipeline: {1000 * pipeline_time:.1f}ms, {image_ops}")
+
+    # a file written again at the same path is read again
+    import os
+    import tempfile
+
+    image_path = os.path.join(tempfile.mkdtemp(), "step.png")
+    Image.new("RGB", (8, 8), (255, 0, 0)).save(image_path)
+    assert get_image_asset(image_path) is get_image_asset(image_path)
+    Image.new("RGB", (8, 9), (0, 255, 0)).save(image_path)
+    assert get_image_asset(image_path).image.getpixel((0, 0)) == (0, 255, 0)
@@ -1,5 +1,8 @@
 import base64
 import os
+import sys
+import struct
+import numpy as np
 from PIL import Image, ImageDraw
 from megfile import smart_open
 import io
@@ -7,43 +10,77 @@ import io
 
 from megfile import smart_open, smart_makedirs, smart_exists, smart_copy
 
+if "." not in sys.path:
+    sys.path.append(".")
+
+from tools.image_pipeline import get_image_asset, image_asset_from_frame
+
+def _target_size(resize_config):
+    if resize_config and resize_config.get("is_resize", False) == True:
+        return resize_config['target_image_size']
+    return None
+
 def make_b64_url(image_path, resize_config=None):
     """
-    Convert an image file to a base64 URL.
+    Convert an image file, or a base64 data URL, to a JPEG base64 URL.
+    JPEG images that need no resize are passed through without re-encoding.
     """
-    image_postfix = os.path.splitext(image_path)[-1].lower()
-    with smart_open(image_path, "rb") as f:
-        image_data = f.read()
-    
-    # print(resize_config)
-    image = Image.open(io.BytesIO(image_data))
+    return get_image_asset(image_path).b64_url(size=_target_size(resize_config), quality=85)
 
-    if resize_config and resize_config.get("is_resize", False) == True:
-        image = image.resize(size= resize_config['target_image_size'])
-    
-    image_data = io.BytesIO()
-    image = image.convert('RGB')
-    image.save(image_data, format="JPEG", quality=85)
-    image_postfix = ".jpeg"
-    image_data = image_data.getvalue()
+def make_b64_url_from_image(image, resize_config=None):
+    """
+    Convert a PIL Image to a JPEG base64 URL, resize it first if resize_config is given.
+    """
+    asset, b64_url = image_asset_from_frame(image, resize_config=resize_config)
+    return b64_url
+
+# android PixelFormat of the raw `screencap` output -> (PIL raw mode, bytes per pixel)
+# the alpha channel of a screen is always opaque, so it is treated as padding
+_RAW_SCREENCAP_FORMATS = {
+    1: ("RGBX", 4),  # RGBA_8888
+    2: ("RGBX", 4),  # RGBX_8888
+    3: ("RGB", 3),   # RGB_888
+    5: ("BGRX", 4),  # BGRA_8888
+}
+
+def decode_raw_screencap(raw_data):
+    """
+    Wrap the raw output of `screencap` (without -p) in a NumPy array without copying the pixels.
+    The header is width, height and format as little endian uint32, Android 9+ appends a dataspace uint32.
+    :return: (pixels, raw_mode), pixels is a (height, width, bytes_per_pixel) uint8 array; None if the header is unknown.
+    """
+    if len(raw_data) < 12:
+        return None
+
+    width, height, pixel_format = struct.unpack_from("<III", raw_data, 0)
+    if pixel_format not in _RAW_SCREENCAP_FORMATS or width == 0 or height == 0:
+        return None
+
+    raw_mode, bytes_per_pixel = _RAW_SCREENCAP_FORMATS[pixel_format]
+    pixel_bytes = width * height * bytes_per_pixel
 
-    b64_image = base64.b64encode(image_data).decode('utf-8')
-    return f"data:image/{image_postfix[1:]};base64,{b64_image}"
+    header_size = len(raw_data) - pixel_bytes
+    if header_size not in [12, 16]:
+        return None
+
+    pixels = np.frombuffer(raw_data, dtype=np.uint8, count=pixel_bytes, offset=header_size)
+    pixels = pixels.reshape(height, width, bytes_per_pixel)
+    return pixels, raw_mode
+
+def raw_pixels_to_image(pixels, raw_mode):
+    """
+    Build a PIL Image from the pixels returned by decode_raw_screencap.
+    RGBX pixels are shared with the NumPy array, other formats are unpacked into RGB in a single pass.
+    """
+    height, width = pixels.shape[0], pixels.shape[1]
+    return Image.frombuffer("RGB", (width, height), pixels, "raw", raw_mode, 0, 1)
 
 def read_from_url(image_url):
     """
     Read an image from a base64 URL and return a PIL Image.
     """
-    if image_url.startswith("data:image/"):
-        header, b64_data = image_url.split(",", 1)
-        image_data = base64.b64decode(b64_data)
-        image = Image.open(io.BytesIO(image_data))
-        return image
-    else:
-        with smart_open(image_url, "rb") as f:
-            image_data = f.read()
-        image = Image.open(io.BytesIO(image_data))
-        return image
+    # a copy, the decoded image of the asset is shared
+    return get_image_asset(image_url).image.copy()
 
 
 def draw_points(image_path, image_path_save, points, color=(255, 0, 0, 128), return_image=False):
@@ -96,9 +133,76 @@ def draw_points(image_path, image_path_save, points, color=(255, 0, 0, 128), ret
         
         return image_path_save
 
+# small `screencap` dumps of a 4x3 frame, see tools/screencap_dumps/README.md
+_SCREENCAP_DUMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "screencap_dumps")
+
+def check_raw_screencap_dumps(dump_dir=_SCREENCAP_DUMP_DIR):
+    """
+    Decode the dumps of dump_dir and compare them with expected.png, the unknown formats must be refused.
+    """
+    expected = np.asarray(Image.open(os.path.join(dump_dir, "expected.png")).convert("RGB"))
+
+    for dump_name in ["rgba_8888_header12.raw", "rgba_8888_header16.raw", "rgbx_8888_header16.raw", "rgb_888_header16.raw", "bgra_8888_header16.raw"]:
+        with open(os.path.join(dump_dir, dump_name), "rb") as f:
+            raw_data = f.read()
+        raw_frame = decode_raw_screencap(raw_data)
+        assert raw_frame is not None, f"{dump_name} was not decoded"
+        assert raw_frame[0].shape[:2] == expected.shape[:2], f"{dump_name}: shape {raw_frame[0].shape}"
+        image = raw_pixels_to_image(*raw_frame)
+        # RGBX images share the buffer of the dump
+        assert image.mode in ["RGB", "RGBX"] and np.array_equal(np.asarray(image.convert("RGB")), expected), f"{dump_name}: pixels differ"
+        if raw_frame[1] in ["RGB", "RGBX"]:
+            # the strided view of the settle frames reads the same pixels
+            assert np.array_equal(raw_frame[0][::2, ::2, :3], expected[::2, ::2]), f"{dump_name}: strided view differs"
+        # a cut transfer leaves no valid header size
+        assert decode_raw_screencap(raw_data[:-1]) is None, f"{dump_name}: truncated dump was decoded"
+
+    with open(os.path.join(dump_dir, "rgb_565_header16.raw"), "rb") as f:
+        assert decode_raw_screencap(f.read()) is None, "RGB_565 is not supported, it must fall back to png"
+    assert decode_raw_screencap(b"") is None
+
+def check_png_fallback(dump_dir=_SCREENCAP_DUMP_DIR):
+    """
+    Capture the dumps in raw capture mode through a local stand-in adb server, whose `screencap -p` prints expected.png;
+    an unknown format switches the device to png capture mode.
+    """
+    import tempfile
+    from copilot_front_end.adb_protocol import _StandInAdbServer
+    from copilot_front_end.adb_session import set_adb_backend
+    from copilot_front_end.async_executor import set_capture_mode, get_capture_mode
+    from copilot_front_end.mobile_action_helper import capture_screenshot_frame
+
+    bin_dir = tempfile.mkdtemp()
+    dump_path = os.path.join(bin_dir, "current.raw")
+    with open(os.path.join(bin_dir, "screencap"), "w") as f:
+        f.write(f'#!/bin/sh\nif [ "$1" = "-p" ]; then cat {dump_dir}/expected.png; else cat {dump_path}; fi\n')
+    os.chmod(os.path.join(bin_dir, "screencap"), 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+    stand_in = _StandInAdbServer()
+    os.environ["ANDROID_ADB_SERVER_PORT"] = str(stand_in.port)
+    set_adb_backend("socket")
+
+    expected = np.asarray(Image.open(os.path.join(dump_dir, "expected.png")).convert("RGB"))
+    for dump_name, capture_mode in [("rgbx_8888_header16.raw", "raw"), ("rgb_565_header16.raw", "png")]:
+        smart_copy(os.path.join(dump_dir, dump_name), dump_path)
+        # None is the only device of the stand-in
+        set_capture_mode(None, "raw")
+        image = capture_screenshot_frame(None)
+        assert np.array_equal(np.asarray(image.convert("RGB")), expected), f"{dump_name}: captured pixels differ"
+        assert get_capture_mode(None) == capture_mode, f"{dump_name}: capture mode {get_capture_mode(None)}"
+
 if __name__ == "__main__":
+    # python tools/image_tools.py [image_path]
+    # without an image path, the raw screencap decoding is checked on the dumps of tools/screencap_dumps
+    if len(sys.argv) == 1:
+        check_raw_screencap_dumps()
+        check_png_fallback()
+        print("raw screencap dumps: ok")
+        sys.exit(0)
+
     # Example usage
-    image_path = "tmp_screenshot/uuid_4bead247-acca-4272-bd11-ed67d06fd757.png"  # Replace with your image path
+    image_path = sys.argv[1]
     resize_config = {
         "is_resize": True,
         "target_image_size": (800, 600)  # Resize to 800x600 pixels
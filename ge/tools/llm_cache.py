@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import atexit
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+
+def _canonical_content(content):
+    # an image is known by the hash of its bytes as sent, the same screenshot gives the same key whatever its path
+    if content.get("type") == "image_url":
+        url = content["image_url"]["url"]
+        return {"type": "image_sha256", "sha256": hashlib.sha256(url.encode("utf-8")).hexdigest()}
+    return content
+
+
+def make_cache_key(kwargs):
+    """
+    The key of a chat completion request: the model, the messages with every image replaced by its hash,
+    and the sampling args, as the kwargs of make_completion_kwargs after preprocess_messages.
+    """
+    canonical = {}
+    for key, value in kwargs.items():
+        if key == "stream":
+            # a streamed and a plain request get the same completion
+            continue
+        if key == "messages":
+            value = [
+                dict(msg, content=[_canonical_content(content) for content in msg["content"]])
+                if type(msg.get("content")) == list else msg
+                for msg in value
+            ]
+        canonical[key] = value
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    A content-addressed on-disk cache of chat completions, one JSON file per request key, for replaying
+    recorded sessions and offline evaluation without paying the inference again.
+
+    The least recently used entries are removed once the files exceed max_size_mb. Entries are only ever replaced
+    as a whole, so several processes may share a cache directory; recency is kept in the mtime of the files.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+
+        self._lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self._index = OrderedDict()
+        self._total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _load_index(self):
+        entries = []
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+
+    def get(self, key):
+        """
+        The cached completion dict of a key, None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            # the recency survives the process
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+                if key in self._index:
+                    # removed by another process sharing the directory
+                    self._total_bytes -= self._index.pop(key)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._index:
+                self._index.move_to_end(key)
+        return entry["completion"]
+
+    def put(self, key, completion, model_name=None):
+        """
+        Store the completion dict of a key, evicting the least recently used entries beyond the size limit.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"model": model_name, "time": time.time(), "completion": completion}, ensure_ascii=False)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self.stores += 1
+            self._total_bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._index) > 1:
+                old_key, old_size = self._index.popitem(last=False)
+                self._total_bytes -= old_size
+                self.evictions += 1
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "entries": len(self._index),
+                "size_mb": self._total_bytes / 1024 / 1024,
+            }
+
+    def report(self):
+        stats = self.get_stats()
+        print(f"LLM response cache {self.cache_dir}: {stats['hits']} hits / {stats['hits'] + stats['misses']} lookups "
+              f"({100 * stats['hit_rate']:.1f}%), {stats['entries']} entries, {stats['size_mb']:.1f}MB, "
+              f"{stats['evictions']} evicted")
+
+
+_response_caches = {}
+_response_caches_lock = threading.Lock()
+
+
+def get_response_cache(cache_config):
+    """
+    Get the process wide cache of a cache_config, {"cache_dir": ..., "max_size_mb": 1024}, None if it is not enabled.
+    Its hit rate is reported when the process exits.
+    """
+    if cache_config is None or not cache_config.get("enabled", True):
+        return None
+    cache_dir = os.path.abspath(cache_config["cache_dir"])
+    with _response_caches_lock:
+        if cache_dir not in _response_caches:
+            cache = ResponseCache(cache_dir, max_size_mb=cache_config.get("max_size_mb", 1024))
+            atexit.register(cache.report)
+            _response_caches[cache_dir] = cache
+        return _response_caches[cache_dir]
+
+
+if __name__ == "__main__":
+    # python tools/llm_cache.py
+    # replays the same session twice against a stand-in server with 50ms per request, the replay is served by the cache
+    import tempfile
+    import yaml
+
+    from PIL import Image
+    from tools.llm_providers import _StandInOpenAIServer
+    from tools.image_pipeline import image_asset_from_frame
+
+    server = _StandInOpenAIServer(latency=0.05)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, "model_config.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump({"stand-in": {"api_base": server.api_base}}, f)
+        os.environ["GELAB_MODEL_CONFIG"] = config_path
+        from tools.ask_llm_v2 import ask_llm_anything
+
+        cache = get_response_cache({"cache_dir": os.path.join(tmp_dir, "llm_cache")})
+        screenshots = [image_asset_from_frame(Image.effect_noise((540, 1200), 64 + i).convert("RGB"))[1] for i in range(20)]
+
+        def replay():
+            start_time = time.time()
+            for i, url in enumerate(screenshots):
+                messages = [{"role": "user", "content": [{"type": "text", "text": f"step {i}"}, {"type": "image_url", "image_url": {"url": url}}]}]
+                ask_llm_anything("stand-in", "stand-in", messages, args={"temperature": 0.1, "max_tokens": 64}, response_cache=cache)
+            return time.time() - start_time
+
+        first_time = replay()
+        requests_sent = server.requests
+        replay_time = replay()
+        assert server.requests == requests_sent, "the replay reached the server"
+        print(f"first run {first_time:.2f}s, {requests_sent} requests; replay {replay_time:.2f}s, no request")
+        cache.report()
+
+        # the least recently used entries go beyond the size limit
+        small_cache = ResponseCache(os.path.join(tmp_dir, "small_cache"), max_size_mb=0.002)
+        for i in range(10):
+            small_cache.put(f"{i:064x}", {"content": "x" * 500})
+        assert small_cache.get(f"{0:064x}") is None and small_cache.get(f"{9:064x}") is not None
+        print("size limit:", small_cache.get_stats())
+    server.close()
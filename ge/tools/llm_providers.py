@@ -0,0 +1,992 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+
+if "." not in sys.path:
+    sys.path.append(".")
+
+from tools.async_runner import run_sync
+
+import yaml
+import openai
+from collections import OrderedDict, deque
+from megfile import smart_open, smart_stat, smart_exists
+from openai import OpenAI, AsyncOpenAI
+
+try:
+    import httpx
+except ImportError:
+    # the connection limits are not configurable then, the OpenAI client keeps its defaults
+    httpx = None
+
+# defaults of the optional per-provider settings of model_config.yaml
+_DEFAULT_PROVIDER_SETTINGS = {
+    # seconds, for the whole request and for establishing the connection
+    "timeout": 600,
+    "connect_timeout": 10,
+    # connections kept open to the provider, shared by all threads
+    "max_connections": 64,
+    "max_keepalive_connections": 32,
+    "keepalive_expiry": 60,
+    # a request failing with a connection error, timeout, 5xx or 429 goes to the other endpoints right away,
+    # then all of them are retried max_retries times, after a jittered exponential backoff from backoff_base
+    # up to backoff_max seconds
+    "max_retries": 2,
+    "backoff_base": 0.5,
+    "backoff_max": 8,
+    # seconds for a whole call, retries and backoffs included, None for no limit besides the timeout of each attempt
+    "deadline": None,
+    # requests in flight to the provider, the others wait for a slot, None for no limit
+    "max_concurrency": None,
+    # consecutive connection errors or 5xx after which the requests are refused for circuit_cooldown seconds,
+    # None to never refuse them
+    "circuit_failures": 5,
+    "circuit_cooldown": 30,
+
+    # with a list of api_base endpoints: "least_outstanding" requests or "ewma" latency
+    "balance": "least_outstanding",
+    # consecutive failures before an endpoint is ejected, and seconds before it is health checked to come back
+    "max_failures": 1,
+    "eject_cooldown": 30,
+    "ewma_alpha": 0.3,
+    # the requests of a session stay on one endpoint, for the prefix cache of the inference server
+    "sticky_sessions": True,
+}
+
+# errors worth trying another endpoint for, the others are the same on every endpoint
+_FAILOVER_ERRORS = (openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError)
+# errors that say the endpoint itself is unhealthy, APITimeoutError is an APIConnectionError
+_EJECT_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """
+    A call, with its retries, did not finish within its deadline.
+    """
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    A call refused without being sent, the provider failed too often recently.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after failures consecutive connection errors or 5xx of a provider, and refuses its requests for cooldown
+    seconds, so a dead provider fails the steps at once instead of after all their retries. Then a single probe
+    request is let through, a success closes the circuit, a failure opens it for another cooldown.
+    """
+
+    def __init__(self, failures=5, cooldown=30):
+        self.failures = failures
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        # closed, open or half_open
+        self.state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probing = False
+
+        self.rejected = 0
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if the request may not be sent.
+        """
+        if self.failures is None:
+            return
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.time() - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(f"circuit open after {self._consecutive_failures} failures in a row, "
+                                   f"retried {self.cooldown - (time.time() - self._opened_at):.1f}s from now")
+
+    def record(self, failed):
+        """
+        Record the outcome of a request, failed is None for a request cancelled before it had one.
+        """
+        if self.failures is None:
+            return
+        with self._lock:
+            if failed is None:
+                if self.state == "half_open":
+                    self._probing = False
+                return
+            if not failed:
+                if self.state != "closed":
+                    print("Circuit closed, the provider answers again")
+                self.state = "closed"
+                self._consecutive_failures = 0
+                self._probing = False
+                return
+
+            self._consecutive_failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self._consecutive_failures >= self.failures):
+                self.state = "open"
+                self._opened_at = time.time()
+                self._probing = False
+                print(f"Circuit opened for {self.cooldown}s after {self._consecutive_failures} failures in a row")
+
+
+class Endpoint:
+    """
+    One api_base of a provider, with its clients and the stats the balancer decides on.
+    """
+
+    def __init__(self, api_base, client, async_client_factory=None):
+        self.api_base = api_base
+        self.client = client
+        self._async_client_factory = async_client_factory
+        self._async_client = None
+
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.failures = 0
+        # time the endpoint may be health checked again, None while it is in rotation
+        self.ejected_until = None
+
+        self.requests = 0
+        self.errors = 0
+
+    def get_async_client(self):
+        # built on first use, most providers are only called synchronously
+        if self._async_client is None:
+            self._async_client = self._async_client_factory()
+        return self._async_client
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate of a slow request: once it has been running for the given percentile of the recent
+    latencies. The hedges are capped to max_hedge_ratio of the requests, plus a burst, so a slow provider does not
+    get twice the load.
+    """
+
+    def __init__(self, percentile=95, min_samples=20, window=200, max_hedge_ratio=0.1, burst=2, min_delay=0.05):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self.burst = burst
+        self.min_delay = min_delay
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+
+    def start_request(self):
+        """
+        Count a request and return its hedge delay, None until enough latencies are known.
+        """
+        with self._lock:
+            self.requests += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+            index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+            return max(self.min_delay, latencies[index])
+
+    def try_spend(self):
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_ratio * self.requests + self.burst:
+                self.budget_exhausted += 1
+                return False
+            self.hedges += 1
+            return True
+
+    def record(self, latency, hedge_won=False):
+        with self._lock:
+            self._latencies.append(latency)
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedges / self.requests if self.requests > 0 else 0.0,
+                "hedge_win_rate": self.hedge_wins / self.hedges if self.hedges > 0 else 0.0,
+                "budget_exhausted": self.budget_exhausted,
+            }
+
+
+class EndpointBalancer:
+    """
+    Spreads the requests of one provider over its endpoints.
+
+    An endpoint failing max_failures times in a row is ejected; once eject_cooldown has passed, a background
+    health check (GET /models) puts it back, or ejects it for another cooldown. With sticky_sessions, a session
+    keeps its endpoint while it is in rotation.
+
+    The requests run as coroutines on the background loop of async_runner, with the async clients of the endpoints;
+    at most max_concurrency of them are in flight, and a CircuitBreaker refuses them while the provider is down.
+    """
+
+    def __init__(self, endpoints, balance="least_outstanding", max_failures=1, eject_cooldown=30, ewma_alpha=0.3,
+                 sticky_sessions=True, max_sticky_sessions=4096, max_retries=2, backoff_base=0.5, backoff_max=8,
+                 deadline=None, max_concurrency=None, circuit_failures=5, circuit_cooldown=30):
+        assert len(endpoints) > 0, "EndpointBalancer needs at least one endpoint"
+        assert balance in ["least_outstanding", "ewma"], f"Unknown balance policy: {balance}"
+        self.endpoints = endpoints
+        self.balance = balance
+        self.max_failures = max_failures
+        self.eject_cooldown = eject_cooldown
+        self.ewma_alpha = ewma_alpha
+        self.sticky_sessions = sticky_sessions
+        self.max_sticky_sessions = max_sticky_sessions
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.max_concurrency = max_concurrency
+        self.circuit = CircuitBreaker(circuit_failures, circuit_cooldown)
+
+        self._lock = threading.Lock()
+        # session id -> endpoint, least recently used first
+        self._sticky = OrderedDict()
+        self._round_robin = 0
+        self._health_checker = None
+        # (model, hedge config) -> HedgePolicy, the latencies differ per model
+        self._hedge_policies = {}
+        # created on the background loop by the first request
+        self._semaphore = None
+
+        self.retries = 0
+        self.deadline_exceeded = 0
+
+    def _score(self, endpoint, default_latency):
+        if self.balance == "ewma":
+            latency = endpoint.ewma_latency if endpoint.ewma_latency is not None else default_latency
+            return (latency * (endpoint.outstanding + 1), endpoint.outstanding)
+        return endpoint.outstanding
+
+    def _select(self, session_id=None, exclude=()):
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.ejected_until is None and endpoint not in exclude]
+        if len(candidates) == 0:
+            # all ejected, the one back soonest: a failing endpoint beats no answer at all
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            if len(candidates) == 0:
+                return None
+            candidates = [min(candidates, key=lambda endpoint: endpoint.ejected_until or 0)]
+
+        sticky = self.sticky_sessions and session_id is not None
+        if sticky:
+            endpoint = self._sticky.get(session_id, None)
+            if endpoint in candidates:
+                self._sticky.move_to_end(session_id)
+                return endpoint
+
+        # an endpoint without a latency yet counts as the fastest known one
+        latencies = [endpoint.ewma_latency for endpoint in candidates if endpoint.ewma_latency is not None]
+        default_latency = min(latencies) if len(latencies) > 0 else 0.0
+
+        # equal scores are taken in turn
+        self._round_robin += 1
+        offset = self._round_robin % len(candidates)
+        endpoint = min(candidates[offset:] + candidates[:offset], key=lambda endpoint: self._score(endpoint, default_latency))
+
+        if sticky:
+            self._sticky[session_id] = endpoint
+            self._sticky.move_to_end(session_id)
+            while len(self._sticky) > self.max_sticky_sessions:
+                self._sticky.popitem(last=False)
+        return endpoint
+
+    def acquire(self, session_id=None, exclude=()):
+        """
+        Pick an endpoint for a request and count it as outstanding, None if all endpoints are excluded.
+        """
+        with self._lock:
+            endpoint = self._select(session_id, exclude)
+            if endpoint is not None:
+                endpoint.outstanding += 1
+                endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, latency=None, error=None, cancelled=False):
+        """
+        Finish a request of acquire, with its latency on success or the error it failed with.
+        """
+        self.circuit.record(None if cancelled else isinstance(error, _EJECT_ERRORS))
+        with self._lock:
+            endpoint.outstanding -= 1
+            if cancelled:
+                return
+            if error is None or not isinstance(error, _EJECT_ERRORS):
+                if error is not None:
+                    endpoint.errors += 1
+                endpoint.failures = 0
+                if latency is not None:
+                    if endpoint.ewma_latency is None:
+                        endpoint.ewma_latency = latency
+                    else:
+                        endpoint.ewma_latency += self.ewma_alpha * (latency - endpoint.ewma_latency)
+                return
+
+            endpoint.errors += 1
+            endpoint.failures += 1
+            if endpoint.failures >= self.max_failures and endpoint.ejected_until is None and len(self.endpoints) > 1:
+                endpoint.ejected_until = time.time() + self.eject_cooldown
+                print(f"Ejected endpoint {endpoint.api_base} for {self.eject_cooldown}s: {error}")
+                if self._health_checker is None:
+                    self._health_checker = threading.Thread(target=self._health_check_runner, daemon=True)
+                    self._health_checker.start()
+
+    def _health_check_runner(self):
+        while True:
+            time.sleep(min(1.0, self.eject_cooldown))
+            now = time.time()
+            with self._lock:
+                ejected = [endpoint for endpoint in self.endpoints if endpoint.ejected_until is not None]
+                if len(ejected) == 0:
+                    self._health_checker = None
+                    return
+            for endpoint in ejected:
+                if endpoint.ejected_until > now:
+                    continue
+                try:
+                    endpoint.client.with_options(timeout=5, max_retries=0).models.list()
+                    healthy = True
+                except Exception:
+                    healthy = False
+                with self._lock:
+                    if healthy:
+                        endpoint.ejected_until = None
+                        endpoint.failures = 0
+                        print(f"Endpoint {endpoint.api_base} is healthy again")
+                    else:
+                        endpoint.ejected_until = time.time() + self.eject_cooldown
+
+    async def _run_attempt(self, endpoint, request):
+        if self.max_concurrency is None:
+            return await request(endpoint.get_async_client())
+        if self._semaphore is None:
+            # only ever touched from the background loop, no lock needed
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await request(endpoint.get_async_client())
+
+    def _backoff_delay(self, attempt, error):
+        # full jitter, the retries of many sessions failing together do not come back together
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        # a 429 or 503 may say when to come back
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                delay = max(delay, min(self.backoff_max, float(response.headers.get("retry-after"))))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    async def _with_deadline(self, coro, deadline):
+        deadline = self.deadline if deadline is None else deadline
+        if deadline is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, deadline)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.deadline_exceeded += 1
+            raise LLMDeadlineExceeded(f"no response within the deadline of {deadline}s") from None
+
+    async def _call_with_retries(self, request, session_id, can_retry):
+        tried = []
+        attempt = 0
+        while True:
+            self.circuit.before_call()
+            endpoint = self.acquire(session_id, exclude=tried)
+            start_time = time.time()
+            try:
+                result = await self._run_attempt(endpoint, request)
+            except asyncio.CancelledError:
+                self.release(endpoint, cancelled=True)
+                raise
+            except Exception as e:
+                self.release(endpoint, error=e)
+                tried.append(endpoint)
+                if not isinstance(e, _FAILOVER_ERRORS):
+                    raise
+                if can_retry is not None and not can_retry():
+                    raise
+                if len(tried) < len(self.endpoints):
+                    print(f"Request to {endpoint.api_base} failed, trying another endpoint: {e}")
+                    continue
+
+                # every endpoint failed in this round, the next one starts after a backoff
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                tried = []
+                delay = self._backoff_delay(attempt, e)
+                print(f"Request to {endpoint.api_base} failed, retry {attempt}/{self.max_retries} in {delay:.2f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            self.release(endpoint, latency=time.time() - start_time)
+            return result
+
+    async def async_call(self, request, session_id=None, can_retry=None, deadline=None):
+        """
+        Run the coroutine request(async_client) on an endpoint. If it fails with a connection error, timeout,
+        5xx or 429, it fails over to another endpoint right away while there is an untried one; once all failed,
+        the round is retried after a jittered exponential backoff, up to max_retries times.
+        can_retry() may forbid the retry, e.g. once a streamed response was partly consumed.
+        The whole call fails with LLMDeadlineExceeded after deadline seconds, the deadline of the provider by default,
+        and with CircuitOpenError without being sent while the circuit of the provider is open.
+        """
+        return await self._with_deadline(self._call_with_retries(request, session_id, can_retry), deadline)
+
+    def call(self, request, session_id=None, can_retry=None, deadline=None):
+        """
+        Sync facade of async_call for the callers running in threads, request(async_client) returns an awaitable,
+        e.g. lambda client: client.chat.completions.create(**kwargs).
+        """
+        return run_sync(self.async_call(request, session_id, can_retry, deadline))
+
+    def get_hedge_policy(self, model_name, hedge_config):
+        key = (model_name, tuple(sorted(hedge_config.items())))
+        with self._lock:
+            if key not in self._hedge_policies:
+                self._hedge_policies[key] = HedgePolicy(**{k: v for k, v in hedge_config.items() if k != "enabled"})
+            return self._hedge_policies[key]
+
+    async def async_call_hedged(self, request, policy, session_id=None, call_stats=None, deadline=None):
+        """
+        Run the coroutine request(async_client) on an endpoint. If it is still running after the hedge delay of
+        the policy, a duplicate goes to another endpoint; the first response wins and the other request is
+        cancelled, which closes its connection. Failed requests fail over to the endpoints not tried yet, without backoff.
+        call_stats, if given, receives how this request was hedged and the totals of the policy.
+        The deadline, concurrency limit and circuit breaker apply as in async_call.
+        """
+        return await self._with_deadline(self._call_hedged(request, policy, session_id, call_stats), deadline)
+
+    async def _call_hedged(self, request, policy, session_id, call_stats):
+        start_time = time.time()
+        hedge_delay = policy.start_request()
+        tried = []
+        # task -> (endpoint, is the hedge)
+        tasks = {}
+        hedge_decided, hedged = hedge_delay is None, False
+        last_error = None
+
+        def launch(is_hedge):
+            try:
+                self.circuit.before_call()
+            except CircuitOpenError:
+                if len(tried) == 0:
+                    raise
+                # no duplicate or failover while the provider is failing
+                return False
+            endpoint = self.acquire(None if is_hedge else session_id, exclude=tried)
+            if endpoint is None:
+                return False
+            tried.append(endpoint)
+            tasks[asyncio.ensure_future(self._run_attempt(endpoint, request))] = (endpoint, is_hedge)
+            return True
+
+        launch(False)
+        try:
+            while len(tasks) > 0:
+                timeout = None if hedge_decided else max(0.0, start_time + hedge_delay - time.time())
+                done, _ = await asyncio.wait(list(tasks.keys()), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    # slower than the hedge delay, one duplicate at most
+                    hedge_decided = True
+                    if policy.try_spend():
+                        hedged = launch(True)
+                    continue
+
+                for task in done:
+                    endpoint, is_hedge = tasks.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        latency = time.time() - start_time
+                        self.release(endpoint, latency=latency)
+                        policy.record(latency, hedge_won=is_hedge)
+                        if call_stats is not None:
+                            call_stats.update({"hedge_delay": hedge_delay, "hedged": hedged, "hedge_won": is_hedge})
+                            call_stats.update(policy.get_stats())
+                        return task.result()
+
+                    self.release(endpoint, error=error)
+                    last_error = error
+                    if isinstance(error, _FAILOVER_ERRORS) and len(tasks) == 0:
+                        print(f"Request to {endpoint.api_base} failed, trying another endpoint: {error}")
+                        launch(False)
+            raise last_error
+        finally:
+            # the losing request, or all of them if this call is cancelled
+            for task, (endpoint, is_hedge) in tasks.items():
+                task.cancel()
+                self.release(endpoint, cancelled=True)
+
+    def call_hedged(self, request, policy, session_id=None, call_stats=None, deadline=None):
+        return run_sync(self.async_call_hedged(request, policy, session_id, call_stats, deadline))
+
+    def get_client(self, session_id=None):
+        with self._lock:
+            return self._select(session_id).client
+
+    def get_stats(self):
+        with self._lock:
+            return [{
+                "api_base": endpoint.api_base,
+                "outstanding": endpoint.outstanding,
+                "ewma_latency": endpoint.ewma_latency,
+                "requests": endpoint.requests,
+                "errors": endpoint.errors,
+                "ejected": endpoint.ejected_until is not None,
+            } for endpoint in self.endpoints]
+
+    def get_call_stats(self):
+        with self._lock:
+            return {
+                "retries": self.retries,
+                "deadline_exceeded": self.deadline_exceeded,
+                "circuit_state": self.circuit.state,
+                "circuit_rejected": self.circuit.rejected,
+            }
+
+
+class ProviderRegistry:
+    """
+    The providers of model_config.yaml and one keep-alive OpenAI client per provider endpoint.
+
+    The config is parsed once and re-read only when its mtime changes, checked at most every reload_interval
+    seconds. A provider whose settings changed gets a new client, the others keep their connection pools.
+    """
+
+    def __init__(self, config_path="model_config.yaml", reload_interval=1.0):
+        self.config_path = config_path
+        self.reload_interval = reload_interval
+
+        self._lock = threading.Lock()
+        self._config = None
+        self._mtime = None
+        self._last_check_time = 0
+        # provider -> (settings, EndpointBalancer)
+        self._balancers = {}
+
+    def _maybe_reload(self):
+        now = time.time()
+        if self._config is not None and now - self._last_check_time < self.reload_interval:
+            return
+        self._last_check_time = now
+
+        assert smart_exists(self.config_path), f"model config {self.config_path} does not exist"
+        mtime = smart_stat(self.config_path).mtime
+        if self._config is not None and mtime == self._mtime:
+            return
+
+        with smart_open(self.config_path, "r") as f:
+            config = yaml.safe_load(f) or {}
+        if self._config is not None:
+            print(f"Reloaded model config {self.config_path}")
+        self._config, self._mtime = config, mtime
+
+    def get_config(self):
+        with self._lock:
+            self._maybe_reload()
+            return self._config
+
+    def get_provider_settings(self, model_provider):
+        """
+        The settings of a provider, with the defaults of the optional ones filled in.
+        """
+        config = self.get_config()
+        if model_provider not in config:
+            raise ValueError(f"Unknown model provider: {model_provider}")
+
+        provider_config = config[model_provider] or {}
+        assert "api_base" in provider_config, f"model provider {model_provider} must have 'api_base'"
+        settings = dict(_DEFAULT_PROVIDER_SETTINGS)
+        settings.update(provider_config)
+        return settings
+
+    def _build_client(self, settings, api_base, is_async=False):
+        kwargs = {
+            "api_key": settings.get("api_key", "EMPTY"),
+            "base_url": api_base,
+            # retried by the balancer, over the endpoints and within the deadline
+            "max_retries": 0,
+        }
+        if httpx is not None:
+            timeout = httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"])
+            kwargs["timeout"] = timeout
+            kwargs["http_client"] = (httpx.AsyncClient if is_async else httpx.Client)(
+                timeout=timeout,
+                limits=httpx.Limits(
+                    max_connections=settings["max_connections"],
+                    max_keepalive_connections=settings["max_keepalive_connections"],
+                    keepalive_expiry=settings["keepalive_expiry"],
+                ),
+            )
+        else:
+            kwargs["timeout"] = settings["timeout"]
+        return AsyncOpenAI(**kwargs) if is_async else OpenAI(**kwargs)
+
+    def get_balancer(self, model_provider):
+        """
+        Get the endpoints of a provider, api_base may be one URL or a list of them; rebuilt only if the settings changed.
+        """
+        settings = self.get_provider_settings(model_provider)
+        with self._lock:
+            entry = self._balancers.get(model_provider, None)
+            if entry is None or entry[0] != settings:
+                # replaced clients are not closed, requests in flight may still use them
+                api_bases = settings["api_base"] if type(settings["api_base"]) == list else [settings["api_base"]]
+                balancer = EndpointBalancer(
+                    [Endpoint(
+                        api_base,
+                        self._build_client(settings, api_base),
+                        lambda api_base=api_base: self._build_client(settings, api_base, is_async=True),
+                    ) for api_base in api_bases],
+                    balance=settings["balance"],
+                    max_failures=settings["max_failures"],
+                    eject_cooldown=settings["eject_cooldown"],
+                    ewma_alpha=settings["ewma_alpha"],
+                    sticky_sessions=settings["sticky_sessions"],
+                    max_retries=settings["max_retries"],
+                    backoff_base=settings["backoff_base"],
+                    backoff_max=settings["backoff_max"],
+                    deadline=settings["deadline"],
+                    max_concurrency=settings["max_concurrency"],
+                    circuit_failures=settings["circuit_failures"],
+                    circuit_cooldown=settings["circuit_cooldown"],
+                )
+                entry = (settings, balancer)
+                self._balancers[model_provider] = entry
+            return entry[1]
+
+    def get_client(self, model_provider, session_id=None):
+        """
+        Get a shared OpenAI client of a provider, of the endpoint the balancer would pick.
+        """
+        return self.get_balancer(model_provider).get_client(session_id)
+
+
+_provider_registries = {}
+_provider_registries_lock = threading.Lock()
+
+
+def get_provider_registry(config_path="model_config.yaml"):
+    """
+    Get the process wide registry of a model config, shared by the agent, caption and auto-reply calls.
+    """
+    config_path = os.environ.get("GELAB_MODEL_CONFIG", config_path)
+    with _provider_registries_lock:
+        if config_path not in _provider_registries:
+            _provider_registries[config_path] = ProviderRegistry(config_path)
+        return _provider_registries[config_path]
+
+
+def get_llm_client(model_provider, session_id=None):
+    return get_provider_registry().get_client(model_provider, session_id)
+
+
+def get_llm_balancer(model_provider):
+    return get_provider_registry().get_balancer(model_provider)
+
+
+class _StandInOpenAIServer:
+    """
+    A minimal OpenAI-compatible server on localhost for the checks of this module and the benchmarks using it:
+    /models and /chat/completions, answering after latency seconds, or with a 500 while failing is set;
+    a POST of {"requests": [...]} is answered as a batch, see ask_llm_batch, a "stream" request with chunks of the reply.
+    fault(request), if given, injects a fault into a POST: an HTTP status, e.g. 503 or 429 (with a Retry-After of 0),
+    "drop" to close the connection without a response, or None to answer normally.
+    """
+
+    def __init__(self, latency=0.01, reply="explain:ok\taction:WAIT\tvalue:1\tsummary:ok", fault=None):
+        import json
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        self.latency = latency
+        self.reply = reply
+        self.failing = False
+        self.fault = fault
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, body, headers={}):
+                data = json.dumps(body).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    for key, value in headers.items():
+                        self.send_header(key, value)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client cancelled the request, e.g. the loser of a hedge
+                    self.close_connection = True
+
+            def _send_stream(self, request):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                reply = stand_in.reply
+                try:
+                    for i in range(0, len(reply), 8):
+                        chunk = {
+                            "id": f"stand-in-{stand_in.requests}", "object": "chat.completion.chunk", "created": 0, "model": request["model"],
+                            "choices": [{"index": 0, "finish_reason": None, "delta": {"role": "assistant", "content": reply[i:i + 8]}}],
+                        }
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                if stand_in.failing:
+                    self._send_json(500, {"error": {"message": "failing"}})
+                else:
+                    self._send_json(200, {"object": "list", "data": [{"id": "stand-in", "object": "model", "created": 0, "owned_by": "gelab"}]})
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with stand_in._lock:
+                    stand_in.requests += 1
+                    stand_in.in_flight += 1
+                    stand_in.max_in_flight = max(stand_in.max_in_flight, stand_in.in_flight)
+                try:
+                    time.sleep(stand_in.latency(request) if callable(stand_in.latency) else stand_in.latency)
+                    fault = stand_in.fault(request) if stand_in.fault is not None else None
+                finally:
+                    with stand_in._lock:
+                        stand_in.in_flight -= 1
+                if stand_in.failing:
+                    fault = 500
+                if fault == "drop":
+                    self.close_connection = True
+                    return
+                if fault is not None:
+                    self._send_json(fault, {"error": {"message": f"injected fault {fault}"}}, headers={"Retry-After": "0"} if fault == 429 else {})
+                    return
+
+                def completion(request):
+                    return {
+                        "id": f"stand-in-{stand_in.requests}", "object": "chat.completion", "created": 0, "model": request["model"],
+                        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": stand_in.reply}}],
+                    }
+
+                if "requests" in request and "model" not in request:
+                    self._send_json(200, {"responses": [completion(r) for r in request["requests"]]})
+                elif request.get("stream", False):
+                    self._send_stream(request)
+                else:
+                    self._send_json(200, completion(request))
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self.api_base = f"http://127.0.0.1:{self.port}/v1"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    # python tools/llm_providers.py [model_config.yaml]
+    # compares parsing the config and building a client on every call, as before, with the registry,
+    # then balances and fails over between stand-in endpoints
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    config_path = sys.argv[1] if len(sys.argv) > 1 else "model_config.yaml"
+    with smart_open(config_path, "r") as f:
+        model_provider = list(yaml.safe_load(f).keys())[0]
+
+    calls = 200
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        with smart_open(config_path, "r") as f:
+            model_config = yaml.safe_load(f)
+        OpenAI(api_key=model_config[model_provider].get("api_key", "EMPTY"), base_url=model_config[model_provider]["api_base"])
+    rebuild_time = time.perf_counter() - start_time
+
+    registry = ProviderRegistry(config_path)
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        balancer = registry.get_balancer(model_provider)
+    registry_time = time.perf_counter() - start_time
+    assert registry.get_balancer(model_provider) is balancer
+    print(f"{model_provider}: rebuild per call {1000 * rebuild_time / calls:.2f}ms, registry {1000 * registry_time / calls:.3f}ms")
+
+    servers = [_StandInOpenAIServer(latency=0.01), _StandInOpenAIServer(latency=0.05), _StandInOpenAIServer(latency=0.01)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "model_config.yaml")
+        with open(path, "w") as f:
+            yaml.safe_dump({"a": {"api_base": "http://localhost:1/v1"}, "b": {"api_base": "http://localhost:2/v1"}}, f)
+        registry = ProviderRegistry(path, reload_interval=0)
+        balancer_a, balancer_b = registry.get_balancer("a"), registry.get_balancer("b")
+
+        # a changed api_base replaces the endpoints of that provider only
+        with open(path, "w") as f:
+            yaml.safe_dump({
+                "a": {"api_base": "http://localhost:3/v1"},
+                "b": {"api_base": "http://localhost:2/v1"},
+                "replicas": {"api_base": [server.api_base for server in servers], "balance": "ewma", "eject_cooldown": 1, "max_retries": 0},
+            }, f)
+        os.utime(path, (time.time() + 1, time.time() + 1))
+        assert registry.get_balancer("a") is not balancer_a
+        assert registry.get_balancer("a").endpoints[0].api_base == "http://localhost:3/v1"
+        assert registry.get_balancer("b") is balancer_b
+        print("hot reload ok")
+
+        balancer = registry.get_balancer("replicas")
+
+        def ask(session_id):
+            completion = balancer.call(lambda client: client.chat.completions.create(
+                model="stand-in", messages=[{"role": "user", "content": "hi"}], max_tokens=16), session_id=session_id)
+            return completion.choices[0].message.content
+
+        # the steps of a session stay on its endpoint
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(ask, [f"session_{i % 16}" for i in range(160)]))
+        sticky = {session_id: endpoint.api_base for session_id, endpoint in balancer._sticky.items()}
+        print("sessions per endpoint:", {server.api_base: list(sticky.values()).count(server.api_base) for server in servers})
+        print("requests per endpoint:", [server.requests for server in servers])
+
+        # without sessions, the ewma latency steers the requests away from the slow endpoint
+        requests_before = [server.requests for server in servers]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(ask, [None] * 160))
+        print("requests per endpoint, no session:", [server.requests - before for server, before in zip(servers, requests_before)])
+
+        # the failing endpoint is ejected, its sessions fail over, and it is back after the cooldown
+        servers[0].failing = True
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            replies = list(executor.map(ask, [f"session_{i % 16}" for i in range(64)]))
+        assert all(reply is not None for reply in replies)
+        assert balancer.endpoints[0].ejected_until is not None
+        print("ejected:", [stats["ejected"] for stats in balancer.get_stats()])
+        servers[0].failing = False
+        time.sleep(2.5)
+        assert balancer.endpoints[0].ejected_until is None
+        print("after the cooldown:", [stats["ejected"] for stats in balancer.get_stats()])
+
+    for server in servers:
+        server.close()
+
+    # hedging: 5% of the requests of the stand-ins take 0.5s instead of 20ms
+    import random
+    servers = [_StandInOpenAIServer(latency=lambda request: 0.5 if random.random() < 0.05 else 0.02) for _ in range(2)]
+
+    def run(hedge_config):
+        balancer = EndpointBalancer([
+            Endpoint(server.api_base, OpenAI(api_key="EMPTY", base_url=server.api_base, max_retries=0),
+                     lambda api_base=server.api_base: AsyncOpenAI(api_key="EMPTY", base_url=api_base, max_retries=0))
+            for server in servers
+        ])
+        policy = HedgePolicy(**hedge_config) if hedge_config is not None else None
+
+        def ask(session_id):
+            start_time = time.time()
+            if policy is None:
+                balancer.call(lambda client: client.chat.completions.create(
+                    model="stand-in", messages=[{"role": "user", "content": "hi"}], max_tokens=16), session_id=session_id)
+            else:
+                balancer.call_hedged(lambda client: client.chat.completions.create(
+                    model="stand-in", messages=[{"role": "user", "content": "hi"}], max_tokens=16), policy, session_id=session_id)
+            return time.time() - start_time
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            latencies = sorted(executor.map(ask, [f"session_{i % 8}" for i in range(400)]))
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+        print(f"hedging {hedge_config}: p50 {1000 * p50:.0f}ms, p99 {1000 * p99:.0f}ms, "
+              f"total {sum(latencies):.1f}s, {policy.get_stats() if policy is not None else ''}")
+
+    run(None)
+    run({"percentile": 90, "max_hedge_ratio": 0.15})
+    for server in servers:
+        server.close()
+
+    # retries, deadlines, concurrency limit and circuit breaking against a fault-injecting stand-in
+    def single_endpoint_balancer(server, **kwargs):
+        return EndpointBalancer([Endpoint(server.api_base, OpenAI(api_key="EMPTY", base_url=server.api_base, max_retries=0),
+                                          lambda: AsyncOpenAI(api_key="EMPTY", base_url=server.api_base, max_retries=0))], **kwargs)
+
+    def ask_once(balancer, **kwargs):
+        return balancer.call(lambda client: client.chat.completions.create(
+            model="stand-in", messages=[{"role": "user", "content": "hi"}], max_tokens=16), **kwargs)
+
+    def count_failures(balancer, calls=100):
+        def ask(_):
+            try:
+                ask_once(balancer)
+                return 0
+            except Exception:
+                return 1
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return sum(executor.map(ask, range(calls)))
+
+    # 30% of the requests get a 503, 429 or lose their connection
+    server = _StandInOpenAIServer(latency=0.01, fault=lambda request: random.choice([503, 429, "drop"]) if random.random() < 0.3 else None)
+    without_retries = count_failures(single_endpoint_balancer(server, max_retries=0, circuit_failures=None))
+    balancer = single_endpoint_balancer(server, max_retries=4, backoff_base=0.05, circuit_failures=None)
+    with_retries = count_failures(balancer)
+    print(f"transient faults: {without_retries}/100 calls failed without retries, {with_retries}/100 with, {balancer.get_call_stats()}")
+    server.close()
+
+    # the deadline covers the retries: a 1s request is given up after 0.3s
+    server = _StandInOpenAIServer(latency=1.0)
+    start_time = time.time()
+    try:
+        ask_once(single_endpoint_balancer(server), deadline=0.3)
+        assert False, "the deadline did not fire"
+    except LLMDeadlineExceeded as e:
+        print(f"deadline: {e} after {time.time() - start_time:.2f}s")
+    server.close()
+
+    # no more than max_concurrency requests reach the provider
+    server = _StandInOpenAIServer(latency=0.05)
+    count_failures(single_endpoint_balancer(server, max_concurrency=3), calls=32)
+    assert server.max_in_flight <= 3
+    print(f"max_concurrency 3: at most {server.max_in_flight} requests in flight")
+
+    # a dead provider opens the circuit, the calls then fail at once, and a probe closes it once the provider is back
+    server = _StandInOpenAIServer(latency=0.01)
+    server.failing = True
+    balancer = single_endpoint_balancer(server, max_retries=0, circuit_failures=3, circuit_cooldown=0.5)
+    failures = count_failures(balancer, calls=20)
+    requests_sent = server.requests
+    print(f"failing provider: {failures}/20 calls failed, {requests_sent} sent, {balancer.get_call_stats()}")
+    assert balancer.circuit.state == "open" and requests_sent < 20
+    server.failing = False
+    time.sleep(0.6)
+    ask_once(balancer)
+    assert balancer.circuit.state == "closed"
+    print(f"provider back: {balancer.get_call_stats()}")
+    server.close()
@@ -69,6 +69,10 @@ def messages2sft(messages):
             role = "human"
         elif current_role in gpt_role:
             role = "assistant"
+        elif current_role == "system":
+            role = "system"
+        else:
+            raise ValueError(f"Unknown role: {message['role']} in message {message}")
 
         conversations.append({
             "role": role,
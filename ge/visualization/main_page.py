@@ -12,6 +12,7 @@ if "." not in sys.path:
     sys.path.append(".")
 
 from tools.image_tools import draw_points
+from copilot_agent_server.trace_writer import iter_jsonl
 
 from megfile import smart_open, smart_exists
 
@@ -107,22 +108,20 @@ if st.button("查找"):
     log_file = f"running_log/server_log/os-copilot-local-eval-logs/traces/{session_id}.jsonl"
 
     if smart_exists(log_file):
-        # with smart_open(log_file, "r") as f:
-        with smart_open(log_file, "r",encoding='utf-8') as f:
-            reader = jsonlines.Reader(f)
-            logs = [log for log in reader]
-
-            messages = meta2messages(logs)
-
-            for mes in messages:
-                with st.chat_message(mes['role']):
-                    if type(mes['content']) == str:
-                        st.markdown(mes['content'])
-                    else:
-                        # interleave_contents = try_pause_json(mes['content'])
-                        for item in mes['content']:
-                            if item['type'] == 'text':
-                                st.markdown(
+        # the session may still be running, a record being written is skipped
+        logs = [log for log in iter_jsonl(log_file)]
+
+        messages = meta2messages(logs)
+
+        for mes in messages:
+            with st.chat_message(mes['role']):
+                if type(mes['content']) == str:
+                    st.markdown(mes['content'])
+                else:
+                    # interleave_contents = try_pause_json(mes['content'])
+                    for item in mes['content']:
+                        if item['type'] == 'text':
+                            st.markdown(
     """
     <style>
     [data-testid="stJson"] {
@@ -133,12 +132,12 @@ if st.button("查找"):
     """,
     unsafe_allow_html=True
 )
-                                st.markdown(item['text'])
-                            elif item['type'] == 'image_url':
-                                image_url = item['image_url']['url']
-                                with smart_open(image_url, "rb") as f:
-                                    image = Image.open(f)
-                                    st.image(image)
+                            st.markdown(item['text'])
+                        elif item['type'] == 'image_url':
+                            image_url = item['image_url']['url']
+                            with smart_open(image_url, "rb") as f:
+                                image = Image.open(f)
+                                st.image(image)
 
     else:
         st.write("未找到数据")